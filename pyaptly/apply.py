@@ -0,0 +1,122 @@
+"""Bring repos, mirrors, snapshots and publishes up to date in one run."""
+
+import logging
+
+from . import (
+    command,
+    date_tools,
+    executor,
+    mirror,
+    model,
+    publish,
+    release,
+    repo,
+    snapshot,
+    state_reader,
+)
+
+lg = logging.getLogger(__name__)
+
+
+def apply(cfg, args):
+    """Create the commands of all sections, merge them and execute them.
+
+    This is the same as running `repo create`, `mirror update`, `snapshot
+    create`, `snapshot update`, `publish create` and `publish update`, but it
+    builds one dependency graph, so independent commands of different sections
+    can run at the same time and the aptly state is only read once.
+
+    :param  cfg: The configuration toml as dict
+    :type   cfg: dict
+    :param args: The command-line arguments read with :py:mod:`argparse`
+    :type  args: namespace
+    """
+    commands = cmd_apply(cfg)
+
+    if args.debug:  # pragma: no cover
+        dot_file = "/tmp/commands.dot"
+        with open(dot_file, "w", encoding="UTF-8") as fh_dot:
+            fh_dot.write(command.Command.command_list_to_digraph(commands))
+        lg.info("Wrote command dependency tree graph to %s", dot_file)
+
+    try:
+        executor.execute_commands(cfg, args, commands)
+    finally:
+        mirror.commit_release_cache(cfg, commands)
+
+
+def cmd_apply(cfg: dict) -> list[command.Command]:
+    """Create the commands of all sections to be ordered and executed later.
+
+    :param cfg: pyaptly config
+    :type  cfg: dict
+    """
+    commands: list[command.Command] = []
+    config = model.config(cfg)
+
+    for repo_name, repo_config in config.repos.items():
+        commands.append(repo.repo_cmd_create(cfg, repo_name, repo_config))
+
+    cache = release.release_cache(cfg)
+    if cache is not None:
+        # Check the Release files of all mirrors at once
+        cache.check_all(config.mirrors)
+    updated_mirrors = set()
+    for mirror_name, mirror_config in config.mirrors.items():
+        mirror_cmds = mirror.cmd_mirror_update(cfg, mirror_name, mirror_config)
+        commands.extend(mirror_cmds)
+        # Mirrors that did not change upstream are not updated
+        if any(
+            ("virtual", "mirror-updated-%s" % mirror_name) in cmd.get_provides()
+            for cmd in mirror_cmds
+        ):
+            updated_mirrors.add(mirror_name)
+
+    changing = frozenset(("mirror", name) for name in updated_mirrors)
+    snapshots = state_reader.state_reader().snapshots()
+    # Read the merge-tree of the snapshots that are updated at once
+    state_reader.state_reader().snapshot_map().prefetch(
+        name for name in config.snapshots if "%T" not in name
+    )
+    for snapshot_name, snapshot_config in config.snapshots.items():
+        name = date_tools.expand_timestamped_name(
+            snapshot_name, snapshot_config.timestamp or {}
+        )
+        if "%T" in snapshot_name or name not in snapshots:
+            snapshot_cmds = snapshot.cmd_snapshot_create(
+                cfg, snapshot_name, snapshot_config
+            )
+        else:
+            snapshot_cmds = snapshot.cmd_snapshot_update(
+                cfg, snapshot_name, snapshot_config, changing
+            )
+        for cmd in snapshot_cmds:
+            # Snapshots have to be taken after the mirror is updated
+            for type_, mirror_name in list(cmd._requires):
+                if type_ == "mirror" and mirror_name in updated_mirrors:
+                    cmd.require("virtual", "mirror-updated-%s" % mirror_name)
+        commands.extend(snapshot_cmds)
+
+    # Publishes affected by a snapshot update are already switched by it
+    provided = set(
+        provide for cmd in commands if cmd is not None for provide in cmd._provides
+    )
+    publishes = state_reader.state_reader().publishes()
+    for publish_entry in config.entries:
+        if ("publish", publish_entry.fullname) in provided:
+            continue
+        if publish_entry.fullname not in publishes:
+            commands.append(
+                publish.publish_cmd_create(cfg, publish_entry.name, publish_entry)
+            )
+        elif publish_entry.automatic_update:
+            commands.append(
+                publish.publish_cmd_update(cfg, publish_entry.name, publish_entry)
+            )
+
+    commands = [cmd for cmd in commands if cmd is not None]
+    publish.defer_cleanup(commands)
+    commands.extend(snapshot.cmd_cleanup_rotated(cfg, commands))
+    # Drop the timestamped snapshots that are not retained anymore last
+    commands.extend(snapshot.cmd_snapshot_gc(cfg, commands))
+    return commands
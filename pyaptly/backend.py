@@ -0,0 +1,626 @@
+"""Backends pyaptly uses to talk to aptly.
+
+The :py:class:`CliBackend` runs `aptly` processes and parses their output, it is
+the default. The :py:class:`ApiBackend` talks to `aptly api serve` over HTTP.
+The API server keeps the database open, so reads and commands do not pay for
+opening it every time and can run concurrently.
+"""
+
+import json
+import logging
+import queue
+import re
+import shlex
+import urllib.parse
+from tempfile import NamedTemporaryFile
+
+from . import util
+
+lg = logging.getLogger(__name__)
+
+
+def publish_name(prefix, distribution, storage=""):
+    """Return the name aptly uses for a publish in `aptly publish list -raw`.
+
+    :param       prefix: Prefix of the publish, "." if there is none
+    :type        prefix: str
+    :param distribution: Distribution of the publish
+    :type  distribution: str
+    :param      storage: Optional storage like "s3:endpoint"
+    :type       storage: str
+    """
+    if storage:
+        prefix = "%s:%s" % (storage, prefix)
+    return "%s %s" % (prefix, distribution)
+
+
+class PublishRecord(object):
+    """A publish as reported by aptly.
+
+    :param       prefix: Prefix of the publish, "." if there is none
+    :type        prefix: str
+    :param distribution: Distribution of the publish
+    :type  distribution: str
+    :param      storage: Storage like "s3:endpoint", "" for the local storage
+    :type       storage: str
+    :param  source_kind: "snapshot" or "local" if a repo is published
+    :type   source_kind: str
+    :param      sources: (component, name) of each published source in the
+                         order aptly reports them
+    :type       sources: list
+    """
+
+    def __init__(self, prefix, distribution, storage, source_kind, sources):
+        self.prefix = prefix
+        self.distribution = distribution
+        self.storage = storage
+        self.source_kind = source_kind
+        self.sources = list(sources)
+
+    @classmethod
+    def from_json(cls, item):
+        """Create a record from aptly's JSON, used by the API and `-json`."""
+        return cls(
+            item["Prefix"],
+            item["Distribution"],
+            item.get("Storage") or "",
+            item.get("SourceKind", "snapshot"),
+            [(source["Component"], source["Name"]) for source in item["Sources"]],
+        )
+
+    @property
+    def name(self):
+        """The name of the publish, "prefix distribution"."""
+        return publish_name(self.prefix, self.distribution, self.storage)
+
+    @property
+    def components(self):
+        """The published components."""
+        return [component for component, _ in self.sources]
+
+    @property
+    def snapshots(self):
+        """The names of the published snapshots."""
+        if self.source_kind != "snapshot":
+            return set()
+        return set(name for _, name in self.sources)
+
+    def snapshots_for(self, components):
+        """Return the published snapshots ordered like components.
+
+        If the components differ from the published ones, the snapshots are
+        returned in the order aptly reports them.
+
+        :param components: The components in the wanted order
+        :type  components: list
+        """
+        if self.source_kind != "snapshot":
+            return []
+        by_component = dict(self.sources)
+        if sorted(components) == sorted(by_component):
+            return [by_component[component] for component in components]
+        return [name for _, name in self.sources]
+
+    def __eq__(self, other):
+        return isinstance(other, PublishRecord) and vars(self) == vars(other)
+
+    def __repr__(self):
+        return "PublishRecord(%s, %s, %s)" % (
+            self.name,
+            self.source_kind,
+            self.sources,
+        )
+
+
+class CliBackend(object):
+    """Run `aptly` processes and parse their output."""
+
+    # match example:  test-snapshot [snapshot]
+    re_snapshot_source = re.compile(r"\s+([\w\d-]+)\s\[snapshot\]")
+    # match example:  main: test-snapshot [snapshot]
+    re_publish_source = re.compile(r"\s+([\w\d-]+)\:\s([\w\d-]+)\s\[(\w+)\]")
+    # match example: Disk space freed: 1.50 GiB...
+    re_space_freed = re.compile(r"Disk space freed: ([\d.]+) ?([KMGTP]i?B|B)")
+    byte_units = {"B": 1, "KiB": 2**10, "MiB": 2**20, "GiB": 2**30, "TiB": 2**40}
+
+    def _extract_sources(self, data):
+        """Extract sources from data.
+
+        Data needs to be in following format:
+        Name: test-snap
+        Description: some description
+        Sources:
+          test-snap-base [snapshot]
+        """
+        entered_sources = False
+        sources = []
+        for line in data.split("\n"):
+            # source line need to start with two spaces
+            if entered_sources and line[0:2] != "  ":
+                break
+
+            if entered_sources:
+                sources.append(line)
+
+            if line == "Sources:":
+                entered_sources = True
+
+        return sources
+
+    def run(self, cmd):
+        """Run an aptly command, raise CalledProcessError if it fails.
+
+        :param cmd: The command as list, one item per argument
+        :type  cmd: list
+        """
+        util.run_command(cmd, check=True)
+
+    def read_list(self, type_):
+        """Read lists from aptly.
+
+        :param type_: The type of list to read ie. snapshot
+        :type  type_: str
+        :rtype:       set
+        """
+        cmd = ["aptly", type_, "list", "-raw"]
+        clean_lines = set()
+        result = util.run_command(cmd, stdout=util.PIPE, check=True)
+        for line in result.stdout.split("\n"):
+            clean_line = line.strip()
+            if clean_line:
+                clean_lines.add(clean_line)
+        return clean_lines
+
+    def snapshot_sources(self, snapshot):
+        """Return the names of the snapshots a snapshot was created from.
+
+        :param snapshot: Name of the snapshot
+        :type  snapshot: str
+        :rtype:          set
+        """
+        cmd = ["aptly", "snapshot", "show", snapshot]
+        result = util.run_command(cmd, stdout=util.PIPE, check=True)
+        sources = self._extract_sources(result.stdout)
+        matches = [self.re_snapshot_source.match(source) for source in sources]
+        return set([match.group(1) for match in matches if match])
+
+    def packages(self, type_, name):
+        """Return the packages of a mirror, repo or snapshot.
+
+        :param type_: mirror, repo or snapshot
+        :type  type_: str
+        :param  name: Name of the mirror, repo or snapshot
+        :type   name: str
+        :rtype:       frozenset
+        """
+        cmd = ["aptly", type_, "show", "-with-packages", name]
+        result = util.run_command(cmd, stdout=util.PIPE, check=True)
+        packages = set()
+        entered_packages = False
+        for line in result.stdout.split("\n"):
+            # package lines start with two spaces
+            if entered_packages and line[0:2] != "  ":
+                break
+            if entered_packages:
+                packages.add(line.strip())
+            if line == "Packages:":
+                entered_packages = True
+        return frozenset(packages)
+
+    def db_cleanup(self):
+        """Remove the unreferenced packages and files with `aptly db cleanup`.
+
+        Return the bytes freed as reported by aptly, None if aptly does not
+        report them.
+
+        :rtype: int
+        """
+        cmd = ["aptly", "db", "cleanup"]
+        result = util.run_command(cmd, stdout=util.PIPE, check=True)
+        match = self.re_space_freed.search(result.stdout)
+        if match is None:
+            return None
+        size, unit = match.groups()
+        return int(float(size) * self.byte_units.get(unit, 1))
+
+    def snapshot_sources_map(self, snapshots):
+        """Return the sources of many snapshots, snapshot -> snapshots.
+
+        All snapshots are shown with `snapshot show -json` in one `aptly task
+        run`, so the database is opened only once. aptly resolves the sources by
+        their id, so renamed sources are reported with their current name.
+        Snapshots that could not be read that way, for example because the aptly
+        version does not know `-json`, are read one by one with the text parser.
+
+        :param snapshots: Names of the snapshots
+        :type  snapshots: iterable
+        :rtype:           dict
+        """
+        snapshots = sorted(snapshots)
+        snapshot_map = {}
+        if len(snapshots) > 1:
+            with NamedTemporaryFile(
+                "w", prefix="pyaptly-task-", suffix=".txt", encoding="UTF-8"
+            ) as task_file:
+                for snapshot in snapshots:
+                    task_file.write(
+                        shlex.join(["snapshot", "show", "-json", snapshot]) + "\n"
+                    )
+                task_file.flush()
+                result = util.run_command(
+                    ["aptly", "task", "run", "-filename=%s" % task_file.name],
+                    stdout=util.PIPE,
+                    hide_error=True,
+                )
+            wanted = set(snapshots)
+            for info in self._extract_json_objects(result.stdout):
+                name = info.get("Name")
+                if name in wanted:
+                    snapshot_map[name] = set(
+                        source["Name"] for source in info.get("Snapshots") or []
+                    )
+        missing = [name for name in snapshots if name not in snapshot_map]
+        if snapshot_map and missing:
+            lg.debug("Reading snapshots without -json: %s", missing)
+        for snapshot in missing:
+            snapshot_map[snapshot] = self.snapshot_sources(snapshot)
+        return snapshot_map
+
+    @staticmethod
+    def _extract_json_objects(data):
+        """Extract the JSON objects aptly prints with `-json` from data.
+
+        aptly indents its JSON output, objects start with a line "{" and end
+        with a line "}". Objects that can not be decoded are skipped.
+        """
+        objects = []
+        lines: list[str] | None = None
+        for line in data.split("\n"):
+            if line == "{":
+                lines = []
+            if lines is None:
+                continue
+            lines.append(line)
+            if line == "}":
+                try:
+                    objects.append(json.loads("\n".join(lines)))
+                except ValueError:
+                    pass
+                lines = None
+        return objects
+
+    def publish_record(self, publish):
+        """Read a publish with `aptly publish show`.
+
+        :param publish: Name of the publish, "prefix distribution"
+        :type  publish: str
+        :rtype:         PublishRecord
+        """
+        prefix, dist = publish.split(" ")
+        cmd = ["aptly", "publish", "show", dist, prefix]
+        result = util.run_command(cmd, stdout=util.PIPE, check=True)
+        sources = self._extract_sources(result.stdout)
+        matches = [
+            match
+            for match in (self.re_publish_source.match(source) for source in sources)
+            if match
+        ]
+        source_kind = "snapshot"
+        if any(match.group(3) != "snapshot" for match in matches):
+            source_kind = "local"
+        storage = ""
+        if ":" in prefix:
+            storage, prefix = prefix.rsplit(":", 1)
+        return PublishRecord(
+            prefix,
+            dist,
+            storage,
+            source_kind,
+            [(match.group(1), match.group(2)) for match in matches],
+        )
+
+    def publish_records(self):
+        """Read all publishes with one `aptly publish list -json`.
+
+        If the aptly version does not know `-json`, every publish is read with
+        :py:meth:`publish_record`.
+
+        :rtype: dict of name -> PublishRecord
+        """
+        cmd = ["aptly", "publish", "list", "-json"]
+        result = util.run_command(cmd, stdout=util.PIPE, hide_error=True)
+        if result.returncode == 0:
+            try:
+                items = json.loads(result.stdout)
+            except ValueError:
+                lg.debug("aptly publish list -json returned no JSON")
+            else:
+                records = [PublishRecord.from_json(item) for item in items or []]
+                return dict((record.name, record) for record in records)
+        return dict(
+            (publish, self.publish_record(publish))
+            for publish in self.read_list("publish")
+        )
+
+
+class ApiError(Exception):
+    """The aptly API returned an error."""
+
+    def __init__(self, status, method, path, body):
+        super().__init__("%s %s -> %s: %s" % (method, path, status, body))
+        self.status = status
+        self.body = body
+
+
+class ApiBackend(CliBackend):
+    """Talk to `aptly api serve` over HTTP with pooled keep-alive connections.
+
+    Reads use the JSON API. The commands pyaptly generates are translated to API
+    calls, commands without a translation fall back to the command line. In that
+    case the API server has to run with `-no-lock`.
+
+    The API does not report the sources of a snapshot, they are read with
+    `aptly snapshot show -json` like the :py:class:`CliBackend` does, so
+    renamed sources are reported with their current name.
+
+    :param     url: URL of the API server, e.g. http://localhost:8080
+    :type      url: str
+    :param    size: Maximum number of idle connections kept open
+    :type     size: int
+    :param timeout: Timeout for connecting and reading in seconds
+    :type  timeout: float
+    """
+
+    def __init__(self, url, size=8, timeout=None):
+        parsed = urllib.parse.urlsplit(url)
+        if parsed.scheme not in ("http", "https"):  # pragma: no cover
+            raise ValueError("Unsupported aptly API URL: %s" % url)
+        self.scheme = parsed.scheme
+        self.netloc = parsed.netloc
+        self.base_path = parsed.path.rstrip("/")
+        self.timeout = timeout
+        self._pool: queue.LifoQueue = queue.LifoQueue(maxsize=size)
+
+    def _connect(self):
+        # Only imported when the API is used, it pulls in ssl and email
+        import http.client
+
+        if self.scheme == "https":  # pragma: no cover
+            return http.client.HTTPSConnection(self.netloc, timeout=self.timeout)
+        return http.client.HTTPConnection(self.netloc, timeout=self.timeout)
+
+    def request(self, method, path, data=None):
+        """Send a request and return the decoded JSON response.
+
+        Connections are reused. If a reused connection was closed by the server,
+        the request is repeated once on a new connection.
+
+        :param method: HTTP method
+        :type  method: str
+        :param   path: Path below /api, e.g. /snapshots
+        :type    path: str
+        :param   data: Optional data sent as JSON
+        :type    data: dict
+        """
+        import http.client
+
+        body = None
+        headers = {"Accept": "application/json"}
+        if data is not None:
+            body = json.dumps(data).encode("UTF-8")
+            headers["Content-Type"] = "application/json"
+        url = "%s/api%s" % (self.base_path, path)
+        try:
+            connection = self._pool.get_nowait()
+            reused = True
+        except queue.Empty:
+            connection = self._connect()
+            reused = False
+        while True:
+            try:
+                connection.request(method, url, body=body, headers=headers)
+                response = connection.getresponse()
+                content = response.read()
+                break
+            except (http.client.HTTPException, ConnectionError):
+                connection.close()
+                if not reused:
+                    raise
+                connection = self._connect()
+                reused = False
+        if response.will_close:
+            connection.close()
+        else:
+            try:
+                self._pool.put_nowait(connection)
+            except queue.Full:  # pragma: no cover
+                connection.close()
+        if response.status >= 400:
+            raise ApiError(response.status, method, url, content.decode("UTF-8"))
+        if not content:
+            return None
+        return json.loads(content)
+
+    @staticmethod
+    def quote(name):
+        """Quote a name for use in a path."""
+        return urllib.parse.quote(name, safe="")
+
+    @classmethod
+    def publish_path(cls, prefix, distribution):
+        """Return the API path of a publish.
+
+        :param       prefix: Prefix of the publish, may contain a storage
+        :type        prefix: str
+        :param distribution: Distribution of the publish
+        :type  distribution: str
+        """
+        storage = ""
+        if ":" in prefix:
+            storage, prefix = prefix.rsplit(":", 1)
+        prefix = prefix.replace("_", "__").replace("/", "_")
+        if storage:
+            prefix = "%s:%s" % (storage, prefix)
+        return "/publish/%s/%s" % (cls.quote(prefix), cls.quote(distribution))
+
+    def read_list(self, type_):
+        """Read lists from aptly.
+
+        :param type_: The type of list to read ie. snapshot
+        :type  type_: str
+        :rtype:       set
+        """
+        if type_ == "publish":
+            return set(
+                publish_name(item["Prefix"], item["Distribution"], item.get("Storage"))
+                for item in self.request("GET", "/publish")
+            )
+        paths = {"mirror": "/mirrors", "repo": "/repos", "snapshot": "/snapshots"}
+        return set(item["Name"] for item in self.request("GET", paths[type_]))
+
+    def packages(self, type_, name):
+        """Return the packages of a mirror, repo or snapshot.
+
+        :param type_: mirror, repo or snapshot
+        :type  type_: str
+        :param  name: Name of the mirror, repo or snapshot
+        :type   name: str
+        :rtype:       frozenset
+        """
+        paths = {"mirror": "/mirrors", "repo": "/repos", "snapshot": "/snapshots"}
+        path = "%s/%s/packages" % (paths[type_], self.quote(name))
+        return frozenset(self.request("GET", path) or [])
+
+    def db_cleanup(self):
+        """Remove the unreferenced packages and files, the API does not report
+        the bytes freed.
+
+        :rtype: None
+        """
+        self.run(["aptly", "db", "cleanup"])
+        return None
+
+    def publish_record(self, publish):
+        """Read a publish.
+
+        :param publish: Name of the publish, "prefix distribution"
+        :type  publish: str
+        :rtype:         PublishRecord
+        """
+        return self.publish_records()[publish]
+
+    def publish_records(self):
+        """Read all publishes.
+
+        :rtype: dict of name -> PublishRecord
+        """
+        records = [
+            PublishRecord.from_json(item) for item in self.request("GET", "/publish")
+        ]
+        return dict((record.name, record) for record in records)
+
+    def run(self, cmd):
+        """Run an aptly command using the API if possible.
+
+        :param cmd: The command as list, one item per argument
+        :type  cmd: list
+        """
+        request = self.translate(cmd)
+        if request is None:
+            lg.debug("No API call for %s, running it", " ".join(cmd))
+            super().run(cmd)
+            return
+        method, path, data = request
+        lg.debug("Running command %s as API call %s %s", " ".join(cmd), method, path)
+        try:
+            self.request(method, path, data)
+        except ApiError as e:
+            lg.error("Command failed: %s\n  %s", " ".join(cmd), e)
+            raise util.CalledProcessError(e.status, cmd, output=e.body)
+
+    def translate(self, cmd):
+        """Translate an aptly command to an API call.
+
+        Return (method, path, data) or None if there is no translation.
+
+        :param cmd: The command as list, one item per argument
+        :type  cmd: list
+        """
+        options = {}
+        args = []
+        for argument in cmd[1:]:
+            if argument.startswith("-"):
+                key, _, value = argument.lstrip("-").partition("=")
+                options[key] = value
+            else:
+                args.append(argument)
+        quote = self.quote
+        data: dict
+        match args:
+            case ["snapshot", "create", name, "from", "mirror", mirror]:
+                return "POST", "/mirrors/%s/snapshots" % quote(mirror), {"Name": name}
+            case ["snapshot", "create", name, "from", "repo", repo]:
+                return "POST", "/repos/%s/snapshots" % quote(repo), {"Name": name}
+            case ["snapshot", "merge", destination, *sources] if sources:
+                return (
+                    "POST",
+                    "/snapshots/%s/merge" % quote(destination),
+                    {"Sources": sources},
+                )
+            case ["snapshot", "rename", name, new_name]:
+                return "PUT", "/snapshots/%s" % quote(name), {"Name": new_name}
+            case ["snapshot", "drop", name]:
+                return "DELETE", "/snapshots/%s" % quote(name), None
+            case ["mirror", "update", name]:
+                data = {}
+                if "max-tries" in options:
+                    data["MaxTries"] = int(options["max-tries"])
+                return "PUT", "/mirrors/%s" % quote(name), data
+            case ["publish", "update", distribution, prefix]:
+                data = {}
+                if options.get("skip-contents") == "true":
+                    data["SkipContents"] = True
+                if options.get("skip-cleanup") == "true":
+                    data["SkipCleanup"] = True
+                return "PUT", self.publish_path(prefix, distribution), data
+            case ["publish", "switch", distribution, prefix, *snapshots]:
+                components = options.get("component", "main").split(",")
+                data = {
+                    "Snapshots": [
+                        {"Component": component, "Name": name}
+                        for component, name in zip(components, snapshots)
+                    ]
+                }
+                if options.get("skip-contents") == "true":
+                    data["SkipContents"] = True
+                if options.get("skip-cleanup") == "true":
+                    data["SkipCleanup"] = True
+                return "PUT", self.publish_path(prefix, distribution), data
+            case ["db", "cleanup"]:
+                return "POST", "/db/cleanup", None
+        return None
+
+
+_backend: CliBackend | None = None
+
+
+def backend():
+    """Return the backend used to talk to aptly."""
+    global _backend
+    if not _backend:
+        _backend = CliBackend()
+    return _backend
+
+
+def configure(cfg):
+    """Select the backend configured in the `execution` section.
+
+    :param cfg: The configuration toml as dict
+    :type  cfg: dict
+    """
+    global _backend
+    url = cfg.get("execution", {}).get("api")
+    if url:
+        _backend = ApiBackend(url)
+    else:
+        _backend = CliBackend()
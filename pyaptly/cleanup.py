@@ -0,0 +1,123 @@
+"""Clean up the package pool once at the end of a run."""
+
+import json
+import logging
+import os
+import time
+
+from . import backend, command
+
+lg = logging.getLogger(__name__)
+
+REMOVING_COMMANDS = {
+    ("mirror", "drop"),
+    ("mirror", "update"),
+    ("publish", "drop"),
+    ("publish", "switch"),
+    ("publish", "update"),
+    ("repo", "drop"),
+    ("repo", "remove"),
+    ("snapshot", "drop"),
+}
+"""aptly commands that may leave packages unreferenced."""
+
+
+def removes_references(cmd):
+    """Return True if the command may leave packages unreferenced.
+
+    :param cmd: The command
+    :type  cmd: Command
+    :rtype:     bool
+    """
+    return tuple(cmd.cmd[1:3]) in REMOVING_COMMANDS
+
+
+class CleanupSchedule(object):
+    """When the pool was cleaned up last and if a cleanup is pending.
+
+    A cleanup is pending if references were removed, but the cleanup was
+    skipped because the last one was too recent.
+
+    :param path: Path of the file the schedule is kept in
+    :type  path: str
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.last = 0.0
+        self.pending = False
+        try:
+            with open(path, encoding="UTF-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            lg.debug("No usable cleanup schedule in %s", path)
+            return
+        self.last = data.get("last", 0.0)
+        self.pending = data.get("pending", False)
+
+    def due(self, interval):
+        """Return True if the last cleanup is at least interval hours ago.
+
+        :param interval: Minimal hours between two cleanups
+        :type  interval: float
+        :rtype:          bool
+        """
+        return time.time() - self.last >= interval * 3600
+
+    def save(self):
+        """Save the schedule."""
+        data = {"last": self.last, "pending": self.pending}
+        tmp_path = "%s.tmp" % self.path
+        with open(tmp_path, "w", encoding="UTF-8") as f:
+            json.dump(data, f)
+        os.replace(tmp_path, self.path)
+
+
+def cleanup(cfg, ordered):
+    """Run `aptly db cleanup` if the run removed references.
+
+    Configured with `db-cleanup` in the `execution` section: the pool is
+    cleaned up at most every `interval` hours, the time of the last cleanup is
+    kept in the file `schedule`, without it the interval is ignored. A cleanup
+    that is skipped because of the interval is done by the next run that is
+    due.
+
+    :param     cfg: The configuration toml as dict
+    :type      cfg: dict
+    :param ordered: The commands of the run
+    :type  ordered: list
+    """
+    settings = cfg.get("execution", {}).get("db-cleanup")
+    if not settings:
+        return
+    if "interval" in settings and not settings.get("schedule"):
+        lg.warning("db-cleanup.interval is ignored, it needs db-cleanup.schedule")
+    removed = any(removes_references(cmd) for cmd in ordered)
+    if command.Command.pretend_mode:
+        if removed:
+            lg.info("Pretending to run command: aptly db cleanup")
+        return
+    schedule = None
+    if settings.get("schedule"):
+        schedule = CleanupSchedule(settings["schedule"])
+        removed = removed or schedule.pending
+    if not removed:
+        lg.debug("No references removed, skipping aptly db cleanup")
+        return
+    if schedule is not None and not schedule.due(settings.get("interval", 0)):
+        lg.info("The last aptly db cleanup is too recent, deferring it")
+        schedule.pending = True
+        schedule.save()
+        return
+
+    start = time.monotonic()
+    freed = backend.backend().db_cleanup()
+    elapsed = time.monotonic() - start
+    if freed is None:
+        lg.info("Cleaned up the package pool in %.1fs", elapsed)
+    else:
+        lg.info("Cleaned up the package pool in %.1fs, %d bytes freed", elapsed, freed)
+    if schedule is not None:
+        schedule.last = time.time()
+        schedule.pending = False
+        schedule.save()
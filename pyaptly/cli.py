@@ -58,6 +58,46 @@ class FakeArgs:
 # do this in a few other CLIs for startup performance.
 
 
+_execution_options = [
+    click.option(
+        "--jobs",
+        "-j",
+        default=None,
+        type=click.IntRange(min=1),
+        help="Run up to JOBS independent commands at once (default: config or 1)",
+    ),
+    click.option(
+        "--batch/--no-batch",
+        "-b/-nb",
+        default=None,
+        type=bool,
+        help="Run ready aptly commands together using 'aptly task run' "
+        "(default: config)",
+    ),
+    click.option(
+        "--resume/--no-resume",
+        "-r/-nr",
+        default=False,
+        type=bool,
+        help="Continue the interrupted run recorded in execution.journal",
+    ),
+    click.option(
+        "--config-cache",
+        default=None,
+        type=click.Path(file_okay=True, dir_okay=False),
+        help="Cache the parsed and validated config in this file",
+    ),
+]
+
+
+def execution_options(func):
+    """Add the options controlling how the commands are executed."""
+    # Applied bottom-up like stacked decorators, to keep the order in --help
+    for option in reversed(_execution_options):
+        func = option(func)
+    return func
+
+
 @click.group()
 @click.version_option()
 def pyaptly():
@@ -86,6 +126,7 @@ def legacy(passthrough):
     type=bool,
     help="Do not change anything",
 )
+@execution_options
 @click.argument("config", type=click.Path(file_okay=True, dir_okay=False, exists=True))
 @click.argument("task", type=click.Choice(["create"]))
 @click.option("--repo-name", "-n", default="all", type=str, help='default: "all"')
@@ -96,7 +137,7 @@ def repo(**kwargs):
     fake_args = FakeArgs(**kwargs)
     main.setup_logger(fake_args)
     cfg = main.prepare(fake_args)
-    repo.repo(cfg, args=fake_args)
+    main.run(repo.repo, cfg, fake_args)
 
 
 @pyaptly.command()
@@ -109,6 +150,7 @@ def repo(**kwargs):
     type=bool,
     help="Do not change anything",
 )
+@execution_options
 @click.argument("config", type=click.Path(file_okay=True, dir_okay=False, exists=True))
 @click.argument("task", type=click.Choice(["create", "update"]))
 @click.option("--mirror-name", "-n", default="all", type=str, help='default: "all"')
@@ -119,7 +161,7 @@ def mirror(**kwargs):
     fake_args = FakeArgs(**kwargs)
     main.setup_logger(fake_args)
     cfg = main.prepare(fake_args)
-    mirror.mirror(cfg, args=fake_args)
+    main.run(mirror.mirror, cfg, fake_args)
 
 
 @pyaptly.command()
@@ -132,6 +174,7 @@ def mirror(**kwargs):
     type=bool,
     help="Do not change anything",
 )
+@execution_options
 @click.argument("config", type=click.Path(file_okay=True, dir_okay=False, exists=True))
 @click.argument("task", type=click.Choice(["create", "update"]))
 @click.option("--snapshot-name", "-n", default="all", type=str, help='default: "all"')
@@ -142,7 +185,7 @@ def snapshot(**kwargs):
     fake_args = FakeArgs(**kwargs)
     main.setup_logger(fake_args)
     cfg = main.prepare(fake_args)
-    snapshot.snapshot(cfg, args=fake_args)
+    main.run(snapshot.snapshot, cfg, fake_args)
 
 
 @pyaptly.command()
@@ -155,6 +198,7 @@ def snapshot(**kwargs):
     type=bool,
     help="Do not change anything",
 )
+@execution_options
 @click.argument("config", type=click.Path(file_okay=True, dir_okay=False, exists=True))
 @click.argument("task", type=click.Choice(["create", "update"]))
 @click.option("--publish-name", "-n", default="all", type=str, help='default: "all"')
@@ -165,7 +209,29 @@ def publish(**kwargs):
     fake_args = FakeArgs(**kwargs)
     main.setup_logger(fake_args)
     cfg = main.prepare(fake_args)
-    publish.publish(cfg, args=fake_args)
+    main.run(publish.publish, cfg, fake_args)
+
+
+@pyaptly.command()
+@click.option("--info/--no-info", "-i/-ni", default=False, type=bool)
+@click.option("--debug/--no-debug", "-d/-nd", default=False, type=bool)
+@click.option(
+    "--pretend/--no-pretend",
+    "-p/-np",
+    default=False,
+    type=bool,
+    help="Do not change anything",
+)
+@execution_options
+@click.argument("config", type=click.Path(file_okay=True, dir_okay=False, exists=True))
+def apply(**kwargs):
+    """Create and update repos, mirrors, snapshots and publishes in one run."""
+    from . import apply, main
+
+    fake_args = FakeArgs(**kwargs)
+    main.setup_logger(fake_args)
+    cfg = main.prepare(fake_args)
+    main.run(apply.apply, cfg, fake_args)
 
 
 @pyaptly.command()
@@ -1,16 +1,30 @@
 """Commands with dependencies."""
 
 import collections
+import hashlib
+import json
 import logging
+import re
+import shlex
+from tempfile import NamedTemporaryFile
 
-from . import state_reader, util
+from . import backend, state_reader, util
 
 lg = logging.getLogger(__name__)
 
+# match example: 2) [Running]: snapshot create snap from mirror mirror
+re_task_step = re.compile(r"^(\d+)\) \[(Running|Skipping)\]", re.MULTILINE)
+
+RESOURCE_CLASSES = ("mirror", "snapshot", "repo", "publish", "virtual")
+"""Resource classes used to limit concurrency, see :py:meth:`Command.resource_class`."""
+
 
 class Command(object):
     """Repesents a system command and is used to resolve dependencies.
 
+    The `host` of a command is the upstream host it downloads from, if any. The
+    executor limits how many commands of a host run at once.
+
     :param cmd: The command as list, one item per argument
     :type  cmd: list
     """
@@ -23,6 +37,7 @@ class Command(object):
         self._requires: set[tuple[str, str]] = set()
         self._provides: set[tuple[str, str]] = set()
         self._finished: bool = False
+        self.host: str | None = None
         self._known_dependency_types = (
             "mirror",
             "snapshot",
@@ -39,6 +54,23 @@ class Command(object):
         """
         return self._provides
 
+    def resource_class(self):
+        """Return the resource class of this command.
+
+        The resource class is used to limit how many commands of the same kind
+        run at once. It is the first type in :py:data:`RESOURCE_CLASSES` this
+        command provides, or if it provides none, requires. Commands that only
+        provide or require virtual dependencies are of class "virtual".
+
+        :rtype: str
+        """
+        for dependencies in (self._provides, self._requires):
+            types = set(type_ for type_, _ in dependencies)
+            for resource_class in RESOURCE_CLASSES:
+                if resource_class != "virtual" and resource_class in types:
+                    return resource_class
+        return "virtual"
+
     def append(self, argument):
         """Append additional arguments to the command.
 
@@ -82,22 +114,19 @@ class Command(object):
         assert type_ in self._known_dependency_types
         self._provides.add((type_, str(identifier)))
 
-    def clear_caches(self):
-        """Clear state_reader caches of functions which have changed"""
+    def update_state(self):
+        """Apply the effect of the command to the state_reader caches.
+
+        If the effect is not known, the caches of the types the command
+        provides are cleared.
+        """
+        if state_reader.state_reader().apply_command(self.cmd):
+            return
         provides = set(p[0] for p in self.get_provides())
         for provide in provides:
-            lg.debug("clearing cache for " + provide)
-            match provide:
-                case "mirror":
-                    state_reader.state_reader().mirrors.cache_clear()
-                case "snapshot":
-                    state_reader.state_reader().snapshots.cache_clear()
-                    state_reader.state_reader().snapshot_map.cache_clear()
-                case "repo":
-                    state_reader.state_reader().repos.cache_clear()
-                case "publish":
-                    state_reader.state_reader().publishes.cache_clear()
-                    state_reader.state_reader().publish_map.cache_clear()
+            if provide in ("mirror", "snapshot", "repo", "publish"):
+                lg.debug("clearing cache for " + provide)
+                state_reader.state_reader().invalidate(provide)
 
     def execute(self):
         """Execute the command. Return the return value of the command.
@@ -117,14 +146,80 @@ class Command(object):
             # which prevents that. I guess the feature is currently not needed.
             # So I decided to change that. For now we fail hard if a `Command` fails.
             # I guess we will see in production what happens.
-            util.run_command(self.cmd, check=True)
-            self.clear_caches()
+            backend.backend().run(self.cmd)
+            self.update_state()
         else:
             lg.info("Pretending to run command: %s", " ".join(self.cmd))
         self._finished = True
 
         return self._finished
 
+    def batchable(self):
+        """Return True if the command can run in an `aptly task run` batch.
+
+        aptly splits the commands of a task file on arguments ending with a
+        comma, these commands have to run on their own.
+
+        :rtype: bool
+        """
+        return (
+            len(self.cmd) > 1
+            and self.cmd[0] == "aptly"
+            and self.cmd[1] != "task"
+            and not any(argument.endswith(",") for argument in self.cmd)
+        )
+
+    @staticmethod
+    def execute_batch(commands):
+        """Execute batchable commands in one `aptly task run` process.
+
+        aptly opens the database and reads its config only once for the whole
+        batch. With the API backend the commands are executed one by one, the
+        API server has the database open anyway. It stops at the first failing
+        command and skips the remaining ones. The commands that succeeded are
+        marked as finished, for the failing command CalledProcessError is raised.
+
+        :param commands: The commands to execute, they must not depend on each
+                         other
+        :type  commands: list
+        """
+        if (
+            len(commands) == 1
+            or Command.pretend_mode
+            or isinstance(backend.backend(), backend.ApiBackend)
+        ):
+            for cmd in commands:
+                cmd.execute()
+            return
+
+        with NamedTemporaryFile(
+            "w", prefix="pyaptly-task-", suffix=".txt", encoding="UTF-8"
+        ) as task_file:
+            for cmd in commands:
+                lg.debug("Batching command: %s", " ".join(cmd.cmd))
+                task_file.write(shlex.join(cmd.cmd[1:]) + "\n")
+            task_file.flush()
+            result = util.run_command(
+                ["aptly", "task", "run", "-filename=%s" % task_file.name],
+                stdout=util.PIPE,
+            )
+
+        steps = re_task_step.findall(result.stdout)
+        succeeded = len([step for _, step in steps if step == "Running"])
+        if result.returncode:
+            # The last command that ran has failed
+            succeeded = max(0, succeeded - 1)
+        for cmd in commands[:succeeded]:
+            cmd._finished = True
+            cmd.update_state()
+        if result.returncode:
+            raise util.CalledProcessError(
+                result.returncode,
+                commands[succeeded].cmd,
+                output=result.stdout,
+                stderr=result.stderr,
+            )
+
     def repr_cmd(self):
         """Return repr of the command.
 
@@ -132,6 +227,47 @@ class Command(object):
         """
         return repr(self.cmd)
 
+    def to_json(self):
+        """Return the command as json object, see :py:meth:`from_json`.
+
+        :rtype: dict
+        """
+        data = {
+            "cmd": list(self.cmd),
+            "requires": sorted(self._requires),
+            "provides": sorted(self._provides),
+        }
+        if self.host is not None:
+            data["host"] = self.host
+        return data
+
+    @staticmethod
+    def from_json(data):
+        """Create a command (or dummy command) from :py:meth:`to_json`.
+
+        :param data: The command as returned by :py:meth:`to_json`
+        :type  data: dict
+        :rtype:      Command
+        """
+        if "identifier" in data:
+            cmd: Command = DummyCommand(data["identifier"])
+        else:
+            cmd = Command(list(data["cmd"]))
+            cmd.host = data.get("host")
+        for type_, identifier in data["requires"]:
+            cmd.require(type_, identifier)
+        for type_, identifier in data["provides"]:
+            cmd.provide(type_, identifier)
+        return cmd
+
+    def digest(self):
+        """Return the identity of the command, it is stable between runs.
+
+        :rtype: str
+        """
+        data = json.dumps(self.to_json(), sort_keys=True)
+        return hashlib.sha256(data.encode("UTF-8")).hexdigest()
+
     def _freeze_common(self):
         if not self.frozen:
             self.frozen = True
@@ -241,71 +377,96 @@ class Command(object):
 
         According to the dependencies they provide/require.
 
+        This is a topological sort (Kahn's algorithm): every command counts
+        the requirements it is still waiting for and is scheduled as soon as
+        all commands providing them are scheduled. Requirements without a
+        pending provider inside the graph are checked against the system state
+        using `has_dependency_cb`, once per requirement. A requirement the
+        callback cannot check (it raises ValueError) is not fulfilled.
+
         :param          commands: The commands to order
         :type           commands: list
         :param has_dependency_cb: Optional callback the resolve external
                                   dependencies
         :type  has_dependency_cb: function
         """
-        commands = set([c for c in commands if c is not None])
+        # dict.fromkeys() removes duplicates but keeps the order stable
+        commands = list(dict.fromkeys([c for c in commands if c is not None]))
 
         lg.debug("Ordering commands: %s", [str(cmd) for cmd in commands])
 
-        have_requirements: dict["Command", int] = collections.defaultdict(lambda: 0)
-        required_number: dict["Command", int] = collections.defaultdict(lambda: 0)
-        scheduled = []
+        # How many commands still have to run, until a requirement is fulfilled
+        remaining_providers: dict[tuple[str, str], int] = collections.defaultdict(
+            lambda: 0
+        )
+        # Which commands are waiting for a requirement
+        waiting: dict[tuple[str, str], list["Command"]] = collections.defaultdict(list)
+        # How many requirements of a command are not fulfilled yet
+        in_degree: dict["Command", int] = {}
+        fulfilled: set[tuple[str, str]] = set()
+        checked: set[tuple[str, str]] = set()
 
         for cmd in commands:
             for provide in cmd._provides:
-                required_number[provide] += 1
+                remaining_providers[provide] += 1
 
-        something_changed = True
-        while something_changed:
-            something_changed = False
+        ready: collections.deque["Command"] = collections.deque()
+        for cmd in commands:
+            in_degree[cmd] = len(cmd._requires)
+            for req in cmd._requires:
+                waiting[req].append(cmd)
+            if not cmd._requires:
+                ready.append(cmd)
+
+        def fulfill(req):
+            fulfilled.add(req)
+            for waiting_cmd in waiting.pop(req, []):
+                in_degree[waiting_cmd] -= 1
+                if in_degree[waiting_cmd] == 0:
+                    ready.append(waiting_cmd)
 
-            for cmd in commands:
-                if cmd in scheduled:
+        scheduled = []
+        while True:
+            while ready:
+                cmd = ready.popleft()
+                lg.debug("%s: all dependencies fulfilled" % cmd)
+                scheduled.append(cmd)
+                for provide in cmd._provides:
+                    remaining_providers[provide] -= 1
+                    if remaining_providers[provide] == 0 and provide not in fulfilled:
+                        fulfill(provide)
+
+            if len(scheduled) == len(commands):
+                break
+
+            # No command providing our dependencies can run (or there is none).
+            # Let's see if the dependencies without a pending provider are
+            # already otherwise fulfilled.
+            progress = False
+            for req in list(waiting.keys()):
+                if req in checked or remaining_providers[req] > 0:
                     continue
-
-                can_schedule = True
-                for req in cmd._requires:
-                    if have_requirements[req] < required_number[req]:
-                        lg.debug(
-                            "%s: dependency %s not fulfilled, "
-                            "checking aptly state" % (cmd, req)
-                        )
-                        # No command providing our dependency.. Let's see if
-                        # it's already otherwise fulfilled
-                        if not has_dependency_cb(req):
-                            lg.debug(
-                                "%s: dependency %s not "
-                                "in aptly state either" % (cmd, req)
-                            )
-                            can_schedule = False
-                            # Break out of the requirements loop, as the
-                            # command cannot be scheduled anyway.
-                            break
-
-                if can_schedule:
-                    lg.debug("%s: all dependencies fulfilled" % cmd)
-                    scheduled.append(cmd)
-                    for provide in cmd._provides:
-                        have_requirements[provide] += 1
-
-                    something_changed = True
-
-        unresolved = [cmd for cmd in commands if cmd not in scheduled]
-
-        if len(unresolved) > 0:  # pragma: no cover
+                checked.add(req)
+                lg.debug("dependency %s not fulfilled, checking aptly state" % (req,))
+                try:
+                    found = has_dependency_cb(req)
+                except ValueError as e:
+                    lg.debug("dependency %s cannot be checked: %s" % (req, e))
+                    found = False
+                if found:
+                    fulfill(req)
+                    progress = True
+                else:
+                    lg.debug("dependency %s not in aptly state either" % (req,))
+            if not progress:
+                break
+
+        if len(scheduled) < len(commands):  # pragma: no cover
+            unresolved = [cmd for cmd in commands if in_degree[cmd] > 0]
             raise ValueError(
                 "Commands with unresolved deps: %s" % [str(cmd) for cmd in unresolved]
             )
 
-        # Just one last verification before we commence
-        scheduled_set = set([cmd for cmd in scheduled])
-        incoming_set = set([cmd for cmd in commands])
-        assert incoming_set == scheduled_set
-
         lg.debug("Reordered commands: %s", [str(cmd) for cmd in scheduled])
 
         return scheduled
@@ -357,6 +518,17 @@ class DummyCommand(Command):
         """
         return self.identifier
 
+    def to_json(self):
+        """Return the dummy command as json object.
+
+        :rtype: dict
+        """
+        return {
+            "identifier": self.identifier,
+            "requires": sorted(self._requires),
+            "provides": sorted(self._provides),
+        }
+
     def __repr__(self):
         """Show repr for DummyCommand."""
         return "DummyCommand<%s requires %s, provides %s>\n" % (
@@ -66,12 +66,8 @@ def environment(debug_mode):
     util._PYTEST_KEYSERVER = "hkp://127.0.0.1:8080"
 
     # Make sure we start with a clean slate
-    state_reader.state_reader().mirrors.cache_clear()
-    state_reader.state_reader().snapshots.cache_clear()
-    state_reader.state_reader().snapshot_map.cache_clear()
-    state_reader.state_reader().repos.cache_clear()
-    state_reader.state_reader().publishes.cache_clear()
-    state_reader.state_reader().publish_map.cache_clear()
+    for type_ in ("mirror", "snapshot", "repo", "publish"):
+        state_reader.state_reader().invalidate(type_)
 
     try:
         yield
@@ -81,6 +77,26 @@ def environment(debug_mode):
         aptly_conf.unlink()
 
 
+@pytest.fixture()
+def fake_aptly(tmp_path, monkeypatch):
+    """Put a fake aptly in PATH, yield the log of its calls.
+
+    See `tests/fake-aptly` for what it can do. Outputs of commands are written
+    to the `output` directory next to the log.
+    """
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    (bin_dir / "aptly").symlink_to(test_base / "fake-aptly")
+    log = tmp_path / "aptly.log"
+    log.touch()
+    output = tmp_path / "output"
+    output.mkdir()
+    monkeypatch.setenv("PATH", f"{bin_dir}:{os.environ['PATH']}")
+    monkeypatch.setenv("FAKE_APTLY_LOG", str(log))
+    monkeypatch.setenv("FAKE_APTLY_OUTPUT", str(output))
+    yield log
+
+
 @pytest.fixture()
 def test_key_03(environment):
     """Get test gpg-key number 3."""
@@ -1,7 +1,6 @@
+import functools
 import logging
 
-from colorama import Fore, Style
-
 from . import util
 
 
@@ -10,14 +9,6 @@ class CustomFormatter(logging.Formatter):
     info_warn = "%(message)s"
     error_plus = "%(levelname)s: %(message)s"
 
-    FORMATS_COLOR = {
-        logging.DEBUG: Style.DIM + debug + Style.RESET_ALL,
-        logging.INFO: Fore.YELLOW + info_warn + Style.RESET_ALL,
-        logging.WARNING: info_warn,
-        logging.ERROR: Fore.RED + error_plus + Style.RESET_ALL,
-        logging.CRITICAL: Fore.MAGENTA + error_plus + Style.RESET_ALL,
-    }
-
     FORMATS = {
         logging.DEBUG: debug,
         logging.INFO: info_warn,
@@ -26,9 +17,23 @@ class CustomFormatter(logging.Formatter):
         logging.CRITICAL: error_plus,
     }
 
+    @classmethod
+    @functools.lru_cache(maxsize=None)
+    def formats_color(cls):  # pragma: no cover
+        """Return the colored formats, colorama is only imported on a tty."""
+        from colorama import Fore, Style
+
+        return {
+            logging.DEBUG: Style.DIM + cls.debug + Style.RESET_ALL,
+            logging.INFO: Fore.YELLOW + cls.info_warn + Style.RESET_ALL,
+            logging.WARNING: cls.info_warn,
+            logging.ERROR: Fore.RED + cls.error_plus + Style.RESET_ALL,
+            logging.CRITICAL: Fore.MAGENTA + cls.error_plus + Style.RESET_ALL,
+        }
+
     def format(self, record):
         if util.isatty():
-            formats = self.FORMATS_COLOR  # pragma: no cover
+            formats = self.formats_color()  # pragma: no cover
         else:
             formats = self.FORMATS
 
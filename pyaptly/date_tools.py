@@ -1,6 +1,7 @@
 """Tools to convert and round dates."""
 
 import datetime
+import re
 
 
 def iso_first_week_start(iso_year, tzinfo=None):
@@ -226,6 +227,10 @@ def format_timestamp(timestamp):
     return timestamp.strftime("%Y%m%dT%H%MZ")
 
 
+re_timestamp = re.compile(r"\d{8}T\d{4}Z")
+"""Matches a timestamp formatted by :py:func:`format_timestamp`."""
+
+
 day_of_week_map = {
     "mon": 1,
     "tue": 2,
@@ -0,0 +1,394 @@
+"""Execute commands along their dependency graph."""
+
+import collections
+import concurrent.futures
+import logging
+import os
+import time
+
+from . import cleanup, command, history, journal, state_reader, util
+
+lg = logging.getLogger(__name__)
+
+BATCH_SIZE = 100
+"""Maximum number of commands in one `aptly task run` batch."""
+
+
+def execute_commands(cfg, args, commands):
+    """Order the commands and execute them.
+
+    The number of commands running at once is limited by `--jobs` (or `jobs`
+    in the `execution` section of the config). Additionally each resource class
+    (see :py:meth:`Command.resource_class`) can be limited in
+    `execution.pools`. If only pools are configured, the total is the sum of
+    all pools, every resource class without a configured pool gets one slot.
+    With `per-host` in the `execution` section, at most that many commands
+    downloading from the same upstream host (see `Command.host`, e.g. mirror
+    updates) run at once, while commands of other hosts may start.
+
+    With `--batch` (or `batch` in the `execution` section) ready aptly
+    commands of the same resource class are executed together using `aptly task
+    run`.
+
+    Ready commands are started in the order of the longest remaining path to
+    the end of the graph, estimated from the durations of earlier runs kept in
+    the file `history` of the `execution` section.
+
+    With `journal` in the `execution` section the finished commands are
+    recorded, so an interrupted run can be continued, see :py:func:`resume`.
+
+    If the run removed references to packages, `aptly db cleanup` runs once
+    after all commands, see :py:func:`cleanup.cleanup`.
+
+    :param      cfg: The configuration toml as dict
+    :type       cfg: dict
+    :param     args: The command-line arguments read with :py:mod:`argparse`
+    :type      args: namespace
+    :param commands: The commands to execute
+    :type  commands: list
+    """
+    ordered = command.Command.order_commands(
+        commands, state_reader.state_reader().has_dependency
+    )
+    run_journal = None
+    path = cfg.get("execution", {}).get("journal")
+    if path and not command.Command.pretend_mode:
+        if os.path.exists(path):
+            lg.warning(
+                "Replacing the journal of an interrupted run %s, use --resume to "
+                "continue an interrupted run",
+                path,
+            )
+        run_journal = journal.Journal(path)
+        run_journal.start(ordered)
+    execute_ordered(cfg, args, ordered, run_journal)
+
+
+def execute_ordered(cfg, args, ordered, run_journal=None, plan=None):
+    """Execute ordered commands, see :py:func:`execute_commands`.
+
+    :param         cfg: The configuration toml as dict
+    :type          cfg: dict
+    :param        args: The command-line arguments read with :py:mod:`argparse`
+    :type         args: namespace
+    :param     ordered: Commands as returned by :py:meth:`Command.order_commands`
+    :type      ordered: list
+    :param run_journal: Journal the finished commands are recorded in
+    :type  run_journal: :py:class:`journal.Journal`
+    :param        plan: All commands of the run, if only the remaining ones
+                        are executed; they decide if the pool is cleaned up
+    :type         plan: list
+    """
+    settings = cfg.get("execution", {})
+    pools = dict(settings.get("pools", {}))
+    jobs = getattr(args, "jobs", None) or settings.get("jobs")
+    if jobs is None:
+        if pools:
+            jobs = sum(pools.get(type_, 1) for type_ in command.RESOURCE_CLASSES)
+        else:
+            jobs = 1
+    batch = getattr(args, "batch", None)
+    if batch is None:
+        batch = settings.get("batch", False)
+    durations = history.DurationHistory(settings.get("history"))
+    complete = False
+    try:
+        GraphExecutor(
+            ordered,
+            jobs=jobs,
+            pools=pools,
+            per_host=settings.get("per-host"),
+            batch=batch,
+            journal=run_journal,
+            durations=durations,
+        ).run()
+        cleanup.cleanup(cfg, ordered if plan is None else plan)
+        complete = True
+    finally:
+        if run_journal is not None:
+            run_journal.close(complete)
+        if not command.Command.pretend_mode:
+            durations.save()
+
+
+def resume(cfg, args):
+    """Resume the interrupted run, if `--resume` was given.
+
+    The commands of the interrupted run are loaded from the journal (see
+    `execution.journal`), the commands that did not finish are executed. The
+    commands are not created again, so they are the same as in the interrupted
+    run, even if the aptly state changed in the meantime. The pool is cleaned
+    up if any command of the interrupted run removed references, also if it
+    finished before the interruption.
+
+    Return True if an interrupted run was resumed, False if there is none.
+
+    :param  cfg: The configuration toml as dict
+    :type   cfg: dict
+    :param args: The command-line arguments read with :py:mod:`argparse`
+    :type  args: namespace
+    :rtype:      bool
+    """
+    if not getattr(args, "resume", False):
+        return False
+    path = cfg.get("execution", {}).get("journal")
+    if not path:
+        util.exit_with_error("--resume needs a journal, see execution.journal")
+    run_journal = journal.Journal(path)
+    interrupted = run_journal.load()
+    if interrupted is None:
+        lg.info("No interrupted run to resume in %s", path)
+        return False
+    plan, finished = interrupted
+    remaining = [cmd for cmd in plan if cmd.digest() not in finished]
+    lg.warning(
+        "Resuming the interrupted run, %d of %d commands finished",
+        len(plan) - len(remaining),
+        len(plan),
+    )
+    if command.Command.pretend_mode:
+        execute_ordered(cfg, args, remaining, plan=plan)
+    else:
+        run_journal.start(remaining, resume=True)
+        execute_ordered(cfg, args, remaining, run_journal, plan)
+    return True
+
+
+class GraphExecutor(object):
+    """Runs ordered commands as soon as the commands they require have finished.
+
+    A command waits for all commands that provide one of its requirements and
+    come before it in the order. Therefore the graph is always acyclic, even if
+    a requirement was resolved using the system state while ordering.
+
+    If a command fails, no new commands are started. The running commands are
+    awaited, the remaining commands are cancelled and the error is raised.
+
+    In batch mode, ready commands are grouped into batches (see
+    :py:meth:`Command.execute_batch`), a batch occupies one slot.
+
+    Ready commands are started by priority: the estimated duration of the
+    longest path from the command to the end of the graph (critical path). So
+    slow commands and commands many others wait for start first.
+
+    Every finished command is reported with its duration and the progress of
+    the run.
+
+    :param   ordered: Commands as returned by :py:meth:`Command.order_commands`
+    :type    ordered: list
+    :param      jobs: How many commands may run at once
+    :type       jobs: int
+    :param     pools: How many commands of a resource class may run at once,
+                      resource classes not in pools are only limited by jobs
+    :type      pools: dict
+    :param  per_host: How many commands of an upstream host may run at once,
+                      None for no limit
+    :type   per_host: int
+    :param     batch: Group ready commands into `aptly task run` batches
+    :type      batch: bool
+    :param   journal: Journal the finished commands are recorded in
+    :type    journal: :py:class:`journal.Journal`
+    :param durations: Durations of earlier runs, the durations of this run are
+                      recorded in it
+    :type  durations: :py:class:`history.DurationHistory`
+    """
+
+    def __init__(
+        self,
+        ordered: list[command.Command],
+        jobs: int = 1,
+        pools: dict[str, int] | None = None,
+        per_host: int | None = None,
+        batch: bool = False,
+        journal: journal.Journal | None = None,
+        durations: history.DurationHistory | None = None,
+    ):
+        self.ordered = ordered
+        self.jobs = max(1, jobs)
+        self.pools = pools or {}
+        self.per_host = per_host
+        self.completed = 0
+        self.batch = batch
+        self.journal = journal
+        self.durations = durations or history.DurationHistory()
+        self.dependencies: dict[command.Command, set[command.Command]] = {}
+        self.dependents: dict[command.Command, list[command.Command]] = (
+            collections.defaultdict(list)
+        )
+        providers: dict[tuple[str, str], list[command.Command]] = (
+            collections.defaultdict(list)
+        )
+        for cmd in ordered:
+            dependencies = set()
+            for req in cmd._requires:
+                dependencies.update(providers.get(req, []))
+            self.dependencies[cmd] = dependencies
+            for dependency in dependencies:
+                self.dependents[dependency].append(cmd)
+            for provide in cmd._provides:
+                providers[provide].append(cmd)
+        # Dependents come after their dependencies in the order
+        self.priority: dict[command.Command, float] = {}
+        for cmd in reversed(ordered):
+            self.priority[cmd] = self.durations.estimate(cmd) + max(
+                (self.priority[dependent] for dependent in self.dependents[cmd]),
+                default=0.0,
+            )
+
+    def _host_free(self, cmd, running_per_host):
+        """Return True if the host of a command has a free slot."""
+        return (
+            self.per_host is None
+            or cmd.host is None
+            or running_per_host[cmd.host] < self.per_host
+        )
+
+    def _take_ready(self, ready, running_per_class, running_per_host):
+        """Remove and return the next unit of ready commands that has a free slot.
+
+        A unit is a single command, or in batch mode a batch of commands of the
+        same resource class. The commands of a batch run one after the other,
+        so a batch occupies one slot of each of its hosts.
+        """
+        for cmd in ready:
+            resource_class = cmd.resource_class()
+            limit = self.pools.get(resource_class)
+            if (
+                limit is None or running_per_class[resource_class] < limit
+            ) and self._host_free(cmd, running_per_host):
+                break
+        else:
+            return None
+        unit = [cmd]
+        if self.batch and cmd.batchable():
+            for other in ready:
+                if len(unit) >= BATCH_SIZE:
+                    break
+                if (
+                    other is not cmd
+                    and other.batchable()
+                    and other.resource_class() == resource_class
+                    and (
+                        other.host in self._hosts(unit)
+                        or self._host_free(other, running_per_host)
+                    )
+                ):
+                    unit.append(other)
+        for cmd in unit:
+            ready.remove(cmd)
+        return unit
+
+    @staticmethod
+    def _hosts(unit):
+        """Return the upstream hosts of a unit."""
+        return set(cmd.host for cmd in unit if cmd.host is not None)
+
+    @staticmethod
+    def _execute_unit(unit):
+        """Execute a unit of commands, return its wall time."""
+        start = time.monotonic()
+        if len(unit) == 1:
+            unit[0].execute()
+        else:
+            command.Command.execute_batch(unit)
+        return time.monotonic() - start
+
+    def _record(self, unit, seconds):
+        """Record the durations of a unit, a batch is split evenly."""
+        if command.Command.pretend_mode:
+            return
+        for cmd in unit:
+            self.durations.record(cmd, seconds / len(unit))
+
+    def _report(self, unit, seconds):
+        """Report the progress of the run, a batch is split evenly."""
+        self.completed += len(unit)
+        if command.Command.pretend_mode:
+            return
+        for cmd in unit:
+            if not isinstance(cmd, command.DummyCommand):
+                lg.info(
+                    "Finished %s in %.1fs (%d/%d)",
+                    " ".join(cmd.cmd),
+                    seconds / len(unit),
+                    self.completed,
+                    len(self.ordered),
+                )
+
+    def _prioritize(self, ready):
+        """Sort ready commands, the longest remaining path first."""
+        ready.sort(key=lambda cmd: -self.priority[cmd])
+
+    def run(self):
+        """Execute all commands."""
+        if self.jobs == 1 and not self.batch:
+            for cmd in self.ordered:
+                seconds = self._execute_unit([cmd])
+                self._record([cmd], seconds)
+                self._report([cmd], seconds)
+                if self.journal is not None:
+                    self.journal.finished(cmd)
+            return
+
+        waiting_for = {cmd: len(deps) for cmd, deps in self.dependencies.items()}
+        ready = [cmd for cmd in self.ordered if not waiting_for[cmd]]
+        self._prioritize(ready)
+        running_per_class: dict[str, int] = collections.defaultdict(lambda: 0)
+        running_per_host: dict[str, int] = collections.defaultdict(lambda: 0)
+        finished: set[command.Command] = set()
+        failed: set[command.Command] = set()
+        error = None
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.jobs) as pool:
+            running: dict[concurrent.futures.Future, list[command.Command]] = {}
+            while ready or running:
+                while ready and error is None and len(running) < self.jobs:
+                    unit = self._take_ready(ready, running_per_class, running_per_host)
+                    if unit is None:
+                        break
+                    running_per_class[unit[0].resource_class()] += 1
+                    for host in self._hosts(unit):
+                        running_per_host[host] += 1
+                    running[pool.submit(self._execute_unit, unit)] = unit
+                if not running:
+                    break
+                done, _ = concurrent.futures.wait(
+                    running, return_when=concurrent.futures.FIRST_COMPLETED
+                )
+                for future in done:
+                    unit = running.pop(future)
+                    running_per_class[unit[0].resource_class()] -= 1
+                    for host in self._hosts(unit):
+                        running_per_host[host] -= 1
+                    exception = future.exception()
+                    if exception is None:
+                        self._record(unit, future.result())
+                        self._report(unit, future.result())
+                    completed = unit
+                    if exception is not None:
+                        # In a batch the commands before the failing one finished
+                        completed = [cmd for cmd in unit if cmd._finished]
+                        for cmd in [cmd for cmd in unit if not cmd._finished][:1]:
+                            lg.error("Command failed: %s", cmd.repr_cmd())
+                            failed.add(cmd)
+                        if error is None:
+                            error = exception
+                    for cmd in completed:
+                        finished.add(cmd)
+                        if self.journal is not None:
+                            self.journal.finished(cmd)
+                        for dependent in self.dependents[cmd]:
+                            waiting_for[dependent] -= 1
+                            if waiting_for[dependent] == 0:
+                                ready.append(dependent)
+                self._prioritize(ready)
+
+        if error is not None:
+            cancelled = [
+                cmd for cmd in self.ordered if cmd not in finished and cmd not in failed
+            ]
+            lg.warning(
+                "Cancelled commands after a failure: %s",
+                [cmd.repr_cmd() for cmd in cancelled],
+            )
+            raise error
@@ -0,0 +1,91 @@
+"""Durations of past commands, used to schedule the slow commands first."""
+
+import json
+import logging
+import os
+
+from . import command, date_tools
+
+lg = logging.getLogger(__name__)
+
+HISTORY_VERSION = 1
+
+DEFAULT_DURATION = 1.0
+"""Estimated duration in seconds of a command that never ran before."""
+
+WEIGHT = 0.5
+"""Weight of the latest duration in the moving average of a command."""
+
+
+def command_key(cmd):
+    """Return the normalized identity of a command.
+
+    Timestamps in the names of snapshots are replaced by %T, so the commands of
+    timestamped snapshots share their durations across runs.
+
+    :param cmd: The command
+    :type  cmd: Command
+    :rtype:     str
+    """
+    return date_tools.re_timestamp.sub("%T", " ".join(cmd.cmd))
+
+
+class DurationHistory(object):
+    """Wall times of commands, kept in a json file between runs.
+
+    The history keeps a moving average of the duration of each command
+    identity (see :py:func:`command_key`).
+
+    :param path: Path of the history file, None to only keep it in memory
+    :type  path: str
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.durations: dict[str, float] = {}
+        if not path:
+            return
+        try:
+            with open(path, encoding="UTF-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            lg.debug("No usable command history in %s", path)
+            return
+        if data.get("version") == HISTORY_VERSION:
+            self.durations = data["durations"]
+
+    def estimate(self, cmd):
+        """Return the estimated duration of a command in seconds.
+
+        :param cmd: The command
+        :type  cmd: Command
+        :rtype:     float
+        """
+        if isinstance(cmd, command.DummyCommand):
+            return 0.0
+        return self.durations.get(command_key(cmd), DEFAULT_DURATION)
+
+    def record(self, cmd, seconds):
+        """Record the duration of a command.
+
+        :param     cmd: The command
+        :type      cmd: Command
+        :param seconds: Wall time of the command
+        :type  seconds: float
+        """
+        if isinstance(cmd, command.DummyCommand):
+            return
+        key = command_key(cmd)
+        if key in self.durations:
+            seconds = WEIGHT * seconds + (1 - WEIGHT) * self.durations[key]
+        self.durations[key] = seconds
+
+    def save(self):
+        """Save the history, if it has a path."""
+        if not self.path:
+            return
+        data = {"version": HISTORY_VERSION, "durations": self.durations}
+        tmp_path = "%s.tmp" % self.path
+        with open(tmp_path, "w", encoding="UTF-8") as f:
+            json.dump(data, f)
+        os.replace(tmp_path, self.path)
@@ -0,0 +1,105 @@
+"""Journal of the commands of a run, to resume it after it was interrupted."""
+
+import json
+import logging
+import os
+import threading
+
+from . import command
+
+lg = logging.getLogger(__name__)
+
+JOURNAL_VERSION = 1
+
+
+class Journal(object):
+    """Journal of a run, written while the commands are executed.
+
+    The journal is a file of json lines. The first line is the plan, the
+    ordered commands of the run. Every further line is the digest (see
+    :py:meth:`Command.digest`) of a command that finished. The journal is
+    removed when all commands finished.
+
+    If the run is interrupted, the plan is loaded again with `--resume` and
+    only the commands that did not finish are executed.
+
+    :param path: Path of the journal file
+    :type  path: str
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+        self._lock = threading.Lock()
+
+    def load(self):
+        """Load the plan of an interrupted run.
+
+        Return the commands in the order of the plan and the digests of the
+        finished commands, None if there is no interrupted run.
+
+        :rtype: tuple
+        """
+        try:
+            with open(self.path, encoding="UTF-8") as f:
+                lines = f.read().splitlines()
+        except FileNotFoundError:
+            return None
+        entries = []
+        for line in lines:
+            try:
+                entries.append(json.loads(line))
+            except ValueError:
+                # The line was being written when the run was interrupted
+                lg.debug("Ignoring incomplete line in journal %s", self.path)
+        if not entries or entries[0].get("version") != JOURNAL_VERSION:
+            lg.warning("Ignoring journal %s of another pyaptly version", self.path)
+            return None
+        plan = [command.Command.from_json(data) for data in entries[0]["plan"]]
+        finished = set(entry["finished"] for entry in entries[1:])
+        return plan, finished
+
+    def start(self, ordered, resume=False):
+        """Start journaling the run.
+
+        :param ordered: The commands of the run, in the order they are executed
+        :type  ordered: list
+        :param  resume: Continue the journal of an interrupted run
+        :type   resume: bool
+        """
+        if not resume:
+            header = {
+                "version": JOURNAL_VERSION,
+                "plan": [cmd.to_json() for cmd in ordered],
+            }
+            tmp_path = "%s.tmp" % self.path
+            with open(tmp_path, "w", encoding="UTF-8") as f:
+                f.write(json.dumps(header) + "\n")
+            os.replace(tmp_path, self.path)
+        self._file = open(self.path, "a", encoding="UTF-8")
+
+    def finished(self, cmd):
+        """Record that a command finished.
+
+        The journal is synced to the disk, so it survives a reboot.
+
+        :param cmd: The command that finished
+        :type  cmd: Command
+        """
+        with self._lock:
+            assert self._file is not None
+            self._file.write(json.dumps({"finished": cmd.digest()}) + "\n")
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+    def close(self, complete):
+        """Stop journaling, the journal is removed if the run is complete.
+
+        :param complete: True if all commands finished
+        :type  complete: bool
+        """
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        if complete:
+            os.unlink(self.path)
@@ -1,27 +1,134 @@
 """Aptly mirror/snapshot managment automation."""
 
 import argparse
+import functools
+import hashlib
+import importlib
+import json
 import logging
+import os
 import sys
 from pathlib import Path
-import json
-from jsonschema import validate
 
-from . import command, custom_logger, mirror, publish, repo, snapshot, util
+from . import (
+    backend,
+    command,
+    custom_logger,
+    executor,
+    model,
+    state_reader,
+    util,
+)
 
 _logging_setup = False
 
 
 lg = logging.getLogger(__name__)
 
-with (Path(__file__).parent / "config.schema.json").open('r') as file:
-    jsonschema = json.load(file)
+SCHEMA_PATH = Path(__file__).parent / "config.schema.json"
+CONFIG_CACHE_VERSION = 1
+
+
+@functools.lru_cache(maxsize=None)
+def config_validator():
+    """Return the validator of the config schema, it is only created once."""
+    from jsonschema import validators
+
+    with SCHEMA_PATH.open("r") as file:
+        schema = json.load(file)
+    return validators.validator_for(schema)(schema)
+
 
 def validate_config(config):
+    """Validate the config against the schema, errors are only logged.
+
+    :rtype: bool
+    """
     try:
-        validate(instance=config, schema=jsonschema)
-    except Exception as e: # pragma: no cover
+        config_validator().validate(config)
+    except Exception as e:  # pragma: no cover
         lg.error(f"Error while parsing the configfile!: {e}")
+        return False
+    return True
+
+
+def parse_config(suffix, data):
+    """Parse the contents of a config file by its extension.
+
+    :param suffix: Extension of the config file
+    :type  suffix: str
+    :param   data: Contents of the config file
+    :type    data: bytes
+    """
+    if suffix == ".toml":
+        import tomli
+
+        return tomli.loads(data.decode("UTF-8"))
+    elif suffix == ".json":
+        return json.loads(data)
+    elif suffix in (".yaml", ".yml"):
+        import yaml
+
+        return yaml.safe_load(data)
+    else:
+        util.exit_with_error(f"unknown config file extension: {suffix}")
+
+
+def config_digest(data):
+    """Return the key of a config in the config cache.
+
+    The schema is part of the key, a config is validated again if it changed.
+
+    :param data: Contents of the config file
+    :type  data: bytes
+    """
+    digest = hashlib.sha256(data)
+    digest.update(SCHEMA_PATH.read_bytes())
+    return digest.hexdigest()
+
+
+def read_config(path, cache_path=None):
+    """Read, parse and validate the config file.
+
+    With a `cache_path` the parsed config is saved after it was validated
+    without errors. If the config file (and the schema) did not change, the
+    next run uses it and skips parsing and validation.
+
+    :param       path: The config file
+    :type        path: :py:class:`pathlib.Path`
+    :param cache_path: File to cache the parsed config in, None to disable
+    :type  cache_path: str
+    """
+    data = path.read_bytes()
+    digest = None
+    if cache_path:
+        digest = config_digest(data)
+        try:
+            with open(cache_path, encoding="UTF-8") as f:
+                cached = json.load(f)
+        except (OSError, ValueError):
+            cached = {}
+        if (
+            cached.get("version") == CONFIG_CACHE_VERSION
+            and cached.get("digest") == digest
+        ):
+            lg.debug("Using the cached config from %s", cache_path)
+            return cached["config"]
+
+    cfg = parse_config(path.suffix, data)
+    if validate_config(cfg) and digest is not None:
+        cached = {"version": CONFIG_CACHE_VERSION, "digest": digest, "config": cfg}
+        tmp_path = "%s.tmp" % cache_path
+        try:
+            content = json.dumps(cached)
+            with open(tmp_path, "w", encoding="UTF-8") as f:
+                f.write(content)
+            os.replace(tmp_path, cache_path)
+        except (OSError, TypeError) as e:
+            # e.g. toml dates can't be saved as json
+            lg.warning("Could not save the config cache %s: %s", cache_path, e)
+    return cfg
+
 
 def setup_logger(args):
     """Setup the logger."""
@@ -48,29 +155,59 @@ def prepare(args):
     command.Command.pretend_mode = args.pretend
 
     path = Path(args.config)
-    with open(args.config, "rb") as f:
-        if path.suffix == ".toml":
-            import tomli
-
-            cfg = tomli.load(f)
-        elif path.suffix == ".json":
-            import json
-
-            cfg = json.load(f)
-        elif path.suffix in (".yaml", ".yml"):
-            import yaml
-
-            cfg = yaml.safe_load(f)
-            lg.warning(
-                "NOTE: yaml has beed deprecated and will be remove on the next major release."
-            )
-        else:
-            util.exit_with_error(f"unknown config file extension: {path.suffix}")
-
-    validate_config(cfg)
+    cfg = read_config(path, getattr(args, "config_cache", None))
+    if path.suffix in (".yaml", ".yml"):
+        lg.warning(
+            "NOTE: yaml has beed deprecated and will be remove on the next major release."
+        )
+
+    # Compile the config once, the command builders use the compiled model
+    model.config(cfg)
+    backend.configure(cfg)
+    state_reader.configure(cfg)
     return cfg
 
 
+def finish():
+    """Verify the state changed by the run and save it for the next run.
+
+    See :py:meth:`SystemStateReader.verify` and `execution.state-cache`.
+    """
+    state_reader.state_reader().verify()
+    state_reader.state_reader().save_cache()
+
+
+def run(func, cfg, args):
+    """Run a subcommand, or resume the interrupted run with `--resume`.
+
+    :param func: The function of the subcommand
+    :type  func: callable
+    :param  cfg: The configuration toml as dict
+    :type   cfg: dict
+    :param args: The command-line arguments read with :py:mod:`argparse`
+    :type  args: namespace
+    """
+    if not executor.resume(cfg, args):
+        func(cfg, args)
+    finish()
+
+
+def subcommand(name):
+    """Return the function running a subcommand, its module is imported on call.
+
+    So only the modules of the selected subcommand are imported.
+
+    :param name: Name of the module and its function, e.g. "mirror"
+    :type  name: str
+    """
+
+    def run(cfg, args):
+        module = importlib.import_module("%s.%s" % (__package__, name))
+        return getattr(module, name)(cfg, args)
+
+    return run
+
+
 def main(argv=None):
     """Define parsers and executes commands.
 
@@ -105,32 +242,62 @@ def main(argv=None):
         help="Do not do anything, just print out what WOULD be done",
         action="store_true",
     )
+    parser.add_argument(
+        "--jobs",
+        "-j",
+        help="Run up to JOBS independent commands at once (default: config or 1)",
+        type=int,
+        default=None,
+    )
+    parser.add_argument(
+        "--batch",
+        "-b",
+        help="Run ready aptly commands together using 'aptly task run'",
+        action="store_true",
+        default=None,
+    )
+    parser.add_argument(
+        "--resume",
+        "-r",
+        help="Continue the interrupted run recorded in execution.journal",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--config-cache",
+        help="Cache the parsed and validated config in this file",
+        type=str,
+        default=None,
+    )
     subparsers = parser.add_subparsers()
     mirror_parser = subparsers.add_parser("mirror", help="manage aptly mirrors")
-    mirror_parser.set_defaults(func=mirror.mirror)
+    mirror_parser.set_defaults(func=subcommand("mirror"))
     mirror_parser.add_argument("task", type=str, choices=["create", "update"])
     mirror_parser.add_argument("mirror_name", type=str, nargs="?", default="all")
     snap_parser = subparsers.add_parser("snapshot", help="manage aptly snapshots")
-    snap_parser.set_defaults(func=snapshot.snapshot)
+    snap_parser.set_defaults(func=subcommand("snapshot"))
     snap_parser.add_argument("task", type=str, choices=["create", "update"])
     snap_parser.add_argument("snapshot_name", type=str, nargs="?", default="all")
     publish_parser = subparsers.add_parser(
         "publish", help="manage aptly publish endpoints"
     )
-    publish_parser.set_defaults(func=publish.publish)
+    publish_parser.set_defaults(func=subcommand("publish"))
     publish_parser.add_argument("task", type=str, choices=["create", "update"])
     publish_parser.add_argument("publish_name", type=str, nargs="?", default="all")
     repo_parser = subparsers.add_parser("repo", help="manage aptly repositories")
-    repo_parser.set_defaults(func=repo.repo)
+    repo_parser.set_defaults(func=subcommand("repo"))
     repo_parser.add_argument("task", type=str, choices=["create"])
     repo_parser.add_argument("repo_name", type=str, nargs="?", default="all")
+    apply_parser = subparsers.add_parser(
+        "apply", help="create and update repos, mirrors, snapshots and publishes"
+    )
+    apply_parser.set_defaults(func=subcommand("apply"))
 
     args = parser.parse_args(argv)
     setup_logger(args)
     cfg = prepare(args)
 
     # run function for selected subparser
-    args.func(cfg, args)
+    run(args.func, cfg, args)
 
 
 if __name__ == "__main__":  # pragma: no cover
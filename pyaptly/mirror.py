@@ -1,8 +1,9 @@
 """Create and update mirrors in aptly."""
 
 import logging
+import urllib.parse
 
-from . import command, state_reader, util
+from . import command, executor, model, release, state_reader, util
 
 lg = logging.getLogger(__name__)
 
@@ -10,27 +11,19 @@ lg = logging.getLogger(__name__)
 def add_gpg_keys(mirror_config):
     """Use the gpg to download and add gpg keys needed to create mirrors.
 
-    :param  mirror_config: The configuration toml as dict
-    :type   mirror_config: dict
+    :param  mirror_config: Configuration of the mirror
+    :type   mirror_config: model.Mirror
     """
-    keyserver = mirror_config.get("keyserver")
+    keyserver = mirror_config.keyserver
     if not keyserver:
         keyserver = util.get_default_keyserver()
     keys_urls = {}
-    if "gpg-keys" in mirror_config:
-        keys = util.unit_or_list_to_list(mirror_config["gpg-keys"])
-        if "gpg-urls" in mirror_config:
-            urls = util.unit_or_list_to_list(mirror_config["gpg-urls"])
-            urls_len = len(urls)
-            for x in range(len(keys)):
-                if x < urls_len:
-                    url = urls[x]
-                else:  # pragma: no cover
-                    url = None
-                keys_urls[keys[x]] = url
+    urls = mirror_config.gpg_urls
+    for x, key in enumerate(mirror_config.gpg_keys):
+        if x < len(urls):
+            keys_urls[key] = urls[x]
         else:
-            for key in keys:
-                keys_urls[key] = None
+            keys_urls[key] = None
 
     for key in keys_urls.keys():
         if key in state_reader.state_reader().gpg_keys():
@@ -59,7 +52,24 @@ def add_gpg_keys(mirror_config):
                 util.run_command(["bash", "-c", key_shell], check=True)
             else:
                 raise
-    state_reader.state_reader().gpg_keys.cache_clear()
+    state_reader.state_reader().invalidate("gpg_key")
+
+
+def archive_host(mirror_config):
+    """Return the host of the archive of a mirror, None if it has no host.
+
+    A malformed URL has no host, aptly reports the error when it runs.
+
+    :param mirror_config: Configuration of the mirror
+    :type  mirror_config: model.Mirror
+    :rtype:               str
+    """
+    if not mirror_config.archive:
+        return None
+    try:
+        return urllib.parse.urlsplit(mirror_config.archive).hostname
+    except ValueError:
+        return None
 
 
 def mirror(cfg, args):
@@ -70,7 +80,8 @@ def mirror(cfg, args):
     :param args: The command-line arguments read with :py:mod:`argparse`
     :type  args: namespace
     """
-    lg.debug("Mirrors to create: %s", cfg["mirror"])
+    mirrors = model.config(cfg).mirrors
+    lg.debug("Mirrors to create: %s", mirrors)
 
     mirror_cmds = {
         "create": cmd_mirror_create,
@@ -80,23 +91,43 @@ def mirror(cfg, args):
     cmd_mirror = mirror_cmds[args.task]
 
     cmds = []
+    cache = release.release_cache(cfg)
+    if args.task == "update" and args.mirror_name == "all" and cache is not None:
+        cache.check_all(mirrors)
     if args.mirror_name == "all":
-        for mirror_name, mirror_config in cfg["mirror"].items():
+        for mirror_name, mirror_config in mirrors.items():
             cmds.extend(cmd_mirror(cfg, mirror_name, mirror_config))
     else:
-        if args.mirror_name in cfg["mirror"]:
-            cmds.extend(
-                cmd_mirror(cfg, args.mirror_name, cfg["mirror"][args.mirror_name])
-            )
+        if args.mirror_name in mirrors:
+            cmds.extend(cmd_mirror(cfg, args.mirror_name, mirrors[args.mirror_name]))
         else:
             raise ValueError(
                 "Requested mirror is not defined in config file: %s"
                 % (args.mirror_name)
             )
-    for cmd in command.Command.order_commands(
-        cmds, state_reader.state_reader().has_dependency
-    ):
-        cmd.execute()
+    try:
+        executor.execute_commands(cfg, args, cmds)
+    finally:
+        commit_release_cache(cfg, cmds)
+
+
+def commit_release_cache(cfg, commands):
+    """Keep the Release validators of the mirrors that were updated.
+
+    See `execution.release-cache` and :py:class:`release.ReleaseCache`.
+
+    :param      cfg: The configuration toml as dict
+    :type       cfg: dict
+    :param commands: The commands of the run
+    :type  commands: list
+    """
+    cache = release.release_cache(cfg)
+    if cache is None or command.Command.pretend_mode:
+        return
+    for cmd in commands:
+        if tuple(cmd.cmd[1:3]) == ("mirror", "update") and cmd._finished:
+            cache.commit(cmd.cmd[-1])
+    cache.save()
 
 
 def cmd_mirror_create(cfg, mirror_name, mirror_config):
@@ -106,8 +137,8 @@ def cmd_mirror_create(cfg, mirror_name, mirror_config):
     :type            cfg: dict
     :param   mirror_name: Name of the mirror to create
     :type    mirror_name: str
-    :param mirror_config: Configuration of the snapshot from the toml file.
-    :type  mirror_config: dict
+    :param mirror_config: Configuration of the mirror
+    :type  mirror_config: model.Mirror
     """
     if mirror_name in state_reader.state_reader().mirrors():  # pragma: no cover
         return []
@@ -115,48 +146,59 @@ def cmd_mirror_create(cfg, mirror_name, mirror_config):
     add_gpg_keys(mirror_config)
     aptly_cmd = ["aptly", "mirror", "create"]
 
-    if "sources" in mirror_config and mirror_config["sources"]:
+    if mirror_config.sources:
         aptly_cmd.append("-with-sources")
     else:
         aptly_cmd.append("-with-sources=false")
 
-    if "udeb" in mirror_config and mirror_config["udeb"]:
+    if mirror_config.udeb:
         aptly_cmd.append("-with-udebs")
 
-    if "architectures" in mirror_config:
+    if mirror_config.architectures is not None:
         aptly_cmd.append(
-            "-architectures={0}".format(
-                ",".join(util.unit_or_list_to_list(mirror_config["architectures"]))
-            )
+            "-architectures={0}".format(",".join(mirror_config.architectures))
         )
 
     aptly_cmd.append(mirror_name)
-    aptly_cmd.append(mirror_config["archive"])
-    aptly_cmd.append(mirror_config["distribution"])
-    if "components" in mirror_config:
-        aptly_cmd.extend(util.unit_or_list_to_list(mirror_config["components"]))
+    aptly_cmd.append(mirror_config.archive)
+    aptly_cmd.append(mirror_config.distribution)
+    aptly_cmd.extend(mirror_config.components)
 
     cmd = command.Command(aptly_cmd)
     cmd.provide("mirror", mirror_name)
+    cmd.host = archive_host(mirror_config)
     return [cmd]
 
 
 def cmd_mirror_update(cfg, mirror_name, mirror_config):
     """Create a mirror update command to be ordered and executed later.
 
+    With `release-cache` in the `execution` section, the update is skipped if
+    the InRelease/Release file of the mirror did not change upstream since the
+    last update. Then no command provides "mirror-updated-<name>". A mirror
+    created in this run is always updated, its Release file is staged too.
+
     :param           cfg: pyaptly config
     :type            cfg: dict
     :param   mirror_name: Name of the mirror to create
     :type    mirror_name: str
-    :param mirror_config: Configuration of the snapshot from the toml file.
-    :type  mirror_config: dict
+    :param mirror_config: Configuration of the mirror
+    :type  mirror_config: model.Mirror
     """
+    create_cmds = cmd_mirror_create(cfg, mirror_name, mirror_config)
+    cache = release.release_cache(cfg)
+    if cache is not None:
+        if cache.check(mirror_name, mirror_config) and not create_cmds:
+            return []
+
     add_gpg_keys(mirror_config)
     aptly_cmd = ["aptly", "mirror", "update"]
-    if "max-tries" in mirror_config:
-        aptly_cmd.append("-max-tries=%d" % mirror_config["max-tries"])
+    if mirror_config.max_tries is not None:
+        aptly_cmd.append("-max-tries=%d" % mirror_config.max_tries)
 
     aptly_cmd.append(mirror_name)
     cmd = command.Command(aptly_cmd)
+    cmd.host = archive_host(mirror_config)
     cmd.require("mirror", mirror_name)
-    return cmd_mirror_create(cfg, mirror_name, mirror_config) + [cmd]
+    cmd.provide("virtual", "mirror-updated-%s" % mirror_name)
+    return create_cmds + [cmd]
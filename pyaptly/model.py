@@ -0,0 +1,378 @@
+"""Typed model of the pyaptly config.
+
+The toml config is compiled once per run (see :py:func:`config`) into slotted,
+immutable objects. References to other publishes are split, lists are
+normalized and lookups are prepared, so the command builders do not have to
+parse the toml dict again.
+"""
+
+import dataclasses
+import datetime
+from types import MappingProxyType
+from typing import Any, Mapping
+
+from . import date_tools, util
+
+back_reference_map = {
+    "current": 0,
+    "previous": 1,
+}
+
+
+@dataclasses.dataclass(frozen=True, slots=True)
+class SnapshotRef(object):
+    """A reference to a snapshot, used by publishes, merges and filters.
+
+    :param              name: Name of the snapshot, may contain %T
+    :type               name: str
+    :param    back_reference: How many timestamps to go back, 0 is the current
+                              one. None if the name is used as it is.
+    :type     back_reference: int
+    :param archive_on_update: Name to archive the snapshot to on update, may
+                              contain %T
+    :type  archive_on_update: str
+    """
+
+    name: str
+    back_reference: int | None = None
+    archive_on_update: str | None = None
+
+    @classmethod
+    def from_spec(cls, spec):
+        """Create a reference from its config, a name or a dict.
+
+        :param spec: The snapshot reference as in the config
+        :type  spec: str or dict
+        """
+        if not hasattr(spec, "items"):
+            return cls(spec)
+        back_reference = None
+        if "timestamp" in spec:
+            back_reference = back_reference_map.get(spec["timestamp"])
+            if back_reference is None:
+                back_reference = int(spec["timestamp"])
+        return cls(spec["name"], back_reference, spec.get("archive-on-update"))
+
+
+@dataclasses.dataclass(frozen=True, slots=True)
+class Mirror(object):
+    """A mirror of a remote archive."""
+
+    name: str
+    archive: str | None
+    distribution: str | None
+    components: tuple[str, ...] = ()
+    architectures: tuple[str, ...] | None = None
+    gpg_keys: tuple[str, ...] = ()
+    gpg_urls: tuple[str, ...] = ()
+    keyserver: str | None = None
+    max_tries: int | None = None
+    sources: bool = False
+    udeb: bool = False
+
+
+@dataclasses.dataclass(frozen=True, slots=True)
+class Repo(object):
+    """A local repo."""
+
+    name: str
+    architectures: tuple[str, ...] | None = None
+    components: tuple[str, ...] | None = None
+    comment: str | None = None
+    distribution: str | None = None
+
+
+@dataclasses.dataclass(frozen=True, slots=True)
+class Snapshot(object):
+    """A snapshot, created from a mirror or repo, filtered or merged.
+
+    Only one of mirror, repo, filter and merge is used, in this order. The
+    filter is a pair of the source and the query. The retention of a
+    timestamped snapshot may keep the last "keep" periods and the snapshots
+    younger than "max-age" days.
+    """
+
+    name: str
+    mirror: str | None = None
+    repo: str | None = None
+    filter: tuple[SnapshotRef, str] | None = None
+    merge: tuple[SnapshotRef, ...] | None = None
+    timestamp: Mapping[str, str] | None = None
+    rotate_via: str | None = None
+    retention: Mapping[str, int] | None = None
+
+
+@dataclasses.dataclass(frozen=True, slots=True)
+class Publish(object):
+    """A publish of one distribution.
+
+    Only one of snapshots, repo and publish is the source of the publish.
+    """
+
+    name: str
+    distribution: str | None
+    components: tuple[str, ...] = ()
+    architectures: tuple[str, ...] | None = None
+    label: str | None = None
+    origin: str | None = None
+    gpg_key: str | None = None
+    skip_contents: bool = False
+    automatic_update: bool = False
+    snapshots: tuple[SnapshotRef, ...] | None = None
+    repo: str | None = None
+    publish: tuple[str, str] | None = None
+
+    @property
+    def fullname(self):
+        """The name of the publish, "prefix distribution"."""
+        return "%s %s" % (self.name, self.distribution)
+
+
+@dataclasses.dataclass(frozen=True, slots=True)
+class Config(object):
+    """The compiled config.
+
+    :param publishes: (name, distribution) -> publish
+    :type  publishes: Mapping
+    :param   entries: All publishes in the order of the config
+    :type    entries: tuple
+    """
+
+    mirrors: Mapping[str, Mirror]
+    repos: Mapping[str, Repo]
+    snapshots: Mapping[str, Snapshot]
+    publishes: Mapping[tuple[str, str | None], Publish]
+    entries: tuple[Publish, ...]
+    execution: Mapping[str, Any]
+
+    def publishes_named(self, name):
+        """Return the publishes (one per distribution) with the given name.
+
+        :param name: Name of the publish
+        :type  name: str
+        :rtype:      tuple
+        """
+        return tuple(publish for publish in self.entries if publish.name == name)
+
+    def snapshot_name(self, ref, date=None):
+        """Resolve a snapshot reference to the name of the snapshot.
+
+        :param  ref: The reference, a config spec is converted
+        :type   ref: SnapshotRef, str or dict
+        :param date: The current date, default now
+        :type  date: :py:class:`datetime.datetime`
+        """
+        if not isinstance(ref, SnapshotRef):
+            ref = SnapshotRef.from_spec(ref)
+        if ref.back_reference is None:
+            return ref.name
+        reference = self.snapshots[ref.name]
+        delta = datetime.timedelta(seconds=1)
+        timestamp = date or datetime.datetime.now()
+        for _ in range(ref.back_reference + 1):
+            timestamp = date_tools.round_timestamp(reference.timestamp or {}, timestamp)
+            timestamp -= delta
+
+        timestamp += delta
+        return ref.name.replace("%T", date_tools.format_timestamp(timestamp))
+
+
+def _list(value):
+    if value is None:
+        return None
+    return tuple(util.unit_or_list_to_list(value))
+
+
+def compile_mirror(name, mirror_config):
+    """Compile the config of a mirror.
+
+    :param          name: Name of the mirror
+    :type           name: str
+    :param mirror_config: Configuration of the mirror from the toml file.
+    :type  mirror_config: dict
+    """
+    return Mirror(
+        name=name,
+        archive=mirror_config.get("archive"),
+        distribution=mirror_config.get("distribution"),
+        components=_list(mirror_config.get("components", [])),
+        architectures=_list(mirror_config.get("architectures")),
+        gpg_keys=_list(mirror_config.get("gpg-keys", [])),
+        gpg_urls=_list(mirror_config.get("gpg-urls", [])),
+        keyserver=mirror_config.get("keyserver"),
+        max_tries=mirror_config.get("max-tries"),
+        sources=bool(mirror_config.get("sources")),
+        udeb=bool(mirror_config.get("udeb")),
+    )
+
+
+def compile_repo(name, repo_config):
+    """Compile the config of a repo.
+
+    :param        name: Name of the repo
+    :type         name: str
+    :param repo_config: Configuration of the repo from the toml file.
+    :type  repo_config: dict
+    """
+    for conf in repo_config:
+        if conf not in ("architectures", "component", "comment", "distribution"):
+            raise ValueError(
+                "Don't know how to handle repo config entry %s in %s" % (conf, name)
+            )
+    return Repo(
+        name=name,
+        architectures=_list(repo_config.get("architectures")),
+        components=_list(repo_config.get("component")),
+        comment=repo_config.get("comment"),
+        distribution=repo_config.get("distribution"),
+    )
+
+
+def compile_snapshot(name, snapshot_config):
+    """Compile the config of a snapshot.
+
+    :param            name: Name of the snapshot, may contain %T
+    :type             name: str
+    :param snapshot_config: Configuration of the snapshot from the toml file.
+    :type  snapshot_config: dict
+    """
+    filter_config = snapshot_config.get("filter")
+    merge = snapshot_config.get("merge")
+    timestamp = snapshot_config.get("timestamp")
+    retention = snapshot_config.get("retention")
+    return Snapshot(
+        name=name,
+        mirror=snapshot_config.get("mirror"),
+        repo=snapshot_config.get("repo"),
+        filter=(
+            (SnapshotRef.from_spec(filter_config["source"]), filter_config["query"])
+            if filter_config
+            else None
+        ),
+        merge=(
+            tuple(SnapshotRef.from_spec(source) for source in merge)
+            if merge is not None
+            else None
+        ),
+        timestamp=MappingProxyType(dict(timestamp)) if timestamp else None,
+        rotate_via=snapshot_config.get("rotate_via"),
+        retention=MappingProxyType(dict(retention)) if retention else None,
+    )
+
+
+def compile_publish(name, publish_config):
+    """Compile the config of a publish entry.
+
+    :param           name: Name of the publish
+    :type            name: str
+    :param publish_config: Configuration of the publish from the toml file.
+    :type  publish_config: dict
+    """
+    known = (
+        "architectures",
+        "automatic-update",
+        "components",
+        "distribution",
+        "gpg-key",
+        "label",
+        "origin",
+        "publish",
+        "repo",
+        "skip-contents",
+        "snapshots",
+    )
+    for conf in publish_config:
+        if conf not in known:
+            raise ValueError(
+                "Don't know how to handle publish config entry %s in %s" % (conf, name)
+            )
+    sources = [
+        conf for conf in ("snapshots", "repo", "publish") if conf in publish_config
+    ]
+    if len(sources) > 1:
+        raise ValueError("Multiple sources for publish %s %s" % (name, publish_config))
+    snapshots = None
+    if "snapshots" in publish_config:
+        snapshots = tuple(
+            SnapshotRef.from_spec(spec)
+            for spec in util.unit_or_list_to_list(publish_config["snapshots"])
+        )
+    publish = None
+    if "publish" in publish_config:
+        reference = publish_config["publish"]
+        ref_name, separator, ref_distribution = reference.rpartition(" ")
+        if not separator:
+            raise ValueError(
+                "Publish %s refers to %s, expected 'name distribution'"
+                % (name, reference)
+            )
+        publish = (ref_name, ref_distribution)
+    return Publish(
+        name=name,
+        distribution=publish_config.get("distribution"),
+        components=_list(publish_config.get("components", [])),
+        architectures=_list(publish_config.get("architectures")),
+        label=publish_config.get("label"),
+        origin=publish_config.get("origin"),
+        gpg_key=publish_config.get("gpg-key"),
+        skip_contents=bool(publish_config.get("skip-contents")),
+        automatic_update=publish_config.get("automatic-update", False) is True,
+        snapshots=snapshots,
+        repo=publish_config.get("repo"),
+        publish=publish,
+    )
+
+
+def compile_config(cfg):
+    """Compile the toml config into a :py:class:`Config`.
+
+    :param cfg: The configuration toml as dict
+    :type  cfg: dict
+    :rtype:     Config
+    """
+    entries = tuple(
+        compile_publish(name, publish_config)
+        for name, publish_configs in cfg.get("publish", {}).items()
+        for publish_config in publish_configs
+    )
+    return Config(
+        mirrors=MappingProxyType(
+            dict(
+                (name, compile_mirror(name, mirror_config))
+                for name, mirror_config in cfg.get("mirror", {}).items()
+            )
+        ),
+        repos=MappingProxyType(
+            dict(
+                (name, compile_repo(name, repo_config))
+                for name, repo_config in cfg.get("repo", {}).items()
+            )
+        ),
+        snapshots=MappingProxyType(
+            dict(
+                (name, compile_snapshot(name, snapshot_config))
+                for name, snapshot_config in cfg.get("snapshot", {}).items()
+            )
+        ),
+        publishes=MappingProxyType(
+            dict(((publish.name, publish.distribution), publish) for publish in entries)
+        ),
+        entries=entries,
+        execution=MappingProxyType(dict(cfg.get("execution", {}))),
+    )
+
+
+_compiled: tuple[dict, Config] | None = None
+
+
+def config(cfg):
+    """Return the compiled config, it is compiled once per config.
+
+    :param cfg: The configuration toml as dict
+    :type  cfg: dict
+    :rtype:     Config
+    """
+    global _compiled
+    if _compiled is None or _compiled[0] is not cfg:
+        _compiled = (cfg, compile_config(cfg))
+    return _compiled[1]
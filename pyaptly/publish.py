@@ -4,7 +4,7 @@ import datetime
 import logging
 import re
 
-from . import command, date_tools, snapshot, state_reader, util
+from . import command, date_tools, executor, model, snapshot, state_reader, util
 
 lg = logging.getLogger(__name__)
 
@@ -17,7 +17,8 @@ def publish(cfg, args):
     :param args: The command-line arguments read with :py:mod:`argparse`
     :type  args: namespace
     """
-    lg.debug("Publishes to create / update: %s", cfg["publish"])
+    entries = model.config(cfg).entries
+    lg.debug("Publishes to create / update: %s", entries)
 
     # aptly publish snapshot -components ... -architectures ... -distribution
     # ... -origin Ubuntu trusty-stable ubuntu/stable
@@ -31,27 +32,23 @@ def publish(cfg, args):
 
     if args.publish_name == "all":
         commands = [
-            cmd_publish(cfg, publish_name, publish_conf_entry)
-            for publish_name, publish_conf in cfg["publish"].items()
-            for publish_conf_entry in publish_conf
-            if publish_conf_entry.get("automatic-update", "false") is True
+            cmd_publish(cfg, publish_entry.name, publish_entry)
+            for publish_entry in entries
+            if publish_entry.automatic_update
         ]
+        defer_cleanup(commands)
 
-        for cmd in command.Command.order_commands(
-            commands, state_reader.state_reader().has_dependency
-        ):
-            cmd.execute()
+        executor.execute_commands(cfg, args, commands)
 
     else:
-        if args.publish_name in cfg["publish"]:
+        named = model.config(cfg).publishes_named(args.publish_name)
+        if named:
             commands = [
-                cmd_publish(cfg, args.publish_name, publish_conf_entry)
-                for publish_conf_entry in cfg["publish"][args.publish_name]
+                cmd_publish(cfg, args.publish_name, publish_entry)
+                for publish_entry in named
             ]
-            for cmd in command.Command.order_commands(
-                commands, state_reader.state_reader().has_dependency
-            ):
-                cmd.execute()
+            defer_cleanup(commands)
+            executor.execute_commands(cfg, args, commands)
         else:
             raise ValueError(
                 "Requested publish is not defined in config file: %s"
@@ -59,6 +56,91 @@ def publish(cfg, args):
             )
 
 
+_snapshot_index: tuple[dict, tuple, dict] | None = None
+
+
+def snapshot_publish_index(cfg):
+    """Index the publish entries of the config by the snapshots they publish.
+
+    The snapshot references are resolved with
+    :py:func:`snapshot.snapshot_spec_to_name` only once, the index is kept for
+    the config it was built from. Entries without snapshots are not indexed.
+
+    Return the publish entries (:py:class:`model.Publish`) in the order of the
+    config and a dict of snapshot name -> positions in that tuple.
+
+    :param cfg: pyaptly config
+    :type  cfg: dict
+    :rtype:     tuple
+    """
+    global _snapshot_index
+    if _snapshot_index is not None and _snapshot_index[0] is cfg:
+        return _snapshot_index[1:]
+    entries = model.config(cfg).entries
+    index: dict[str, list[int]] = {}
+    for position, publish_entry in enumerate(entries):
+        for snap in publish_entry.snapshots or ():
+            snap_name = snapshot.snapshot_spec_to_name(cfg, snap)
+            index.setdefault(snap_name, []).append(position)
+    _snapshot_index = (cfg, entries, index)
+    return entries, index
+
+
+def defer_cleanup(commands):
+    """Let only the last switches of a prefix clean up its published pool.
+
+    aptly removes the files no publish of the prefix refers to anymore after
+    every switch. If several publishes of a prefix are switched, the switches
+    run with `-skip-cleanup`, except the last switch of every component. Those
+    clean up once the other switches of the prefix finished.
+
+    The commands are changed in place, commands that are None are ignored.
+    Copies of a switch (several rotations may switch the same publish) are
+    changed alike, so they are still merged when the commands are ordered.
+
+    :param commands: The commands of the run
+    :type  commands: list
+    """
+    # prefix -> distribution -> (copies of the switch, components)
+    switches: dict[str, dict[str, tuple[list, list[str]]]] = {}
+    for cmd in commands:
+        if cmd is None or tuple(cmd.cmd[1:3]) != ("publish", "switch"):
+            continue
+        args = [argument for argument in cmd.cmd[3:] if not argument.startswith("-")]
+        components = ["main"]
+        for argument in cmd.cmd[3:]:
+            if argument.startswith("-component="):
+                components = argument.partition("=")[2].split(",")
+        distributions = switches.setdefault(args[1], {})
+        copies, _ = distributions.pop(args[0], ([], components))
+        copies.append(cmd)
+        # The last copy decides the position of the switch
+        distributions[args[0]] = (copies, components)
+
+    for prefix, distributions in switches.items():
+        if len(distributions) < 2:
+            continue
+        covered: set[str] = set()
+        cleaning = []
+        skipping = []
+        for copies, components in reversed(list(distributions.values())):
+            if set(components) - covered:
+                covered.update(components)
+                cleaning.extend(copies)
+            else:
+                skipping.extend(copies)
+        lg.debug("Cleaning up prefix %s after %d switches", prefix, len(distributions))
+        for cmd in skipping:
+            cmd.cmd.insert(3, "-skip-cleanup=true")
+            for type_, name in list(cmd.get_provides()):
+                if type_ != "publish":
+                    continue
+                # Internal ordering only, the state reader can not resolve it
+                cmd.provide("virtual", "switched-%s" % name)
+                for cleaning_cmd in cleaning:
+                    cleaning_cmd.require("virtual", "switched-%s" % name)
+
+
 def publish_cmd_update(cfg, publish_name, publish_config, ignore_existing=False):
     """Create a publish command with its dependencies.
 
@@ -68,43 +150,44 @@ def publish_cmd_update(cfg, publish_name, publish_config, ignore_existing=False)
     :type             cfg: dict
     :param   publish_name: Name of the publish to update
     :type    publish_name: str
-    :param publish_config: Configuration of the publish from the toml file.
-    :type  publish_config: dict
+    :param publish_config: Configuration of the publish
+    :type  publish_config: model.Publish
     """
     publish_cmd = ["aptly", "publish"]
     options = []
-    args = [publish_config["distribution"], publish_name]
+    args = [publish_config.distribution, publish_name]
 
-    if "skip-contents" in publish_config and publish_config["skip-contents"]:
+    if publish_config.skip_contents:
         options.append("-skip-contents=true")
 
-    if "repo" in publish_config:
+    if publish_config.repo is not None:
         publish_cmd.append("update")
         cmd = command.Command(publish_cmd + options + args)
         cmd.provide("publish", publish_name)
         return cmd
 
-    publish_fullname = "%s %s" % (publish_name, publish_config["distribution"])
+    publish_fullname = publish_config.fullname
     # TODO: add flag --create to create publishes when they haven't been created yet
     # TODO: Fail gracefully and show an error when there is no existing publish
+    publish_records = state_reader.state_reader().publish_records()
     try:
-        current_snapshots = state_reader.state_reader().publish_map()[publish_fullname]
+        current_snapshots = publish_records[publish_fullname].snapshots
     except KeyError:  # pragma: no cover
         util.exit_with_error(f"The publish {publish_fullname} hasn't been created yet.")
-    if "snapshots" in publish_config:
-        snapshots_config = publish_config["snapshots"]
+    components = publish_config.components
+    if publish_config.snapshots is not None:
+        snapshots_config = publish_config.snapshots
         new_snapshots = [
             snapshot.snapshot_spec_to_name(cfg, snap) for snap in snapshots_config
         ]
-    elif "publish" in publish_config:
-        conf_value = publish_config["publish"]
-        snapshots_config = []
-        ref_publish_name, distribution = conf_value.split(" ")
-        for publish in cfg["publish"][ref_publish_name]:
-            if publish["distribution"] == distribution:
-                snapshots_config.extend(publish["snapshots"])
-                break
-        new_snapshots = list(state_reader.state_reader().publish_map()[conf_value])
+    elif publish_config.publish is not None:
+        ref_publish = model.config(cfg).publishes.get(publish_config.publish)
+        snapshots_config = ()
+        if ref_publish is not None:
+            snapshots_config = ref_publish.snapshots or ()
+        new_snapshots = publish_records["%s %s" % publish_config.publish].snapshots_for(
+            components
+        )
     else:  # pragma: no cover
         raise ValueError(
             "No snapshot references configured in publish %s" % publish_name
@@ -113,48 +196,45 @@ def publish_cmd_update(cfg, publish_name, publish_config, ignore_existing=False)
     if set(new_snapshots) == set(current_snapshots) and not ignore_existing:
         # Already pointing to the newest snapshot, nothing to do
         return
-    components = util.unit_or_list_to_list(publish_config["components"])
 
     for snap in snapshots_config:
-        # snap may be a plain name or a dict..
-        if hasattr(snap, "items"):
-            # Dict mode - only here can we even have an archive option
-            archive = snap.get("archive-on-update", None)
-
-            if archive:
-                # Replace any timestamp placeholder with the current
-                # date/time.  Note that this is NOT rounded, as we want to
-                # know exactly when the archival happened.
-                archive = archive.replace(
-                    "%T", date_tools.format_timestamp(datetime.datetime.now())
+        # Only snapshots referenced by a dict can have an archive option
+        archive = snap.archive_on_update
+
+        if archive:
+            # Replace any timestamp placeholder with the current
+            # date/time.  Note that this is NOT rounded, as we want to
+            # know exactly when the archival happened.
+            archive = archive.replace(
+                "%T", date_tools.format_timestamp(datetime.datetime.now())
+            )
+            if archive in state_reader.state_reader().snapshots():  # pragma: no cover
+                continue
+            prefix_to_search = re.sub("%T$", "", snap.name)
+
+            current_snapshot = None
+            for snap_name in sorted(current_snapshots, key=lambda x: -len(x)):
+                if snap_name.startswith(prefix_to_search):
+                    current_snapshot = snap_name
+                    break
+            if current_snapshot is None:
+                lg.warning(
+                    "Snapshot %s doesn't exist on to-be archived publish %s."
+                    % (snap.name, publish_fullname)
                 )
-                if (
-                    archive in state_reader.state_reader().snapshots()
-                ):  # pragma: no cover
-                    continue
-                prefix_to_search = re.sub("%T$", "", snap["name"])
-
-                current_snapshot = None
-                for snap_name in sorted(current_snapshots, key=lambda x: -len(x)):
-                    if snap_name.startswith(prefix_to_search):
-                        current_snapshot = snap_name
-                        break
-                if current_snapshot is None:
-                    lg.warning(
-                        "Snapshot %s doesn't exist on to-be archived publish %s."
-                        % (snap["name"], publish_fullname)
-                    )
-                else:
-                    snapshot.clone_snapshot(current_snapshot, archive).execute()
+            else:
+                snapshot.clone_snapshot(current_snapshot, archive).execute()
 
     publish_cmd.append("switch")
     options.append("-component=%s" % ",".join(components))
 
-    if "skip-contents" in publish_config and publish_config["skip-contents"]:
+    if publish_config.skip_contents:
         options.append("-skip-contents=true")
 
     cmd = command.Command(publish_cmd + options + args + new_snapshots)
     cmd.provide("publish", publish_fullname)
+    for snap in new_snapshots:
+        cmd.require("snapshot", snap)
     return cmd
 
 
@@ -167,10 +247,10 @@ def publish_cmd_create(cfg, publish_name, publish_config, ignore_existing=False)
     :type             cfg: dict
     :param   publish_name: Name of the publish to create
     :type    publish_name: str
-    :param publish_config: Configuration of the publish from the toml file.
-    :type  publish_config: dict
+    :param publish_config: Configuration of the publish
+    :type  publish_config: model.Publish
     """
-    publish_fullname = "%s %s" % (publish_name, publish_config["distribution"])
+    publish_fullname = publish_config.fullname
     if (
         publish_fullname in state_reader.state_reader().publishes()
         and not ignore_existing
@@ -183,93 +263,58 @@ def publish_cmd_create(cfg, publish_name, publish_config, ignore_existing=False)
     source_args = []
     endpoint_args = [publish_name]
 
-    has_source = False
-    num_sources = 0
-
-    for conf, conf_value in publish_config.items():
-        if conf == "skip-contents":
-            if conf_value:
-                options.append("-skip-contents=true")
-        elif conf == "architectures":  # pragma: no cover
-            options.append(
-                "-architectures=%s" % ",".join(util.unit_or_list_to_list(conf_value))
-            )
-        elif conf == "components":
-            components = util.unit_or_list_to_list(conf_value)
-            options.append("-component=%s" % ",".join(components))
-        elif conf == "label":  # pragma: no cover
-            options.append("-label=%s" % conf_value)
-        elif conf == "origin":  # pragma: no cover
-            options.append("-origin=%s" % conf_value)
-
-        elif conf == "distribution":
-            options.append("-distribution=%s" % conf_value)
-
-        elif conf == "gpg-key":
-            options.append("-gpg-key=%s" % conf_value)
-        elif conf == "automatic-update":
-            # Ignored here
-            pass
-        elif conf == "snapshots":
-            if has_source:  # pragma: no cover
-                raise ValueError(
-                    "Multiple sources for publish %s %s"
-                    % (publish_name, publish_config)
-                )
-            has_source = True
-            snapshots = util.unit_or_list_to_list(conf_value)
-            source_args.append("snapshot")
-            source_args.extend(
-                [
-                    snapshot.snapshot_spec_to_name(cfg, conf_value)
-                    for conf_value in snapshots
-                ]
-            )
-
-            num_sources = len(snapshots)
-
-        elif conf == "repo":
-            if has_source:  # pragma: no cover
-                raise ValueError(
-                    "Multiple sources for publish %s %s"
-                    % (publish_name, publish_config)
-                )
-            has_source = True
-            source_args = ["repo", conf_value]
-            num_sources = 1
-        elif conf == "publish":
-            if has_source:  # pragma: no cover
-                raise ValueError(
-                    "Multiple sources for publish %s %s"
-                    % (publish_name, publish_config)
-                )
-            has_source = True
-            conf_value = " ".join(conf_value.split("/"))
-            source_args.append("snapshot")
-            try:
-                sources = state_reader.state_reader().publish_map()[conf_value]
-            except KeyError:
-                lg.critical(
-                    (
-                        "Creating %s has been deferred, please call publish "
-                        "create again"
-                    )
-                    % publish_name
-                )
-                return
-            source_args.extend(sources)
-            num_sources = len(sources)
-        else:  # pragma: no cover
-            raise ValueError(
-                "Don't know how to handle publish config entry %s in %s"
-                % (
-                    conf,
-                    publish_name,
-                )
+    if publish_config.skip_contents:
+        options.append("-skip-contents=true")
+    if publish_config.architectures is not None:  # pragma: no cover
+        options.append("-architectures=%s" % ",".join(publish_config.architectures))
+    components = publish_config.components
+    if components:
+        options.append("-component=%s" % ",".join(components))
+    if publish_config.label is not None:  # pragma: no cover
+        options.append("-label=%s" % publish_config.label)
+    if publish_config.origin is not None:  # pragma: no cover
+        options.append("-origin=%s" % publish_config.origin)
+    if publish_config.distribution is not None:
+        options.append("-distribution=%s" % publish_config.distribution)
+    if publish_config.gpg_key is not None:
+        options.append("-gpg-key=%s" % publish_config.gpg_key)
+
+    if publish_config.snapshots is not None:
+        source_args.append("snapshot")
+        source_args.extend(
+            [
+                snapshot.snapshot_spec_to_name(cfg, snap)
+                for snap in publish_config.snapshots
+            ]
+        )
+        num_sources = len(publish_config.snapshots)
+    elif publish_config.repo is not None:
+        source_args = ["repo", publish_config.repo]
+        num_sources = 1
+    elif publish_config.publish is not None:
+        source_args.append("snapshot")
+        try:
+            record = state_reader.state_reader().publish_records()[
+                "%s %s" % publish_config.publish
+            ]
+        except KeyError:
+            lg.critical(
+                ("Creating %s has been deferred, please call publish create again")
+                % publish_name
             )
-    assert has_source
+            return
+        sources = record.snapshots_for(components)
+        source_args.extend(sources)
+        num_sources = len(sources)
+    else:  # pragma: no cover
+        raise ValueError("No source configured for publish %s" % publish_name)
     assert len(components) == num_sources
 
     cmd = command.Command(publish_cmd + options + source_args + endpoint_args)
     cmd.provide("publish", publish_fullname)
+    if source_args[0] == "snapshot":
+        for snap in source_args[1:]:
+            cmd.require("snapshot", snap)
+    else:
+        cmd.require("repo", source_args[1])
     return cmd
@@ -0,0 +1,195 @@
+"""Detect if the Release file of a mirror changed upstream."""
+
+import concurrent.futures
+import hashlib
+import json
+import logging
+import os
+import threading
+
+lg = logging.getLogger(__name__)
+
+RELEASE_CACHE_VERSION = 1
+
+TIMEOUT = 5
+"""Timeout in seconds of the requests for Release files."""
+
+CHECK_JOBS = 16
+"""How many Release files :py:meth:`ReleaseCache.check_all` requests at once."""
+
+
+def release_urls(mirror_config):
+    """Return the URLs of the InRelease and Release file of a mirror.
+
+    :param mirror_config: Configuration of the mirror
+    :type  mirror_config: model.Mirror
+    :rtype:               list
+    """
+    archive = mirror_config.archive.rstrip("/")
+    distribution = mirror_config.distribution or ""
+    if distribution.endswith("/"):
+        # Flat repository
+        base = "%s/%s" % (archive, distribution.strip("/"))
+    else:
+        base = "%s/dists/%s" % (archive, distribution)
+    base = base.rstrip("/")
+    return ["%s/InRelease" % base, "%s/Release" % base]
+
+
+class ReleaseCache(object):
+    """Validators of the Release files of the mirrors, kept between runs.
+
+    For every mirror the URL, ETag, Last-Modified and sha256 of its Release
+    file are kept. The Release file is requested conditionally, if the server
+    answers "304 Not Modified" or the file has the same hash, the mirror did
+    not change upstream.
+
+    The validators of a changed Release file are staged by :py:meth:`check`
+    and only kept by :py:meth:`commit` once the mirror was updated, so a
+    failed update is tried again by the next run.
+
+    The result of a check is kept for the run, :py:meth:`check_all` checks
+    many mirrors at once, so slow upstreams do not add up.
+
+    :param path: Path of the cache file
+    :type  path: str
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.entries: dict[str, dict] = {}
+        self.staged: dict[str, dict] = {}
+        self.results: dict[str, bool] = {}
+        self._lock = threading.Lock()
+        try:
+            with open(path, encoding="UTF-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            lg.debug("No usable release cache in %s", path)
+            return
+        if data.get("version") == RELEASE_CACHE_VERSION:
+            self.entries = data["mirrors"]
+
+    def check(self, mirror_name, mirror_config):
+        """Return True if the Release file of the mirror did not change.
+
+        If the Release file can not be fetched, it is considered changed. The
+        validators of a changed Release file are staged.
+
+        :param   mirror_name: Name of the mirror
+        :type    mirror_name: str
+        :param mirror_config: Configuration of the mirror
+        :type  mirror_config: model.Mirror
+        :rtype:               bool
+        """
+        with self._lock:
+            if mirror_name in self.results:
+                return self.results[mirror_name]
+        result = self._check(mirror_name, mirror_config)
+        with self._lock:
+            return self.results.setdefault(mirror_name, result)
+
+    def check_all(self, mirrors):
+        """Check many mirrors at once, see :py:meth:`check`.
+
+        :param mirrors: name -> configuration of the mirrors
+        :type  mirrors: dict
+        """
+        with concurrent.futures.ThreadPoolExecutor(max_workers=CHECK_JOBS) as pool:
+            for name, mirror_config in mirrors.items():
+                pool.submit(self.check, name, mirror_config)
+
+    def _check(self, mirror_name, mirror_config):
+        import http.client
+        import urllib.error
+
+        if not mirror_config.archive:
+            return False
+        with self._lock:
+            cached = self.entries.get(mirror_name, {})
+        for url in release_urls(mirror_config):
+            try:
+                entry = self._fetch(url, cached if cached.get("url") == url else {})
+            except urllib.error.HTTPError as e:
+                if e.code == 404:
+                    continue
+                lg.info("Could not check %s for %s: %s", url, mirror_name, e)
+                return False
+            except (OSError, ValueError, http.client.HTTPException) as e:
+                lg.info("Could not check %s for %s: %s", url, mirror_name, e)
+                return False
+            if entry is None or entry == cached:
+                lg.info("Release of mirror %s did not change", mirror_name)
+                return True
+            with self._lock:
+                if cached.get("url") == url and entry["sha256"] == cached.get("sha256"):
+                    lg.info("Release of mirror %s did not change", mirror_name)
+                    self.entries[mirror_name] = entry
+                    return True
+                self.staged[mirror_name] = entry
+            return False
+        return False
+
+    @staticmethod
+    def _fetch(url, cached):
+        """Fetch a Release file, return its validators or None if unmodified."""
+        import urllib.error
+        import urllib.request
+
+        headers = {}
+        if cached.get("etag"):
+            headers["If-None-Match"] = cached["etag"]
+        if cached.get("last-modified"):
+            headers["If-Modified-Since"] = cached["last-modified"]
+        request = urllib.request.Request(url, headers=headers)
+        try:
+            with urllib.request.urlopen(request, timeout=TIMEOUT) as response:
+                body = response.read()
+                return {
+                    "url": url,
+                    "etag": response.headers.get("ETag"),
+                    "last-modified": response.headers.get("Last-Modified"),
+                    "sha256": hashlib.sha256(body).hexdigest(),
+                }
+        except urllib.error.HTTPError as e:
+            if e.code == 304:
+                return None
+            raise
+
+    def commit(self, mirror_name):
+        """Keep the staged validators of a mirror that was updated.
+
+        :param mirror_name: Name of the mirror
+        :type  mirror_name: str
+        """
+        if mirror_name in self.staged:
+            self.entries[mirror_name] = self.staged.pop(mirror_name)
+
+    def save(self):
+        """Save the cache."""
+        data = {"version": RELEASE_CACHE_VERSION, "mirrors": self.entries}
+        tmp_path = "%s.tmp" % self.path
+        with open(tmp_path, "w", encoding="UTF-8") as f:
+            json.dump(data, f)
+        os.replace(tmp_path, self.path)
+
+
+_cache: tuple[str, ReleaseCache] | None = None
+
+
+def release_cache(cfg):
+    """Return the release cache configured in `execution.release-cache`.
+
+    The cache is loaded once per path, None if it is not configured.
+
+    :param cfg: The configuration toml as dict
+    :type  cfg: dict
+    :rtype:     ReleaseCache
+    """
+    global _cache
+    path = cfg.get("execution", {}).get("release-cache")
+    if not path:
+        return None
+    if _cache is None or _cache[0] != path:
+        _cache = (path, ReleaseCache(path))
+    return _cache[1]
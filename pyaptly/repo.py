@@ -2,7 +2,7 @@
 
 import logging
 
-from . import command, state_reader, util
+from . import command, executor, model, state_reader
 
 lg = logging.getLogger(__name__)
 
@@ -15,7 +15,8 @@ def repo(cfg, args):
     :param args: The command-line arguments read with :py:mod:`argparse`
     :type  args: namespace
     """
-    lg.debug("Repositories to create: %s", cfg["repo"])
+    repos = model.config(cfg).repos
+    lg.debug("Repositories to create: %s", repos)
 
     repo_cmds = {
         "create": repo_cmd_create,
@@ -26,21 +27,15 @@ def repo(cfg, args):
     if args.repo_name == "all":
         commands = [
             cmd_repo(cfg, repo_name, repo_conf)
-            for repo_name, repo_conf in cfg["repo"].items()
+            for repo_name, repo_conf in repos.items()
         ]
 
-        for cmd in command.Command.order_commands(
-            commands, state_reader.state_reader().has_dependency
-        ):
-            cmd.execute()
+        executor.execute_commands(cfg, args, commands)
 
     else:
-        if args.repo_name in cfg["repo"]:
-            commands = [cmd_repo(cfg, args.repo_name, cfg["repo"][args.repo_name])]
-            for cmd in command.Command.order_commands(
-                commands, state_reader.state_reader().has_dependency
-            ):
-                cmd.execute()
+        if args.repo_name in repos:
+            commands = [cmd_repo(cfg, args.repo_name, repos[args.repo_name])]
+            executor.execute_commands(cfg, args, commands)
         else:
             raise ValueError(
                 "Requested publish is not defined in config file: %s" % (args.repo_name)
@@ -54,8 +49,8 @@ def repo_cmd_create(cfg, repo_name, repo_config):
     :type          cfg: dict
     :param   repo_name: Name of the repo to create
     :type    repo_name: str
-    :param repo_config: Configuration of the repo from the toml file.
-    :type  repo_config: dict
+    :param repo_config: Configuration of the repo
+    :type  repo_config: model.Repo
     """
     if repo_name in state_reader.state_reader().repos():  # pragma: no cover
         # Nothing to do, repo already created
@@ -65,26 +60,14 @@ def repo_cmd_create(cfg, repo_name, repo_config):
     options = []
     endpoint_args = ["create", repo_name]
 
-    for conf, conf_value in repo_config.items():
-        if conf == "architectures":
-            options.append(
-                "-architectures=%s" % ",".join(util.unit_or_list_to_list(conf_value))
-            )
-        elif conf == "component":
-            components = util.unit_or_list_to_list(conf_value)
-            options.append("-component=%s" % ",".join(components))
-        elif conf == "comment":  # pragma: no cover
-            options.append("-comment=%s" % conf_value)
-        elif conf == "distribution":
-            options.append("-distribution=%s" % conf_value)
-        else:  # pragma: no cover
-            raise ValueError(
-                "Don't know how to handle repo config entry %s in %s"
-                % (
-                    conf,
-                    repo_name,
-                )
-            )
+    if repo_config.architectures is not None:
+        options.append("-architectures=%s" % ",".join(repo_config.architectures))
+    if repo_config.components is not None:
+        options.append("-component=%s" % ",".join(repo_config.components))
+    if repo_config.comment is not None:  # pragma: no cover
+        options.append("-comment=%s" % repo_config.comment)
+    if repo_config.distribution is not None:
+        options.append("-distribution=%s" % repo_config.distribution)
 
     cmd = command.Command(repo_cmd + options + endpoint_args)
     cmd.provide("repo", repo_name)
@@ -1,18 +1,25 @@
 """Create and update snapshots in aptly."""
 
+import collections
 import datetime
+import functools
 import logging
+import re
 from typing import Optional
 
-from . import command, date_tools, publish, state_reader, types
+from . import (
+    backend,
+    command,
+    date_tools,
+    executor,
+    model,
+    publish,
+    state_reader,
+    types,
+)
 
 lg = logging.getLogger(__name__)
 
-back_reference_map = {
-    "current": 0,
-    "previous": 1,
-}
-
 
 def snapshot(cfg, args):
     """Create snapshot commands, orders and executes them.
@@ -22,18 +29,25 @@ def snapshot(cfg, args):
     :param args: The command-line arguments read with :py:mod:`argparse`
     :type  args: namespace
     """
-    lg.debug("Snapshots to create: %s", cfg["snapshot"].keys())
+    snapshots = model.config(cfg).snapshots
+    lg.debug("Snapshots to create: %s", snapshots.keys())
 
     cmd_snapshot: types.SnapshotCommand = cmd_snapshot_update
     if args.task == "create":
         cmd_snapshot = cmd_snapshot_create
 
     if args.snapshot_name == "all":
+        if args.task == "update":
+            # Read the merge-tree of all snapshots to update at once
+            state_reader.state_reader().snapshot_map().prefetch(snapshots)
         commands = [
             cmd
-            for snapshot_name, snapshot_config in cfg["snapshot"].items()
+            for snapshot_name, snapshot_config in snapshots.items()
             for cmd in cmd_snapshot(cfg, snapshot_name, snapshot_config)
         ]
+        commands.extend(cmd_cleanup_rotated(cfg, commands))
+        commands.extend(cmd_snapshot_gc(cfg, commands))
+        publish.defer_cleanup(commands)
 
         if args.debug:  # pragma: no cover
             dot_file = "/tmp/commands.dot"
@@ -42,22 +56,21 @@ def snapshot(cfg, args):
             lg.info("Wrote command dependency tree graph to %s", dot_file)
 
         if len(commands) > 0:
-            for cmd in command.Command.order_commands(
-                commands, state_reader.state_reader().has_dependency
-            ):
-                cmd.execute()
+            executor.execute_commands(cfg, args, commands)
 
     else:
-        if args.snapshot_name in cfg["snapshot"]:
+        if args.snapshot_name in snapshots:
             commands = cmd_snapshot(
-                cfg, args.snapshot_name, cfg["snapshot"][args.snapshot_name]
+                cfg, args.snapshot_name, snapshots[args.snapshot_name]
+            )
+            commands.extend(cmd_cleanup_rotated(cfg, commands))
+            commands.extend(
+                cmd_snapshot_gc(cfg, commands, snapshot_names=[args.snapshot_name])
             )
+            publish.defer_cleanup(commands)
 
             if len(commands) > 0:
-                for cmd in command.Command.order_commands(
-                    commands, state_reader.state_reader().has_dependency
-                ):
-                    cmd.execute()
+                executor.execute_commands(cfg, args, commands)
 
         else:
             raise ValueError(
@@ -82,43 +95,77 @@ def snapshot_spec_to_name(cfg, snapshot):
     For further information regarding the timestamp's data structure,
     consult the documentation of expand_timestamped_name().
 
+    The spec may also be a compiled :py:class:`model.SnapshotRef`.
+
     :param      cfg: Complete yaml config
     :type       cfg: dict
     :param snapshot: Config of the snapshot
     :type  snapshot: dict
     """
-    delta = datetime.timedelta(seconds=1)
-    if hasattr(snapshot, "items"):
-        name = snapshot["name"]
-        if "timestamp" not in snapshot:
-            return name
-
-        ts = snapshot["timestamp"]
-        back_ref = back_reference_map.get(ts)
-        if back_ref is None:
-            back_ref = int(ts)
-        reference = cfg["snapshot"][name]
-
-        timestamp = datetime.datetime.now()
-        for _ in range(back_ref + 1):
-            timestamp = date_tools.round_timestamp(reference["timestamp"], timestamp)
-            timestamp -= delta
-
-        timestamp += delta
-        return name.replace("%T", date_tools.format_timestamp(timestamp))
-    else:  # pragma: no cover
-        return snapshot
+    return model.config(cfg).snapshot_name(snapshot)
 
 
 def dependents_of_snapshot(snapshot_name):
-    """Yield a flat list of dependents from the current state_reader.state.
+    """Return a flat list of dependents from the current state_reader.state.
+
+    See :py:meth:`SnapshotMap.dependents`.
+
+    :rtype: tuple
+    """
+    return state_reader.state_reader().snapshot_map().dependents(snapshot_name)
+
 
-    :rtype: generator
+def snapshot_unchanged(cfg, snapshot_name, changing=frozenset()):
+    """Return True if recreating a snapshot would not change its content.
+
+    A snapshot of a mirror or repo is unchanged if it has the same packages as
+    the mirror or repo. A merged snapshot is unchanged if it was merged from
+    the snapshots the config refers to now and those are unchanged.
+    Timestamped and unconfigured sources never change once they exist.
+    Filtered snapshots are always rebuilt, the query may have changed.
+
+    :param           cfg: pyaptly config
+    :type            cfg: dict
+    :param snapshot_name: Name of the snapshot
+    :type  snapshot_name: str
+    :param      changing: Mirrors and repos as (type, name), that are changed
+                          in this run before the snapshot is recreated
+    :type       changing: set
+    :rtype:               bool
     """
-    for dependent in state_reader.state_reader().snapshot_map().get(snapshot_name, []):
-        yield dependent
-        # TODO I fixed a bug, but there is no test. We do not test recursive dependants
-        yield from dependents_of_snapshot(dependent)
+    snapshots = model.config(cfg).snapshots
+    snapshot_map = state_reader.state_reader().snapshot_map()
+    packages = functools.lru_cache(maxsize=None)(backend.backend().packages)
+
+    def unchanged(name):
+        snapshot_config = snapshots.get(name)
+        if snapshot_config is None or "%T" in name:
+            return True
+        if name not in state_reader.state_reader().snapshots():
+            return False
+        for type_, source in [
+            ("mirror", snapshot_config.mirror),
+            ("repo", snapshot_config.repo),
+        ]:
+            if source is not None:
+                if (type_, source) in changing:
+                    return False
+                return packages(type_, source) == packages("snapshot", name)
+        if snapshot_config.merge is None:
+            return False
+        sources = [
+            (source, snapshot_spec_to_name(cfg, source))
+            for source in snapshot_config.merge
+        ]
+        if set(name for _, name in sources) != snapshot_map[name]:
+            return False
+        return all(
+            unchanged(source_name)
+            for source, source_name in sources
+            if source.back_reference is None
+        )
+
+    return unchanged(snapshot_name)
 
 
 def rotate_snapshot(cfg, snapshot_name):
@@ -131,11 +178,12 @@ def rotate_snapshot(cfg, snapshot_name):
     :param snapshot_name: the snapshot to rotate
     :type  snapshot_name: str
     """
-    rotated_name = cfg["snapshot"][snapshot_name].get(
-        "rotate_via",
-        "%s-rotated-%s"
-        % (snapshot_name, date_tools.format_timestamp(datetime.datetime.now())),
-    )
+    rotated_name = model.config(cfg).snapshots[snapshot_name].rotate_via
+    if rotated_name is None:
+        rotated_name = "%s-rotated-%s" % (
+            snapshot_name,
+            date_tools.format_timestamp(datetime.datetime.now()),
+        )
 
     # First, verify that our snapshot environment is in a sane state_reader.state.
     # Fixing the environment is not currently our task.
@@ -152,16 +200,26 @@ def rotate_snapshot(cfg, snapshot_name):
 
 
 def cmd_snapshot_update(
-    cfg: dict, snapshot_name: str, snapshot_config: dict
+    cfg: dict,
+    snapshot_name: str,
+    snapshot_config: model.Snapshot,
+    changing: frozenset[tuple[str, str]] = frozenset(),
 ) -> list[command.Command]:
     """Create commands to update all rotating snapshots.
 
+    With `skip-unchanged` in the `execution` section, the snapshot, its
+    dependents and their publishes are left untouched, if recreating the
+    snapshot would not change it (see :py:func:`snapshot_unchanged`).
+
     :param             cfg: pyaptly config
     :type              cfg: dict
     :param   snapshot_name: Name of the snapshot to update/rotate
     :type    snapshot_name: str
-    :param snapshot_config: Configuration of the snapshot from the toml file.
-    :type  snapshot_config: dict
+    :param snapshot_config: Configuration of the snapshot
+    :type  snapshot_config: model.Snapshot
+    :param        changing: Mirrors and repos as (type, name), that are changed
+                            in this run before the snapshot is recreated
+    :type         changing: frozenset
     """
     # To update a snapshot, we need to do roughly the following steps:
     # 1) Rename the current snapshot and all snapshots that depend on it
@@ -174,8 +232,15 @@ def cmd_snapshot_update(
         # Timestamped snapshots are never rotated by design.
         return []
 
+    if model.config(cfg).execution.get("skip-unchanged") and snapshot_unchanged(
+        cfg, snapshot_name, changing
+    ):
+        lg.info("Snapshot %s is up to date, not rotating it", snapshot_name)
+        return []
+
+    dependents = dependents_of_snapshot(snapshot_name)
     affected_snapshots = [snapshot_name]
-    affected_snapshots.extend(list(dependents_of_snapshot(snapshot_name)))
+    affected_snapshots.extend(dependents)
 
     # TODO: rotated snapshots should be identified by configuration option, not
     # just by "not being timestamped"
@@ -208,7 +273,7 @@ def cmd_snapshot_update(
         # of assuming it's going to be a single entry (and fail horribly if
         # this assumption changes in the future).
         for create_cmd in cmd_snapshot_create(
-            cfg, snapshot_name, cfg["snapshot"][snapshot_name], ignore_existing=True
+            cfg, snapshot_name, snapshot_config, ignore_existing=True
         ):
             # enforce cmd to run after the refresh, and thus also
             # after all the renames
@@ -225,7 +290,7 @@ def cmd_snapshot_update(
             )
 
             create_cmd.provide("virtual", "readyness-for-%s" % snapshot_name)
-            for follower in dependents_of_snapshot(snapshot_name):
+            for follower in dependents:
                 create_cmd.require("virtual", "readyness-for-%s" % follower)
 
             # "Focal point" - make intermediate2 run after all the commands
@@ -239,39 +304,21 @@ def cmd_snapshot_update(
     # After each of the steps, the system state has been re-read.
     # So now, we're left with updating the publishes.
 
-    def is_publish_affected(name, publish_info):
-        if (
-            "%s %s" % (name, publish_info["distribution"])
-            in state_reader.state_reader().publishes()
-        ):
-            try:
-                for snap in publish_info["snapshots"]:
-                    snap_name = snapshot_spec_to_name(cfg, snap)
-                    if snap_name in affected_snapshots:
-                        return True
-            except KeyError:  # pragma: no cover
-                lg.debug(
-                    (
-                        "publish_info endpoint %s is not affected because it has no "
-                        "snapshots defined"
-                    )
-                    % name
+    # Look up the publishes of the affected snapshots, in config order
+    entries, index = publish.snapshot_publish_index(cfg)
+    positions = set()
+    for snap in affected_snapshots:
+        positions.update(index.get(snap, []))
+    publishes = state_reader.state_reader().publishes()
+    all_publish_commands = []
+    for position in sorted(positions):
+        publish_entry = entries[position]
+        if publish_entry.automatic_update and publish_entry.fullname in publishes:
+            all_publish_commands.append(
+                publish.publish_cmd_update(
+                    cfg, publish_entry.name, publish_entry, ignore_existing=True
                 )
-                return False
-        return False
-
-    if "publish" in cfg:
-        all_publish_commands = [
-            publish.publish_cmd_update(
-                cfg, publish_name, publish_conf_entry, ignore_existing=True
             )
-            for publish_name, publish_conf in cfg["publish"].items()
-            for publish_conf_entry in publish_conf
-            if publish_conf_entry.get("automatic-update", "false") is True
-            if is_publish_affected(publish_name, publish_conf_entry)
-        ]
-    else:
-        all_publish_commands = []
 
     republish_cmds = [c for c in all_publish_commands if c]
 
@@ -280,17 +327,248 @@ def cmd_snapshot_update(
         cmd.require("virtual", "all-snapshots-rebuilt")
 
     # TODO:
-    # - We need to cleanup all the rotated snapshots after the publishes are
-    #   rebuilt
     # - Filter publishes, so only the non-timestamped publishes are rebuilt
 
     return rename_cmds + create_cmds + republish_cmds + [intermediate, intermediate2]
 
 
+def cmd_cleanup_rotated(cfg, commands):
+    """Create commands to drop the snapshots rotated by the commands of a run.
+
+    Configured with `cleanup-rotated` in the `execution` section. The drops run
+    after all other commands, as one phase, so a snapshot rotated by several
+    updates is dropped once.
+
+    A rotated snapshot is kept if a publish that is not switched still refers
+    to it, or if it is a source of an existing snapshot that is not dropped
+    (ie. an archived clone or another merge). Snapshots with `rotate_via` are
+    always kept. Dependents are dropped before their sources, aptly does not
+    drop a source.
+
+    :param      cfg: pyaptly config
+    :type       cfg: dict
+    :param commands: The other commands of the run
+    :type  commands: list
+    :rtype:          list
+    """
+    config = model.config(cfg)
+    if not config.execution.get("cleanup-rotated"):
+        return []
+    # snapshot -> name it is rotated to
+    rotated: dict[str, str] = {}
+    switched: set[str] = set()
+    for cmd in commands:
+        if tuple(cmd.cmd[1:3]) == ("snapshot", "rename"):
+            rotated.setdefault(cmd.cmd[3], cmd.cmd[4])
+        switched.update(
+            name for type_, name in cmd.get_provides() if type_ == "publish"
+        )
+    if not rotated:
+        return []
+
+    reader = state_reader.state_reader()
+    existing = reader.snapshots()
+    snapshot_map = reader.snapshot_map()
+    snapshot_map.prefetch(existing)
+    keep = set(
+        snapshot
+        for snapshot in rotated
+        if snapshot in config.snapshots
+        and config.snapshots[snapshot].rotate_via is not None
+    )
+    for publish_name, published in reader.publish_map().items():
+        if publish_name not in switched:
+            keep.update(snapshot for snapshot in rotated if snapshot in published)
+    # The sources of every snapshot that is not dropped have to be kept
+    changed = True
+    while changed:
+        changed = False
+        for snapshot in existing:
+            if snapshot in rotated and snapshot not in keep:
+                continue
+            for source in snapshot_map.get(snapshot, ()):
+                if source in rotated and source not in keep:
+                    keep.add(source)
+                    changed = True
+
+    dropped = [snapshot for snapshot in rotated if snapshot not in keep]
+    for snapshot in rotated:
+        if snapshot in keep:
+            lg.info("Keeping %s, it is still referenced", rotated[snapshot])
+    if not dropped:
+        return []
+
+    ready = command.DummyCommand("rotated-snapshots-droppable")
+    ready.provide("virtual", "rotated-snapshots-droppable")
+    for cmd in commands:
+        for provide in cmd.get_provides():
+            ready.require(*provide)
+
+    drop_cmds: list[command.Command] = [ready]
+    for snapshot in dropped:
+        cmd = command.Command(["aptly", "snapshot", "drop", rotated[snapshot]])
+        cmd.require("virtual", "rotated-snapshots-droppable")
+        cmd.provide("virtual", "dropped-%s" % rotated[snapshot])
+        for dependent in dropped:
+            if snapshot in snapshot_map.get(dependent, ()):
+                cmd.require("virtual", "dropped-%s" % rotated[dependent])
+        drop_cmds.append(cmd)
+    return drop_cmds
+
+
+def retained_snapshots(cfg, snapshot_name, snapshot_config, existing, date=None):
+    """Return the existing snapshots of a timestamped snapshot and if they are
+    retained.
+
+    A snapshot is retained if it is one of the last "keep" periods of the
+    timestamp (see :py:func:`date_tools.round_timestamp`) or if it is younger
+    than "max-age" days.
+
+    :param             cfg: pyaptly config
+    :type              cfg: dict
+    :param   snapshot_name: Name of the snapshot, containing %T
+    :type    snapshot_name: str
+    :param snapshot_config: Configuration of the snapshot
+    :type  snapshot_config: model.Snapshot
+    :param        existing: Names of the existing snapshots
+    :type         existing: iterable
+    :param            date: The current date, default now
+    :type             date: :py:class:`datetime.datetime`
+    :rtype:                 dict of name -> bool
+    """
+    date = date or datetime.datetime.now()
+    retention = snapshot_config.retention or {}
+    config = model.config(cfg)
+    kept_periods = set(
+        config.snapshot_name(model.SnapshotRef(snapshot_name, back), date)
+        for back in range(retention.get("keep", 0))
+    )
+    prefix, _, suffix = snapshot_name.partition("%T")
+    pattern = re.compile(
+        "%s(%s)%s"
+        % (re.escape(prefix), date_tools.re_timestamp.pattern, re.escape(suffix))
+    )
+    retained = {}
+    for name in existing:
+        match = pattern.fullmatch(name)
+        if match is None:
+            continue
+        keep = name in kept_periods
+        if "max-age" in retention:
+            timestamp = datetime.datetime.strptime(match.group(1), "%Y%m%dT%H%MZ")
+            age = datetime.timedelta(days=retention["max-age"])
+            keep = keep or timestamp > date - age
+        retained[name] = keep
+    return retained
+
+
+def cmd_snapshot_gc(cfg, commands=(), snapshot_names=None, date=None):
+    """Create commands to drop the timestamped snapshots that are not retained.
+
+    The snapshots are reference counted: every publish and every snapshot
+    merged or filtered from a snapshot counts as a reference, so does a
+    reference in the config and every command of this run requiring the
+    snapshot. Only snapshots without references are dropped, dropping a
+    snapshot releases its sources.
+
+    The drops run after all other commands, as one phase: they only wait for
+    the dropped snapshots created from them, so a batched run drops them in
+    few `aptly task run` calls.
+
+    :param            cfg: pyaptly config
+    :type             cfg: dict
+    :param       commands: The other commands of the run
+    :type        commands: list
+    :param snapshot_names: Names of the snapshots to collect, default all
+    :type  snapshot_names: iterable
+    :param           date: The current date, default now
+    :type            date: :py:class:`datetime.datetime`
+    :rtype:                list
+    """
+    config = model.config(cfg)
+    collected = [
+        (name, snapshot_config)
+        for name, snapshot_config in config.snapshots.items()
+        if snapshot_config.retention
+        and "%T" in name
+        and (snapshot_names is None or name in snapshot_names)
+    ]
+    if not collected:
+        return []
+    reader = state_reader.state_reader()
+    existing = reader.snapshots()
+    candidates: set[str] = set()
+    for name, snapshot_config in collected:
+        retained = retained_snapshots(cfg, name, snapshot_config, existing, date)
+        candidates.update(snapshot for snapshot, keep in retained.items() if not keep)
+    if not candidates:
+        return []
+
+    snapshot_map = reader.snapshot_map()
+    snapshot_map.prefetch(existing)
+    references: collections.Counter = collections.Counter()
+    for snapshot in existing:
+        references.update(snapshot_map.get(snapshot, ()))
+    for published in reader.publish_map().values():
+        references.update(published)
+    for ref in config_snapshot_refs(config):
+        references[config.snapshot_name(ref, date)] += 1
+    for cmd in commands:
+        references.update(name for type_, name in cmd._requires if type_ == "snapshot")
+
+    dropped: list[str] = []
+    unreferenced = sorted(name for name in candidates if not references[name])
+    while unreferenced:
+        snapshot = unreferenced.pop(0)
+        dropped.append(snapshot)
+        for source in snapshot_map.get(snapshot, ()):
+            references[source] -= 1
+            if source in candidates and not references[source]:
+                unreferenced.append(source)
+    for snapshot in sorted(candidates - set(dropped)):
+        lg.info("Keeping %s, it is still referenced", snapshot)
+    if not dropped:
+        return []
+
+    ready = command.DummyCommand("snapshots-collectable")
+    ready.provide("virtual", "snapshots-collectable")
+    for cmd in commands:
+        for provide in cmd.get_provides():
+            ready.require(*provide)
+
+    gc_cmds: list[command.Command] = [ready]
+    for snapshot in dropped:
+        cmd = command.Command(["aptly", "snapshot", "drop", snapshot])
+        cmd.require("virtual", "snapshots-collectable")
+        cmd.provide("virtual", "dropped-%s" % snapshot)
+        for dependent in dropped:
+            if snapshot in snapshot_map.get(dependent, ()):
+                cmd.require("virtual", "dropped-%s" % dependent)
+        gc_cmds.append(cmd)
+    return gc_cmds
+
+
+def config_snapshot_refs(config):
+    """Return the snapshot references of the publishes, merges and filters.
+
+    :param config: The compiled config
+    :type  config: model.Config
+    :rtype:        list of :py:class:`model.SnapshotRef`
+    """
+    refs: list[model.SnapshotRef] = []
+    for publish_entry in config.entries:
+        refs.extend(publish_entry.snapshots or ())
+    for snapshot_config in config.snapshots.values():
+        refs.extend(snapshot_config.merge or ())
+        if snapshot_config.filter is not None:
+            refs.append(snapshot_config.filter[0])
+    return refs
+
+
 def cmd_snapshot_create(
     cfg: dict,
     snapshot_name: str,
-    snapshot_config: dict,
+    snapshot_config: model.Snapshot,
     ignore_existing: Optional[bool] = False,
 ) -> list[command.Command]:
     """Create a snapshot create command to be ordered and executed later.
@@ -299,8 +577,8 @@ def cmd_snapshot_create(
     :type              cfg: dict
     :param   snapshot_name: Name of the snapshot to create
     :type    snapshot_name: str
-    :param snapshot_config: Configuration of the snapshot from the toml file.
-    :type  snapshot_config: dict
+    :param snapshot_config: Configuration of the snapshot
+    :type  snapshot_config: model.Snapshot
     :param ignore_existing: Optional, defaults to False. If set to True, still
                             return a command object even if the requested
                             snapshot already exists
@@ -311,7 +589,9 @@ def cmd_snapshot_create(
     # TODO: extract possible timestamp component
     # and generate *actual* snapshot name
 
-    snapshot_name = date_tools.expand_timestamped_name(snapshot_name, snapshot_config)
+    snapshot_name = date_tools.expand_timestamped_name(
+        snapshot_name, snapshot_config.timestamp or {}
+    )
 
     if snapshot_name in state_reader.state_reader().snapshots() and not ignore_existing:
         return []
@@ -320,36 +600,36 @@ def cmd_snapshot_create(
     default_aptly_cmd.append(snapshot_name)
     default_aptly_cmd.append("from")
 
-    if "mirror" in snapshot_config:
-        cmd = command.Command(default_aptly_cmd + ["mirror", snapshot_config["mirror"]])
+    if snapshot_config.mirror is not None:
+        cmd = command.Command(default_aptly_cmd + ["mirror", snapshot_config.mirror])
         cmd.provide("snapshot", snapshot_name)
-        cmd.require("mirror", snapshot_config["mirror"])
+        cmd.require("mirror", snapshot_config.mirror)
         return [cmd]
 
-    elif "repo" in snapshot_config:
-        cmd = command.Command(default_aptly_cmd + ["repo", snapshot_config["repo"]])
+    elif snapshot_config.repo is not None:
+        cmd = command.Command(default_aptly_cmd + ["repo", snapshot_config.repo])
         cmd.provide("snapshot", snapshot_name)
-        cmd.require("repo", snapshot_config["repo"])
+        cmd.require("repo", snapshot_config.repo)
         return [cmd]
 
-    elif "filter" in snapshot_config:
+    elif snapshot_config.filter is not None:
+        source, query = snapshot_config.filter
+        source_name = snapshot_spec_to_name(cfg, source)
         cmd = command.Command(
             [
                 "aptly",
                 "snapshot",
                 "filter",
-                snapshot_spec_to_name(cfg, snapshot_config["filter"]["source"]),
+                source_name,
                 snapshot_name,
-                snapshot_config["filter"]["query"],
+                query,
             ]
         )
         cmd.provide("snapshot", snapshot_name)
-        cmd.require(
-            "snapshot", snapshot_spec_to_name(cfg, snapshot_config["filter"]["source"])
-        )
+        cmd.require("snapshot", source_name)
         return [cmd]
 
-    elif "merge" in snapshot_config:
+    elif snapshot_config.merge is not None:
         cmd = command.Command(
             [
                 "aptly",
@@ -360,7 +640,7 @@ def cmd_snapshot_create(
         )
         cmd.provide("snapshot", snapshot_name)
 
-        for source in snapshot_config["merge"]:
+        for source in snapshot_config.merge:
             source_name = snapshot_spec_to_name(cfg, source)
             cmd.append(source_name)
             cmd.require("snapshot", source_name)
@@ -1,49 +1,406 @@
 """The state reader helps to find the delta between current and target state."""
 
+import collections.abc
+import functools
+import hashlib
+import json
 import logging
-import re
+import os
+import threading
 from functools import lru_cache
+from pathlib import Path
+from typing import Any
 
-from . import util
+from . import backend, util
 
 lg = logging.getLogger(__name__)
 
 
+CACHE_VERSION = 1
+"""Version of the on-disk state cache format."""
+
+APTLY_CONFIGS = ("~/.aptly.conf", "/usr/local/etc/aptly.conf", "/etc/aptly.conf")
+"""Config files of aptly in the order aptly searches them."""
+
+
+def aptly_fingerprint():
+    """Return a fingerprint of the aptly database and the gpg trusted keys.
+
+    The fingerprint is made of the aptly config and the name, size and mtime of
+    every file in the database directory and of the trusted keyring. Return
+    None if the database can not be found.
+
+    :rtype: str
+    """
+    for config in APTLY_CONFIGS:
+        config_path = Path(config).expanduser()
+        if config_path.is_file():
+            break
+    else:
+        return None
+    content = config_path.read_bytes()
+    try:
+        root_dir = json.loads(content)["rootDir"]
+    except (ValueError, KeyError):
+        return None
+    db = Path(root_dir).expanduser() / "db"
+    if not db.is_dir():
+        return None
+    gnupg = Path(os.environ.get("GNUPGHOME", "~/.gnupg")).expanduser()
+    paths = sorted(db.iterdir())
+    paths.extend(gnupg / keyring for keyring in ("trustedkeys.gpg", "trustedkeys.kbx"))
+    digest = hashlib.sha256(content)
+    for path in paths:
+        try:
+            stat = path.stat()
+        except FileNotFoundError:
+            continue
+        digest.update(
+            ("%s %s %s\n" % (path, stat.st_size, stat.st_mtime_ns)).encode("UTF-8")
+        )
+    return digest.hexdigest()
+
+
+persistent_methods: set[str] = set()
+"""Names of the state reading methods kept in the on-disk cache."""
+
+
+def persistent(func):
+    """Remember the result of a state reading method for the on-disk cache.
+
+    If the state was loaded from the cache, the loaded value is returned once,
+    the next call (after the lru_cache was cleared) reads the state again. The
+    state is read holding the lock of the reader, commands executed by other
+    threads update the state meanwhile.
+    """
+
+    @functools.wraps(func)
+    def wrapper(self):
+        name = func.__name__
+        with self._lock:
+            if name in self._loaded:
+                value = self._loaded.pop(name)
+                lg.debug("Using %s from the state cache", name)
+            else:
+                value = func(self)
+            self._known[name] = value
+            return value
+
+    persistent_methods.add(func.__name__)
+    return wrapper
+
+
 class SystemStateReader(object):
     """Reads the state from aptly and gpg.
 
     To find out what operations have to be performed to reach the state defined
     in the toml config-file.
     Functions are cached and execution commands clear the cache of functions which need to be rerun
+
+    With :py:meth:`load_cache` the state is also kept on disk between runs. It
+    is only used if the aptly database was not changed since it was saved, see
+    :py:func:`aptly_fingerprint`.
     """
 
     known_dependency_types = ("repo", "snapshot", "mirror", "gpg_key")
 
-    def _extract_sources(self, data):
-        """Extract sources from data.
+    # The cached methods holding the state of each dependency type
+    _cached_methods = {
+        "mirror": ("mirrors",),
+        "snapshot": ("snapshots", "snapshot_map"),
+        "repo": ("repos",),
+        "publish": ("publish_records", "publishes", "publish_map"),
+        "gpg_key": ("gpg_keys",),
+    }
+
+    def __init__(self):
+        self.cache_path = None
+        self._loaded: dict[str, Any] = {}
+        self._known: dict[str, Any] = {}
+        self._written: set[str] = set()
+        self._lock = threading.RLock()
+
+    def invalidate(self, type_):
+        """Forget the state of a dependency type, it is read again when needed.
+
+        :param type_: The type of the dependency ie. snapshot
+        :type  type_: str
+        """
+        with self._lock:
+            for name in self._cached_methods[type_]:
+                getattr(self, name).cache_clear()
+                self._loaded.pop(name, None)
+                self._known.pop(name, None)
+
+    def _cached(self, name):
+        """Return the state of a cached method if it is known, else None."""
+        if name in self._known:
+            return self._known[name]
+        return self._loaded.get(name)
+
+    def apply_command(self, cmd):
+        """Apply the effect of a successful aptly command to the cached state.
+
+        Only state that was already read is updated, so no full re-read is
+        needed after the command. Return False if the effect of the command is
+        not known, the caller has to invalidate the state it changed then.
+
+        :param cmd: The command as list, one item per argument
+        :type  cmd: list
+        """
+        options = {}
+        args = []
+        for argument in cmd[1:]:
+            if argument.startswith("-"):
+                key, _, value = argument.lstrip("-").partition("=")
+                options[key] = value
+            else:
+                args.append(argument)
+        with self._lock:
+            match args:
+                case ["mirror", "update", _] | ["publish", "update", _, _]:
+                    pass
+                case ["db", "cleanup"]:
+                    pass
+                case ["mirror", "create", name, *_]:
+                    self._add("mirror", "mirrors", name)
+                case ["repo", "create", name]:
+                    self._add("repo", "repos", name)
+                case ["snapshot", "create", name, "from", "mirror" | "repo", _]:
+                    self._add_snapshot(name, set())
+                case ["snapshot", "merge", name, *sources] if sources:
+                    self._add_snapshot(name, set(sources))
+                case ["snapshot", "filter", source, name, _]:
+                    self._add_snapshot(name, set([source]))
+                case ["snapshot", "rename", name, new_name]:
+                    self._rename_snapshot(name, new_name)
+                case ["snapshot", "drop", name]:
+                    self._drop_snapshot(name)
+                case ["publish", "switch", distribution, prefix, *snapshots]:
+                    return self._switch_publish(
+                        prefix, distribution, options.get("component"), snapshots
+                    )
+                case ["publish", "snapshot" | "repo" as kind, *sources, prefix]:
+                    return self._create_publish(prefix, kind, options, sources)
+                case _:
+                    return False
+        return True
+
+    def _add(self, type_, name, item):
+        state = self._cached(name)
+        if state is not None:
+            state.add(item)
+            self._written.add(type_)
+
+    def _add_snapshot(self, snapshot, sources):
+        self._add("snapshot", "snapshots", snapshot)
+        snapshot_map = self._cached("snapshot_map")
+        if snapshot_map is not None:
+            snapshot_map.set_sources(snapshot, sources)
+            self._written.add("snapshot")
+
+    def _rename_snapshot(self, snapshot, new_name):
+        snapshots = self._cached("snapshots")
+        if snapshots is not None:
+            snapshots.discard(snapshot)
+            snapshots.add(new_name)
+            self._written.add("snapshot")
+        snapshot_map = self._cached("snapshot_map")
+        if snapshot_map is not None:
+            snapshot_map.rename(snapshot, new_name)
+            self._written.add("snapshot")
+        # aptly references snapshots by id, publishes follow the rename
+        records = self._cached("publish_records")
+        if records is not None:
+            for record in records.values():
+                if record.source_kind == "snapshot":
+                    record.sources = [
+                        (component, new_name if name == snapshot else name)
+                        for component, name in record.sources
+                    ]
+            self._publishes_changed()
+
+    def _drop_snapshot(self, snapshot):
+        snapshots = self._cached("snapshots")
+        if snapshots is not None:
+            snapshots.discard(snapshot)
+            self._written.add("snapshot")
+        snapshot_map = self._cached("snapshot_map")
+        if snapshot_map is not None:
+            snapshot_map.discard(snapshot)
+            self._written.add("snapshot")
+
+    def _switch_publish(self, prefix, distribution, components, snapshots):
+        records = self._cached("publish_records")
+        if records is None:
+            return True
+        record = records.get(backend.publish_name(prefix, distribution))
+        if components is None:
+            components = record.components if record else []
+        else:
+            components = components.split(",")
+        if record is None or len(components) != len(snapshots):
+            return False
+        by_component = dict(record.sources)
+        by_component.update(zip(components, snapshots))
+        record.sources = sorted(by_component.items())
+        self._publishes_changed()
+        return True
+
+    def _create_publish(self, prefix, kind, options, sources):
+        records = self._cached("publish_records")
+        if records is None:
+            return True
+        components = options.get("component", "main").split(",")
+        if "distribution" not in options or len(components) != len(sources):
+            return False
+        storage = ""
+        if ":" in prefix:
+            storage, prefix = prefix.rsplit(":", 1)
+        record = backend.PublishRecord(
+            prefix or ".",
+            options["distribution"],
+            storage,
+            "snapshot" if kind == "snapshot" else "local",
+            sorted(zip(components, sources)),
+        )
+        records[record.name] = record
+        self._publishes_changed()
+        return True
+
+    def _publishes_changed(self):
+        # publishes and publish_map are derived from the records
+        self.publishes.cache_clear()
+        self.publish_map.cache_clear()
+        self._written.add("publish")
+
+    def verify(self):
+        """Read the state changed by :py:meth:`apply_command` again.
 
-        Data needs to be in following format:
-        Name: test-snap
-        Description: some description
-        Sources:
-          test-snap-base [snapshot]
+        This is the verification step at the end of a run. A warning is logged
+        if the state read differs from the state the commands were expected to
+        produce, the state read is kept.
         """
-        entered_sources = False
-        sources = []
-        for line in data.split("\n"):
-            # source line need to start with two spaces
-            if entered_sources and line[0:2] != "  ":
-                break
+        with self._lock:
+            written = self._written
+            self._written = set()
+        for type_ in sorted(written):
+            expected = {}
+            for name in self._cached_methods[type_]:
+                state = self._cached(name)
+                if name in persistent_methods and state is not None:
+                    expected[name] = state
+            self.invalidate(type_)
+            for name, state in expected.items():
+                if name == "snapshot_map":
+                    state = state.resolved()
+                    snapshots = self.snapshots()
+                    actual = backend.backend().snapshot_sources_map(
+                        snapshot for snapshot in state if snapshot in snapshots
+                    )
+                    self._loaded[name] = SnapshotMap(self.snapshots, actual)
+                else:
+                    actual = getattr(self, name)()
+                if actual != state:
+                    lg.warning(
+                        "The %s differ from what the commands should have done:"
+                        "\n  expected: %s\n  read:     %s",
+                        name,
+                        state,
+                        actual,
+                    )
 
-            if entered_sources:
-                sources.append(line)
+    def load_cache(self, path):
+        """Load the state saved by :py:meth:`save_cache`.
 
-            if line == "Sources:":
-                entered_sources = True
+        The state is only loaded if the aptly database was not changed since.
 
-        return sources
+        :param path: Path of the cache file, None to disable the cache
+        :type  path: str
+        """
+        self.cache_path = path
+        self._loaded = {}
+        if not path:
+            return
+        try:
+            with open(path, encoding="UTF-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            lg.debug("No usable state cache in %s", path)
+            return
+        if data.get("version") != CACHE_VERSION:
+            return
+        if data.get("fingerprint") != aptly_fingerprint():
+            lg.info("aptly changed since the state cache was saved")
+            return
+        for type_ in self._cached_methods:
+            self.invalidate(type_)
+        state = data["state"]
+        for name in ("gpg_keys", "mirrors", "repos", "snapshots"):
+            if name in state:
+                self._loaded[name] = set(state[name])
+        if "publish_records" in state:
+            records = [
+                backend.PublishRecord(
+                    record["prefix"],
+                    record["distribution"],
+                    record["storage"],
+                    record["source_kind"],
+                    [tuple(source) for source in record["sources"]],
+                )
+                for record in state["publish_records"]
+            ]
+            self._loaded["publish_records"] = dict(
+                (record.name, record) for record in records
+            )
+        if "snapshot_map" in state:
+            self._loaded["snapshot_map"] = SnapshotMap(
+                self.snapshots,
+                dict(
+                    (snapshot, set(sources))
+                    for snapshot, sources in state["snapshot_map"].items()
+                ),
+            )
+        lg.info("Loaded state cache %s", path)
+
+    def save_cache(self):
+        """Save the state that was read to the cache file.
+
+        Only state that is still valid is saved, state that was invalidated by a
+        command is not read again. Call this after the last aptly command, the
+        fingerprint is taken when saving.
+        """
+        if not self.cache_path:
+            return
+        fingerprint = aptly_fingerprint()
+        if fingerprint is None:
+            lg.warning("aptly database not found, not saving the state cache")
+            return
+        with self._lock:
+            known = dict(self._known)
+            # State loaded from the cache but not used is still valid
+            for name, value in self._loaded.items():
+                known.setdefault(name, value)
+        state: dict[str, Any] = {}
+        for name, value in known.items():
+            if name == "publish_records":
+                state[name] = [vars(record) for record in value.values()]
+            elif name == "snapshot_map":
+                state[name] = dict(
+                    (snapshot, sorted(sources))
+                    for snapshot, sources in value.resolved().items()
+                )
+            else:
+                state[name] = sorted(value)
+        data = {"version": CACHE_VERSION, "fingerprint": fingerprint, "state": state}
+        tmp_path = "%s.tmp" % self.cache_path
+        with open(tmp_path, "w", encoding="UTF-8") as f:
+            json.dump(data, f)
+        os.replace(tmp_path, self.cache_path)
+        lg.debug("Saved state cache %s", self.cache_path)
 
     @lru_cache(maxsize=None)
+    @persistent
     def gpg_keys(self):
         """Read all trusted keys in gp and cache in lru_cache."""
         gpg_keys = set()
@@ -65,62 +422,56 @@ class SystemStateReader(object):
                 gpg_keys.add(key_short)
         return gpg_keys
 
+    @lru_cache(maxsize=None)
+    @persistent
+    def publish_records(self):
+        """Read all publishes with their sources, components and storage.
+        publish -> :py:class:`backend.PublishRecord`.
+        Cached in the lru_cache.
+        """
+        return backend.backend().publish_records()
+
     @lru_cache(maxsize=None)
     def publish_map(self):
         """Create a publish map. publish -> snapshots.
         Cached in the lru_cache.
         """
         publish_map = {}
-        re_snap = re.compile(r"\s+[\w\d-]+\:\s([\w\d-]+)\s\[snapshot\]")
-        for publish in self.publishes():
-            prefix, dist = publish.split(" ")
-            cmd = ["aptly", "publish", "show", dist, prefix]
-            result = util.run_command(cmd, stdout=util.PIPE, check=True)
-            sources = self._extract_sources(result.stdout)
-            matches = [re_snap.match(source) for source in sources]
-            snapshots = [match.group(1) for match in matches if match]
-            publish_map[publish] = set(snapshots)
+        for publish, record in self.publish_records().items():
+            publish_map[publish] = record.snapshots
 
         lg.debug("Joined snapshots and publishes: %s", publish_map)
         return publish_map
 
     @lru_cache(maxsize=None)
+    @persistent
     def snapshot_map(self):
         """Create a snapshot map. snapshot -> snapshots.
         This is also called merge-tree.
+        The map is lazy, see :py:class:`SnapshotMap`.
         Cached in the lru_cache.
         """
-        snapshot_map = {}
-        # match example:  test-snapshot [snapshot]
-        re_snap = re.compile(r"\s+([\w\d-]+)\s\[snapshot\]")
-        for snapshot_outer in self.snapshots():
-            cmd = ["aptly", "snapshot", "show", snapshot_outer]
-
-            result = util.run_command(cmd, stdout=util.PIPE, check=True)
-            sources = self._extract_sources(result.stdout)
-            matches = [re_snap.match(source) for source in sources]
-            snapshots = [match.group(1) for match in matches if match]
-            snapshot_map[snapshot_outer] = set(snapshots)
-
-        lg.debug("Joined snapshots with self(snapshots): %s", snapshot_map)
-        return snapshot_map
+        return SnapshotMap(self.snapshots)
 
     @lru_cache(maxsize=None)
     def publishes(self):
         """Read all available publishes and cache in lru_cache"""
-        return self.read_aptly_list("publish")
+        return set(self.publish_records())
 
     @lru_cache(maxsize=None)
+    @persistent
     def repos(self):
         """Read all available repo and cache in lru_cache."""
         return self.read_aptly_list("repo")
 
     @lru_cache(maxsize=None)
+    @persistent
     def mirrors(self):
         """Read all available mirror and cache in lru_cache."""
         return self.read_aptly_list("mirror")
 
     @lru_cache(maxsize=None)
+    @persistent
     def snapshots(self):
         """Read all available snapshot and cache in lru_cache."""
         return self.read_aptly_list("snapshot")
@@ -130,17 +481,8 @@ class SystemStateReader(object):
 
         :param type_: The type of list to read ie. snapshot
         :type  type_: str
-        :param list_: Read into this list
-        :param list_: list
         """
-        cmd = ["aptly", type_, "list", "-raw"]
-        clean_lines = set()
-        result = util.run_command(cmd, stdout=util.PIPE, check=True)
-        for line in result.stdout.split("\n"):
-            clean_line = line.strip()
-            if clean_line:
-                clean_lines.add(clean_line)
-        return clean_lines
+        return backend.backend().read_list(type_)
 
     def has_dependency(self, dependency):
         """Check system state dependencies.
@@ -167,6 +509,175 @@ class SystemStateReader(object):
             raise ValueError("Unknown dependency to resolve: %s" % str(dependency))
 
 
+class SnapshotMap(collections.abc.Mapping):
+    """Lazy map of snapshot -> snapshots it was created from.
+
+    The sources of a snapshot are read from aptly when the snapshot is looked
+    up for the first time, so only the snapshots a command needs are read.
+    :py:meth:`prefetch` reads many snapshots at once, reading all values (ie.
+    `items()` or comparing the map) prefetches all snapshots.
+
+    :py:meth:`dependents` walks the merge-tree below a snapshot, the results
+    are kept until the map is changed.
+
+    :param snapshots: Function returning the names of all snapshots
+    :type  snapshots: callable
+    :param   sources: Sources that are already known
+    :type    sources: dict
+    """
+
+    def __init__(self, snapshots, sources=None):
+        self._snapshots = snapshots
+        self._sources: dict[str, set[str]] = dict(sources or {})
+        self._dependents: dict[str, tuple[str, ...]] = {}
+        self._lock = threading.Lock()
+
+    def __getitem__(self, snapshot):
+        with self._lock:
+            if snapshot in self._sources:
+                return self._sources[snapshot]
+        if snapshot not in self._snapshots():
+            raise KeyError(snapshot)
+        sources = backend.backend().snapshot_sources(snapshot)
+        lg.debug("Read sources of snapshot %s: %s", snapshot, sources)
+        with self._lock:
+            return self._sources.setdefault(snapshot, sources)
+
+    def __iter__(self):
+        return iter(self._snapshots())
+
+    def __len__(self):
+        return len(self._snapshots())
+
+    def prefetch(self, snapshots):
+        """Read the sources of the snapshots that are not read yet at once.
+
+        Names that are not snapshots are ignored.
+
+        :param snapshots: Names of the snapshots
+        :type  snapshots: iterable
+        """
+        existing = self._snapshots()
+        with self._lock:
+            missing = set(
+                snapshot
+                for snapshot in snapshots
+                if snapshot in existing and snapshot not in self._sources
+            )
+        if not missing:
+            return
+        sources_map = backend.backend().snapshot_sources_map(missing)
+        lg.debug("Read sources of snapshots: %s", sources_map)
+        with self._lock:
+            for snapshot, sources in sources_map.items():
+                self._sources.setdefault(snapshot, sources)
+
+    def dependents(self, snapshot):
+        """Return all snapshots in the merge-tree below a snapshot.
+
+        These are the sources of the snapshot, their sources and so on. Each
+        snapshot is listed once, before the snapshots below it. The result of
+        every snapshot visited is memoized. A cycle raises ValueError.
+
+        :param snapshot: Name of the snapshot
+        :type  snapshot: str
+        :rtype:          tuple
+        """
+        with self._lock:
+            if snapshot in self._dependents:
+                return self._dependents[snapshot]
+            memo = dict(self._dependents)
+
+        def children(name):
+            sources = sorted(self.get(name, ()))
+            self.prefetch(source for source in sources if source not in memo)
+            return sources
+
+        # Depth-first without recursion, so deep trees do not hit the
+        # recursion limit
+        stack = [(snapshot, children(snapshot))]
+        path = [snapshot]
+        while stack:
+            name, sources = stack[-1]
+            for source in sources:
+                if source in path:
+                    cycle = path[path.index(source) :] + [source]
+                    raise ValueError(
+                        "Cycle in the snapshot merge-tree: %s" % " -> ".join(cycle)
+                    )
+                if source not in memo:
+                    stack.append((source, children(source)))
+                    path.append(source)
+                    break
+            else:
+                stack.pop()
+                path.pop()
+                closure: dict[str, None] = {}
+                for source in sources:
+                    closure[source] = None
+                    closure.update(dict.fromkeys(memo[source]))
+                memo[name] = tuple(closure)
+
+        with self._lock:
+            self._dependents.update(memo)
+        return memo[snapshot]
+
+    def set_sources(self, snapshot, sources):
+        """Set the sources of a snapshot that was created.
+
+        :param snapshot: Name of the snapshot
+        :type  snapshot: str
+        :param  sources: Names of the sources
+        :type   sources: set
+        """
+        with self._lock:
+            self._dependents.clear()
+            self._sources[snapshot] = set(sources)
+
+    def rename(self, snapshot, new_name):
+        """Rename a snapshot, also where it is used as source.
+
+        :param snapshot: Name of the snapshot
+        :type  snapshot: str
+        :param new_name: New name of the snapshot
+        :type  new_name: str
+        """
+        with self._lock:
+            self._dependents.clear()
+            if snapshot in self._sources:
+                self._sources[new_name] = self._sources.pop(snapshot)
+            for sources in self._sources.values():
+                if snapshot in sources:
+                    sources.discard(snapshot)
+                    sources.add(new_name)
+
+    def discard(self, snapshot):
+        """Forget a snapshot that was dropped.
+
+        :param snapshot: Name of the snapshot
+        :type  snapshot: str
+        """
+        with self._lock:
+            self._dependents.clear()
+            self._sources.pop(snapshot, None)
+
+    def resolved(self):
+        """Return the snapshots that were read so far, snapshot -> snapshots."""
+        with self._lock:
+            return dict(self._sources)
+
+    def items(self):
+        self.prefetch(self)
+        return super().items()
+
+    def values(self):
+        self.prefetch(self)
+        return super().values()
+
+    def __repr__(self):
+        return "SnapshotMap(%s)" % self._sources
+
+
 _state_reader: SystemStateReader | None = None
 
 
@@ -175,3 +686,12 @@ def state_reader():
     if not _state_reader:
         _state_reader = SystemStateReader()
     return _state_reader
+
+
+def configure(cfg):
+    """Load the state cache configured in the `execution` section.
+
+    :param cfg: The configuration toml as dict
+    :type  cfg: dict
+    """
+    state_reader().load_cache(cfg.get("execution", {}).get("state-cache"))
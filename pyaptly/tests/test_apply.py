@@ -0,0 +1,47 @@
+"""Test applying all sections in one run."""
+
+import pytest
+
+from .. import main, state_reader
+
+
+@pytest.mark.parametrize("config", ["publish.toml"], indirect=True)
+def test_apply_basic(environment, config, test_key_03, freeze):
+    """Test if apply creates mirrors, snapshots and publishes in one run."""
+    main.main(["-c", config, "--jobs", "4", "apply"])
+    state = state_reader.SystemStateReader()
+    assert {"fakerepo01", "fakerepo02"} == state.mirrors()
+    assert {
+        "fakerepo01-20121010T0000Z",
+        "fakerepo02-20121006T0000Z",
+    } == state.snapshots()
+    expect = {
+        "fakerepo02 main": set(["fakerepo02-20121006T0000Z"]),
+        "fakerepo01 main": set(["fakerepo01-20121010T0000Z"]),
+    }
+    assert expect == state.publish_map()
+
+
+@pytest.mark.parametrize("config", ["publish-current.toml"], indirect=True)
+def test_apply_rotating(environment, config, test_key_03, freeze):
+    """Test if a second apply rotates the snapshots and keeps the publishes."""
+    main.main(["-c", config, "apply"])
+    state = state_reader.SystemStateReader()
+    expect = {
+        "fake/current stable": set(["fake-current"]),
+        "fakerepo01/current stable": set(["fakerepo01-current"]),
+        "fakerepo02/current stable": set(["fakerepo02-current"]),
+    }
+    assert expect == state.publish_map()
+    freeze.move_to("2012-10-11 10:10:10")
+    main.main(["-c", config, "apply"])
+    state = state_reader.SystemStateReader()
+    assert set(
+        [
+            "fake-current",
+            "fakerepo01-current",
+            "fakerepo01-current-rotated-20121011T1010Z",
+            "fakerepo02-current-rotated-20121011T1010Z",
+        ]
+    ).issubset(state.snapshots())
+    assert expect == state.publish_map()
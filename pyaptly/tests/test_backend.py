@@ -0,0 +1,291 @@
+"""Test the backends used to talk to aptly."""
+
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from .. import backend, command, state_reader, util
+
+ROUTES = {
+    ("GET", "/api/mirrors"): [{"Name": "fakerepo01"}],
+    ("GET", "/api/repos"): [{"Name": "centrify"}],
+    ("GET", "/api/snapshots"): [{"Name": "fake-current"}, {"Name": "fakerepo01"}],
+    ("GET", "/api/publish"): [
+        {
+            "Prefix": "fake/current",
+            "Distribution": "stable",
+            "Storage": "",
+            "SourceKind": "snapshot",
+            "Sources": [{"Component": "main", "Name": "fake-current"}],
+        },
+        {
+            "Prefix": ".",
+            "Distribution": "latest",
+            "Storage": "s3:test",
+            "SourceKind": "local",
+            "Sources": [{"Component": "main", "Name": "centrify"}],
+        },
+    ],
+    ("PUT", "/api/publish/fake_current/stable"): {},
+    ("PUT", "/api/snapshots/fake-current"): {},
+}
+
+
+class FakeApiHandler(BaseHTTPRequestHandler):
+    """Answer like a tiny aptly API server and record the requests."""
+
+    protocol_version = "HTTP/1.1"
+
+    def handle_request(self):
+        """Answer from ROUTES."""
+        length = int(self.headers.get("Content-Length", 0))
+        data = None
+        if length:
+            data = json.loads(self.rfile.read(length))
+        self.server.requests.append(  # type: ignore
+            (self.command, self.path, data, self.client_address[1])
+        )
+        key = (self.command, self.path)
+        if key in ROUTES:
+            status, content = 200, json.dumps(ROUTES[key]).encode("UTF-8")
+        else:
+            status, content = 404, b'{"error": "not found"}'
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    do_GET = do_PUT = do_POST = do_DELETE = handle_request
+
+    def log_message(self, format, *args):
+        """Do not log to stderr."""
+        pass
+
+
+@pytest.fixture()
+def api_server():
+    """Run a stand-in for `aptly api serve`."""
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeApiHandler)
+    server.requests = []  # type: ignore
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield server
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+@pytest.fixture()
+def api_backend(api_server):
+    """Use the API backend with the stand-in server."""
+    host, port = api_server.server_address
+    backend.configure({"execution": {"api": f"http://{host}:{port}"}})
+    try:
+        yield backend.backend()
+    finally:
+        backend.configure({})
+
+
+def test_api_read(api_server, api_backend):
+    """Test if state is read from the JSON API over one kept-alive connection."""
+    assert api_backend.read_list("mirror") == {"fakerepo01"}
+    assert api_backend.read_list("repo") == {"centrify"}
+    assert api_backend.read_list("snapshot") == {"fake-current", "fakerepo01"}
+    assert api_backend.read_list("publish") == {
+        "fake/current stable",
+        "s3:test:. latest",
+    }
+    records = api_backend.publish_records()
+    assert records["fake/current stable"].snapshots == {"fake-current"}
+    assert records["s3:test:. latest"].snapshots == set()
+    assert records["s3:test:. latest"].sources == [("main", "centrify")]
+    assert len(set(port for *_, port in api_server.requests)) == 1
+
+
+def test_api_command(api_server, api_backend):
+    """Test if commands are translated to API calls."""
+    cmd = command.Command(
+        [
+            "aptly",
+            "publish",
+            "switch",
+            "-component=main",
+            "-skip-contents=true",
+            "-skip-cleanup=true",
+            "stable",
+            "fake/current",
+            "fake-current",
+        ]
+    )
+    cmd.execute()
+    command.Command(["aptly", "snapshot", "rename", "fake-current", "x"]).execute()
+    assert api_server.requests[0][:3] == (
+        "PUT",
+        "/api/publish/fake_current/stable",
+        {
+            "Snapshots": [{"Component": "main", "Name": "fake-current"}],
+            "SkipContents": True,
+            "SkipCleanup": True,
+        },
+    )
+    assert api_server.requests[1][:3] == (
+        "PUT",
+        "/api/snapshots/fake-current",
+        {"Name": "x"},
+    )
+    with pytest.raises(util.CalledProcessError):
+        command.Command(["aptly", "snapshot", "drop", "nothing"]).execute()
+
+
+def test_api_fallback(api_backend, fake_aptly):
+    """Test if commands without API call run aptly."""
+    command.Command(["aptly", "snapshot", "filter", "a", "b", "Name"]).execute()
+    assert fake_aptly.read_text() == "aptly snapshot filter a b Name\n"
+
+
+SNAPSHOT_SHOW = """Name: %s
+Description: Merged from sources: 'fakerepo01'
+Sources:
+  fakerepo01 [snapshot]
+"""
+
+
+def snapshot_json(name, sources):
+    """Return the output of aptly snapshot show -json."""
+    info = {"Name": name, "SourceKind": "snapshot", "Description": ""}
+    if sources:
+        info["Snapshots"] = [{"Name": source} for source in sources]
+    return json.dumps(info, indent=2) + "\n"
+
+
+def test_cli_snapshot_map(fake_aptly):
+    """Test if all snapshots are read in one aptly task run."""
+    output = fake_aptly.parent / "output"
+    (output / "snapshot_list_-raw").write_text("fake-current\nfakerepo01\n")
+    (output / "snapshot_show_-json_fake-current").write_text(
+        snapshot_json("fake-current", ["fakerepo01", "fakerepo01-renamed"])
+    )
+    (output / "snapshot_show_-json_fakerepo01").write_text(
+        snapshot_json("fakerepo01", [])
+    )
+    expect = {
+        "fake-current": {"fakerepo01", "fakerepo01-renamed"},
+        "fakerepo01": set(),
+    }
+    assert expect == state_reader.SystemStateReader().snapshot_map()
+    log = fake_aptly.read_text().splitlines()
+    assert log[0] == "aptly snapshot list -raw"
+    assert log[1].startswith("aptly task run -filename=")
+    assert log[2:] == [
+        "task: snapshot show -json fake-current",
+        "task: snapshot show -json fakerepo01",
+    ]
+
+
+def test_cli_snapshot_map_lazy(fake_aptly):
+    """Test if only the snapshots that are looked up are read."""
+    output = fake_aptly.parent / "output"
+    (output / "snapshot_list_-raw").write_text("a\nb\nc\nd\n")
+    for name in "abcd":
+        (output / ("snapshot_show_%s" % name)).write_text(SNAPSHOT_SHOW % name)
+    snapshot_map = state_reader.SystemStateReader().snapshot_map()
+    assert snapshot_map["a"] == {"fakerepo01"}
+    assert snapshot_map.get("a") == {"fakerepo01"}
+    assert snapshot_map.get("missing") is None
+    log = fake_aptly.read_text().splitlines()
+    assert log == ["aptly snapshot list -raw", "aptly snapshot show a"]
+    snapshot_map.prefetch(["a", "b", "c", "missing"])
+    snapshot_map["c"]
+    log = fake_aptly.read_text().splitlines()
+    assert log[2].startswith("aptly task run -filename=")
+    assert log[3:] == [
+        "task: snapshot show -json b",
+        "task: snapshot show -json c",
+        "aptly snapshot show b",
+        "aptly snapshot show c",
+    ]
+    assert len(snapshot_map) == 4
+
+
+def test_cli_snapshot_map_fallback(fake_aptly):
+    """Test if snapshots are read with the text parser if -json fails."""
+    output = fake_aptly.parent / "output"
+    (output / "snapshot_show_-json_a.fail").write_text(
+        "flag provided but not defined: -json\n"
+    )
+    for name in ["a", "b"]:
+        (output / ("snapshot_show_%s" % name)).write_text(SNAPSHOT_SHOW % name)
+    expect = {"a": {"fakerepo01"}, "b": {"fakerepo01"}}
+    assert expect == backend.CliBackend().snapshot_sources_map(["b", "a"])
+    log = fake_aptly.read_text().splitlines()
+    assert log[2:] == ["aptly snapshot show a", "aptly snapshot show b"]
+
+
+def test_api_snapshot_sources(api_server, api_backend, fake_aptly):
+    """Test if the API backend reads snapshot sources with aptly, the API does
+    not report them."""
+    output = fake_aptly.parent / "output"
+    (output / "snapshot_show_-json_fake-current").write_text(
+        snapshot_json("fake-current", ["fakerepo01-rotated", "fakerepo02"])
+    )
+    (output / "snapshot_show_-json_fakerepo01").write_text(
+        snapshot_json("fakerepo01", [])
+    )
+    expect = {
+        "fake-current": {"fakerepo01-rotated", "fakerepo02"},
+        "fakerepo01": set(),
+    }
+    assert expect == api_backend.snapshot_sources_map(["fakerepo01", "fake-current"])
+    assert api_server.requests == []
+
+
+PUBLISH_SHOW = """Prefix: %s
+Distribution: %s
+Sources:
+  contrib: b [snapshot]
+  main: a [snapshot]
+"""
+
+
+def test_cli_publish_records(fake_aptly):
+    """Test if all publishes are read with one aptly publish list -json."""
+    output = fake_aptly.parent / "output"
+    (output / "publish_list_-json").write_text(
+        json.dumps(ROUTES[("GET", "/api/publish")], indent=2)
+    )
+    state = state_reader.SystemStateReader()
+    assert {"fake/current stable": {"fake-current"}, "s3:test:. latest": set()} == (
+        state.publish_map()
+    )
+    assert {"fake/current stable", "s3:test:. latest"} == state.publishes()
+    record = state.publish_records()["s3:test:. latest"]
+    assert (".", "latest", "s3:test", "local") == (
+        record.prefix,
+        record.distribution,
+        record.storage,
+        record.source_kind,
+    )
+    assert fake_aptly.read_text().splitlines() == ["aptly publish list -json"]
+
+
+def test_cli_publish_records_fallback(fake_aptly):
+    """Test if publishes are read with the text parser if -json fails."""
+    output = fake_aptly.parent / "output"
+    (output / "publish_list_-json.fail").write_text(
+        "flag provided but not defined: -json\n"
+    )
+    (output / "publish_list_-raw").write_text("s3:test:fake stable\n")
+    (output / "publish_show_stable_s3:test:fake").write_text(
+        PUBLISH_SHOW % ("s3:test:fake", "stable")
+    )
+    record = backend.CliBackend().publish_records()["s3:test:fake stable"]
+    expect = backend.PublishRecord(
+        "fake", "stable", "s3:test", "snapshot", [("contrib", "b"), ("main", "a")]
+    )
+    assert expect == record
+    assert record.snapshots_for(["main", "contrib"]) == ["a", "b"]
+    assert record.snapshots_for(["main"]) == ["b", "a"]
@@ -1,10 +1,12 @@
 import json
+from pathlib import Path
 
+import pytest
 import tomli
 from hypothesis import given
 from hypothesis import strategies as st
 
-from .. import tomli_w
+from .. import main, tomli_w
 
 try:
     import tomllib
@@ -33,3 +35,24 @@ def test_convert(data):
     # if tomllib is avaible compare to it
     if tomllib:  # pragma: no cover
         tomllib.loads(toml)
+
+
+@pytest.mark.parametrize("config", ["publish.toml"], indirect=True)
+def test_config_cache(config, tmp_path, monkeypatch):
+    """Test if an unchanged config is neither parsed nor validated again."""
+    path = tmp_path / "pyaptly.toml"
+    path.write_bytes(Path(config).read_bytes())
+    cache_path = str(tmp_path / "config-cache.json")
+    cfg = main.read_config(path, cache_path)
+    assert cfg == tomli.loads(path.read_text())
+
+    def fail(*args):
+        raise AssertionError("config parsed again")
+
+    with monkeypatch.context() as m:
+        m.setattr(main, "parse_config", fail)
+        m.setattr(main, "validate_config", fail)
+        assert main.read_config(path, cache_path) == cfg
+
+    path.write_text(path.read_text() + '\n[repo.extra]\ncomment = "extra"\n')
+    assert main.read_config(path, cache_path)["repo"] == {"extra": {"comment": "extra"}}
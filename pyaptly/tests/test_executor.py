@@ -0,0 +1,348 @@
+"""Test executing the command graph."""
+
+import argparse
+import json
+import logging
+import threading
+import time
+
+import pytest
+
+from .. import command, executor, history, main, util
+
+
+def shell_command(script, provides=(), requires=()):
+    """Create a command running a shell script."""
+    cmd = command.Command(["sh", "-c", script])
+    for provide in provides:
+        cmd.provide("virtual", provide)
+    for require in requires:
+        cmd.require("virtual", require)
+    return cmd
+
+
+def execute(commands, jobs=None, execution=None, batch=None):
+    """Execute commands like a subcommand would."""
+    cfg = {}
+    if execution is not None:
+        cfg["execution"] = execution
+    args = argparse.Namespace(jobs=jobs, batch=batch)
+    executor.execute_commands(cfg, args, commands)
+
+
+class TrackingCommand(command.Command):
+    """Sleep instead of running a process and track concurrency per class."""
+
+    lock = threading.Lock()
+    running: dict[str, int] = {}
+    max_running: dict[str, int] = {}
+
+    def tracking_key(self):
+        """Return what the concurrency is tracked by."""
+        return self.resource_class()
+
+    def execute(self):
+        """Sleep and record how many commands of the same class are running."""
+        resource_class = self.tracking_key()
+        with self.lock:
+            count = self.running.get(resource_class, 0) + 1
+            self.running[resource_class] = count
+            self.max_running[resource_class] = max(
+                count, self.max_running.get(resource_class, 0)
+            )
+        time.sleep(0.1)
+        with self.lock:
+            self.running[resource_class] -= 1
+        self._finished = True
+        return self._finished
+
+
+def test_execute_parallel():
+    """Test if independent commands run at the same time."""
+    commands = [shell_command("sleep 0.5", provides=[str(i)]) for i in range(4)]
+    start = time.monotonic()
+    execute(commands, jobs=4)
+    assert time.monotonic() - start < 1.5
+    assert all(cmd._finished for cmd in commands)
+
+
+@pytest.mark.parametrize("jobs", [1, 3])
+def test_execute_order(tmp_path, jobs):
+    """Test if commands wait for the commands they require."""
+    out = tmp_path / "out"
+    commands = [
+        shell_command(f"echo c >> {out}", requires=["b"]),
+        shell_command(f"sleep 0.2; echo a >> {out}", provides=["a"]),
+        shell_command(f"echo b >> {out}", provides=["b"], requires=["a"]),
+        shell_command(f"sleep 0.5; echo x >> {out}"),
+    ]
+    execute(commands, jobs=jobs)
+    lines = out.read_text().split()
+    assert lines.index("a") < lines.index("b") < lines.index("c")
+
+
+def test_execute_fail_fast(caplog):
+    """Test if dependents of a failed command are cancelled."""
+    failing = shell_command("false", provides=["a"])
+    dependent = shell_command("true", requires=["a"])
+    independent = shell_command("sleep 0.2")
+    with pytest.raises(util.CalledProcessError):
+        execute([failing, dependent, independent], jobs=2)
+    assert not failing._finished
+    assert not dependent._finished
+    assert independent._finished
+    assert "Cancelled commands after a failure" in caplog.text
+
+
+def test_resource_class():
+    """Test if the resource class is derived from provides, then requires."""
+    cmd = command.Command(["aptly", "snapshot", "create"])
+    cmd.provide("snapshot", "snap")
+    cmd.require("mirror", "mirror")
+    assert cmd.resource_class() == "snapshot"
+    cmd = command.Command(["aptly", "mirror", "update"])
+    cmd.require("mirror", "mirror")
+    cmd.provide("virtual", "mirror-updated-mirror")
+    assert cmd.resource_class() == "mirror"
+    cmd = command.Command(["aptly", "snapshot", "rename"])
+    cmd.provide("virtual", "rotated")
+    assert cmd.resource_class() == "virtual"
+    assert command.DummyCommand("dummy").resource_class() == "virtual"
+
+
+def test_execute_pools():
+    """Test if pools limit the concurrency of each resource class."""
+    TrackingCommand.max_running.clear()
+    commands = []
+    for i in range(6):
+        mirror = TrackingCommand(["mirror", str(i)])
+        mirror.provide("mirror", str(i))
+        snapshot = TrackingCommand(["snapshot", str(i)])
+        snapshot.provide("snapshot", str(i))
+        commands.extend([mirror, snapshot])
+    execute(commands, execution={"pools": {"mirror": 3, "snapshot": 1}})
+    assert all(cmd._finished for cmd in commands)
+    assert TrackingCommand.max_running == {"mirror": 3, "snapshot": 1}
+
+
+class HostTrackingCommand(TrackingCommand):
+    """Track the concurrency per upstream host."""
+
+    def tracking_key(self):
+        """Track by the host."""
+        return self.host
+
+
+def test_execute_per_host(caplog):
+    """Test if commands of a host are limited, while other hosts proceed."""
+    HostTrackingCommand.max_running.clear()
+    commands = []
+    for i, host in enumerate("aaaabb"):
+        cmd = HostTrackingCommand(["aptly", "mirror", "update", str(i)])
+        cmd.provide("virtual", "mirror-updated-%d" % i)
+        cmd.host = host
+        commands.append(cmd)
+    caplog.set_level(logging.INFO)
+    start = time.monotonic()
+    execute(commands, jobs=4, execution={"per-host": 2})
+    assert HostTrackingCommand.max_running == {"a": 2, "b": 2}
+    # a: 2 rounds of 2, b: 1 round at the same time
+    assert time.monotonic() - start < 0.3
+    assert "Finished aptly mirror update 5 in" in caplog.text
+    assert "(6/6)" in caplog.text
+
+
+def test_execute_batch(fake_aptly):
+    """Test if a failing command in a batch is mapped back to its Command."""
+    commands = [
+        command.Command(["aptly", "snapshot", "drop", name])
+        for name in ["a", "fail", "c"]
+    ]
+    with pytest.raises(util.CalledProcessError) as e:
+        command.Command.execute_batch(commands)
+    assert list(e.value.cmd) == ["aptly", "snapshot", "drop", "fail"]
+    assert [cmd._finished for cmd in commands] == [True, False, False]
+    log = fake_aptly.read_text().splitlines()
+    assert log[0].startswith("aptly task run -filename=")
+    assert log[1:] == ["task: snapshot drop a", "task: snapshot drop fail"]
+
+
+def test_execute_batch_graph(fake_aptly):
+    """Test if ready commands are batched and dependents run afterwards."""
+    commands = []
+    for name in ["a", "b", "c"]:
+        cmd = command.Command(["aptly", "snapshot", "drop", name])
+        cmd.provide("virtual", name)
+        commands.append(cmd)
+    last = command.Command(["aptly", "db", "cleanup"])
+    for name in ["a", "b", "c"]:
+        last.require("virtual", name)
+    commands.append(last)
+    commands.append(command.Command(["aptly", "snapshot", "drop", "it's, quoted,"]))
+    execute(commands, batch=True)
+    assert all(cmd._finished for cmd in commands)
+    log = fake_aptly.read_text().splitlines()
+    assert log[1:4] == [
+        "task: snapshot drop a",
+        "task: snapshot drop b",
+        "task: snapshot drop c",
+    ]
+    assert log[4:] == [
+        "aptly snapshot drop it's, quoted,",
+        "aptly db cleanup",
+    ]
+
+
+def test_resume(fake_aptly, tmp_path):
+    """Test if an interrupted run continues with the commands that did not finish."""
+    path = tmp_path / "journal"
+    execution = {"journal": str(path)}
+    failure = fake_aptly.parent / "output" / "mirror_update_b.fail"
+    failure.write_text("network unreachable")
+    commands = []
+    for name, requires in [("a", []), ("b", ["a"]), ("c", ["b"])]:
+        cmd = command.Command(["aptly", "mirror", "update", name])
+        cmd.provide("virtual", name)
+        for require in requires:
+            cmd.require("virtual", require)
+        commands.append(cmd)
+    with pytest.raises(util.CalledProcessError):
+        execute(commands, execution=execution)
+    assert path.exists()
+    failure.unlink()
+
+    args = argparse.Namespace(jobs=None, batch=None, resume=True)
+    assert executor.resume({"execution": execution}, args)
+    assert not path.exists()
+    assert fake_aptly.read_text().splitlines() == [
+        "aptly mirror update a",
+        "aptly mirror update b",
+        "aptly mirror update b",
+        "aptly mirror update c",
+    ]
+    assert not executor.resume({"execution": execution}, args)
+
+
+def test_resume_db_cleanup(fake_aptly, tmp_path):
+    """Test if a resumed run cleans up after drops that finished before."""
+    path = tmp_path / "journal"
+    execution = {
+        "journal": str(path),
+        "db-cleanup": {"schedule": str(tmp_path / "schedule")},
+    }
+    failure = fake_aptly.parent / "output" / "snapshot_create_b_from_mirror_b.fail"
+    failure.write_text("network unreachable")
+    drop = command.Command(["aptly", "snapshot", "drop", "a"])
+    drop.provide("virtual", "a")
+    create = command.Command(
+        ["aptly", "snapshot", "create", "b", "from", "mirror", "b"]
+    )
+    create.require("virtual", "a")
+    with pytest.raises(util.CalledProcessError):
+        execute([drop, create], execution=execution)
+    failure.unlink()
+
+    args = argparse.Namespace(jobs=None, batch=None, resume=True)
+    assert executor.resume({"execution": execution}, args)
+    assert fake_aptly.read_text().splitlines() == [
+        "aptly snapshot drop a",
+        "aptly snapshot create b from mirror b",
+        "aptly snapshot create b from mirror b",
+        "aptly db cleanup",
+    ]
+
+
+class RecordingCommand(command.Command):
+    """Record the order in which commands are started."""
+
+    started: list[str] = []
+
+    def execute(self):
+        """Record the start of the command."""
+        self.started.append(self.cmd[-1])
+        self._finished = True
+        return self._finished
+
+
+def test_critical_path_first(tmp_path):
+    """Test if the ready command with the longest remaining path starts first."""
+    path = str(tmp_path / "history.json")
+    durations = history.DurationHistory(path)
+    durations.record(command.Command(["aptly", "mirror", "update", "slow"]), 60.0)
+    durations.save()
+
+    RecordingCommand.started = []
+    commands = []
+    for name, requires in [
+        ("quick", None),
+        ("slow", None),
+        ("chain-1", None),
+        ("chain-2", "chain-1"),
+        ("chain-3", "chain-2"),
+    ]:
+        cmd = RecordingCommand(["aptly", "mirror", "update", name])
+        cmd.provide("virtual", name)
+        if requires:
+            cmd.require("virtual", requires)
+        commands.append(cmd)
+    execute(commands, execution={"history": path, "pools": {"virtual": 1}})
+    assert RecordingCommand.started == [
+        "slow",
+        "chain-1",
+        "chain-2",
+        "quick",
+        "chain-3",
+    ]
+
+
+def test_duration_history(tmp_path):
+    """Test if durations are averaged and shared by timestamped names."""
+    path = str(tmp_path / "history.json")
+    durations = history.DurationHistory(path)
+    first = command.Command(["aptly", "snapshot", "create", "a-20121010T0000Z"])
+    assert durations.estimate(first) == history.DEFAULT_DURATION
+    assert durations.estimate(command.DummyCommand("dummy")) == 0.0
+    durations.record(first, 10.0)
+    durations.record(first, 20.0)
+    durations.save()
+    second = command.Command(["aptly", "snapshot", "create", "a-20121011T0000Z"])
+    assert history.DurationHistory(path).estimate(second) == 15.0
+
+
+def test_db_cleanup(fake_aptly, tmp_path, caplog):
+    """Test if the pool is cleaned up after removing references, if due."""
+    (fake_aptly.parent / "output" / "db_cleanup").write_text(
+        "Deleting unreferenced files (3)...\nDisk space freed: 1.50 MiB...\n"
+    )
+    schedule = tmp_path / "schedule"
+    execution = {"db-cleanup": {"interval": 24, "schedule": str(schedule)}}
+    caplog.set_level(logging.INFO)
+
+    execute([command.Command(["aptly", "mirror", "create", "a"])], execution=execution)
+    execute([command.Command(["aptly", "snapshot", "drop", "a"])], execution=execution)
+    assert "1572864 bytes freed" in caplog.text
+    execute([command.Command(["aptly", "snapshot", "drop", "b"])], execution=execution)
+    assert json.loads(schedule.read_text())["pending"]
+
+    # The deferred cleanup is done by the next run that is due
+    execution["db-cleanup"]["interval"] = 0
+    execute([command.Command(["aptly", "mirror", "create", "b"])], execution=execution)
+    assert not json.loads(schedule.read_text())["pending"]
+    assert fake_aptly.read_text().splitlines() == [
+        "aptly mirror create a",
+        "aptly snapshot drop a",
+        "aptly db cleanup",
+        "aptly snapshot drop b",
+        "aptly mirror create b",
+        "aptly db cleanup",
+    ]
+
+
+def test_db_cleanup_interval_needs_schedule(fake_aptly, caplog):
+    """Test if an interval without schedule is rejected by the schema and
+    reported when cleaning up."""
+    execution = {"db-cleanup": {"interval": 24}}
+    assert not main.validate_config({"execution": execution})
+    execute([command.Command(["aptly", "snapshot", "drop", "a"])], execution=execution)
+    assert "db-cleanup.interval is ignored" in caplog.text
+    assert fake_aptly.read_text().splitlines()[-1] == "aptly db cleanup"
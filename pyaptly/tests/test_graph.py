@@ -3,7 +3,8 @@
 import random
 from typing import Union
 
-from hypothesis import given, settings
+import pytest
+from hypothesis import assume, given, settings
 from hypothesis import strategies as st
 
 from .. import command
@@ -99,6 +100,31 @@ def test_graph_island(tree0, tree1, rnd):  # pragma: no cover
     run_graph(tree)
 
 
+def test_graph_state_dependencies():
+    """Test that only requirements without a pending provider are checked."""
+    create = command.Command(["create"])
+    create.require("snapshot", "existing")
+    create.provide("publish", "ubuntu a")
+    switch = command.Command(["switch"])
+    switch.require("publish", "ubuntu a")
+    checked = []
+
+    def has_dependency(req):
+        checked.append(req)
+        if req[0] == "publish":
+            raise ValueError("Unknown dependency to resolve: %s" % str(req))
+        return True
+
+    ordered = command.Command.order_commands([switch, create], has_dependency)
+    assert ordered == [create, switch]
+    assert checked == [("snapshot", "existing")]
+
+    orphan = command.Command(["switch"])
+    orphan.require("publish", "ubuntu b")
+    with pytest.raises(ValueError, match="unresolved deps"):
+        command.Command.order_commands([orphan], has_dependency)
+
+
 def run_graph(tree):
     """Run the test."""
     commands = []
@@ -121,3 +147,63 @@ def run_graph(tree):
     for cmd in ordered:
         assert cmd._requires.issubset(provided)
         provided.update(cmd._provides)
+
+
+def build_islands(tree, copies):
+    """Build `copies` independent copies of a tree, each with its own resources."""
+    commands = []
+    for copy in range(copies):
+        offset = copy * (RES_COUNT + 1)
+        for i in range(len(tree[0])):
+            cmd = command.Command(["%s-%s" % (copy, i)])
+            for provides in tree[0][i]:
+                cmd.provide("virtual", provides + offset)
+            for requires in tree[1][i]:
+                cmd.require("virtual", requires + offset)
+            commands.append(cmd)
+    return commands
+
+
+class CountingFrozenset(frozenset):
+    """Frozenset that counts the elements visited by iterating over it."""
+
+    visits = 0
+
+    def __iter__(self):
+        for item in super().__iter__():
+            CountingFrozenset.visits += 1
+            yield item
+
+
+def count_ordering(commands):
+    """Return the edges visited and dependencies checked ordering the commands."""
+    checks = 0
+
+    def has_dependency(req):
+        nonlocal checks
+        checks += 1
+        return False
+
+    for cmd in commands:
+        cmd.freeze()
+        cmd._requires = CountingFrozenset(cmd._requires)
+        cmd._provides = CountingFrozenset(cmd._provides)
+    CountingFrozenset.visits = 0
+    command.Command.order_commands(commands, has_dependency)
+    return CountingFrozenset.visits + checks
+
+
+@settings(max_examples=5)
+@given(provide_require_st())
+def test_graph_scaling(tree):
+    """Test that ordering scales linearly with the size of the graph.
+
+    The work is counted instead of timed: ordering eight times as many
+    independent islands must not visit more than eight times as many edges. A
+    quadratic scheduler would visit 64 times as many.
+    """
+    assume(len(tree[0]) >= 10)
+    small = build_islands(tree, 25)
+    big = build_islands(tree, 200)
+    assert len(command.Command.order_commands(big)) == len(big)
+    assert count_ordering(big) <= count_ordering(small) * 8
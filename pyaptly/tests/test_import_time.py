@@ -0,0 +1,50 @@
+"""Test the modules imported by the command line entry points."""
+
+import subprocess
+import sys
+
+import pytest
+
+LAZY_MODULES = {
+    "colorama",
+    "http.client",
+    "jsonschema",
+    "tomli",
+    "yaml",
+}
+"""Modules that must only be imported when they are used."""
+
+
+def import_times(module):
+    """Import the module in a new interpreter and return the import times.
+
+    :rtype: dict of module name -> cumulative import time in microseconds
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import %s" % module],
+        stderr=subprocess.PIPE,
+        check=True,
+        text=True,
+    )
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line.split("|")
+        times[name.strip()] = int(cumulative)
+    return times
+
+
+@pytest.mark.parametrize("module", ["pyaptly.cli", "pyaptly.main"])
+def test_import_lazy(module):
+    """Test if the entry points are imported without the optional modules."""
+    times = import_times(module)
+    assert module in times
+    assert not LAZY_MODULES & set(times)
+
+
+def test_import_subcommands_lazy():
+    """Test if the modules of the subcommands are imported when they are run."""
+    times = import_times("pyaptly.main")
+    for name in ["apply", "mirror", "publish", "repo", "snapshot"]:
+        assert "pyaptly.%s" % name not in times
@@ -1,10 +1,13 @@
 """Test mirror functionality."""
 
+import hashlib
 import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
 import pytest
 
-from .. import main, state_reader, util
+from .. import main, mirror, model, release, state_reader, util
 
 
 @pytest.mark.parametrize("config", ["debug.toml"], indirect=True)
@@ -77,3 +80,126 @@ def test_mirror_update_single(config, mirror_update):
     """Test if updating a single mirror works."""
     args = ["-c", config, "mirror", "update", "fakerepo01"]
     main.main(args)
+
+
+class FakeRepoHandler(BaseHTTPRequestHandler):
+    """Serve the Release files of a fake repo with ETags."""
+
+    def do_GET(self):
+        """Answer 304 if the ETag matches."""
+        self.server.requests.append(  # type: ignore
+            (self.path, self.headers.get("If-None-Match"))
+        )
+        content = self.server.files.get(self.path)  # type: ignore
+        if content is None:
+            self.send_error(404)
+            return
+        etag = '"%s"' % hashlib.sha256(content).hexdigest()[:16]
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("ETag", etag)
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        """Do not log to stderr."""
+        pass
+
+
+@pytest.fixture()
+def fake_repo():
+    """Run a stand-in for an upstream archive."""
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeRepoHandler)
+    server.requests = []  # type: ignore
+    server.files = {}  # type: ignore
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield server
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_mirror_update_release_unchanged(fake_aptly, fake_repo, tmp_path):
+    """Test if a mirror is only updated if its Release file changed."""
+    (fake_aptly.parent / "output" / "mirror_list_-raw").write_text("fakerepo01\n")
+    state_reader.state_reader().invalidate("mirror")
+    host, port = fake_repo.server_address
+    cfg = {
+        "execution": {"release-cache": str(tmp_path / "release.json")},
+        "mirror": {
+            "fakerepo01": {
+                "archive": "http://%s:%d/fakerepo01" % (host, port),
+                "distribution": "main",
+                "components": "main",
+            }
+        },
+    }
+    mirror_config = model.config(cfg).mirrors["fakerepo01"]
+    fake_repo.files["/fakerepo01/dists/main/Release"] = b"Date: 1\n"
+
+    def update():
+        release._cache = None  # a new run
+        commands = mirror.cmd_mirror_update(cfg, "fakerepo01", mirror_config)
+        for cmd in commands:
+            cmd.execute()
+        mirror.commit_release_cache(cfg, commands)
+        return commands
+
+    assert len(update()) == 1
+    assert update() == []
+    fake_repo.files["/fakerepo01/dists/main/Release"] = b"Date: 2\n"
+    assert len(update()) == 1
+    assert update() == []
+    assert fake_aptly.read_text().splitlines()[1:] == [
+        "aptly mirror update fakerepo01",
+        "aptly mirror update fakerepo01",
+    ]
+    # InRelease is tried first, the ETag of the last update is sent
+    assert fake_repo.requests[0] == ("/fakerepo01/dists/main/InRelease", None)
+    assert fake_repo.requests[3][0] == "/fakerepo01/dists/main/Release"
+    assert fake_repo.requests[3][1] is not None
+
+
+def test_archive_host():
+    """Test if the host of a mirror archive is found, also in malformed URLs."""
+    mirror_config = model.compile_mirror("m", {"archive": "http://deb.debian.org/x"})
+    assert mirror.archive_host(mirror_config) == "deb.debian.org"
+    mirror_config = model.compile_mirror("m", {"archive": "http://[::1/debian"})
+    assert mirror.archive_host(mirror_config) is None
+
+
+def test_mirror_create_release_staged(fake_aptly, fake_repo, tmp_path):
+    """Test if the Release file of a mirror created in the run is kept."""
+    state_reader.state_reader().invalidate("mirror")
+    host, port = fake_repo.server_address
+    cfg = {
+        "execution": {"release-cache": str(tmp_path / "release.json")},
+        "mirror": {
+            "fakerepo01": {
+                "archive": "http://%s:%d/fakerepo01" % (host, port),
+                "distribution": "main",
+            },
+            "broken": {"archive": "http://[::1/debian", "distribution": "main"},
+        },
+    }
+    config = model.config(cfg)
+    fake_repo.files["/fakerepo01/dists/main/InRelease"] = b"Date: 1\n"
+    release._cache = None
+    release.release_cache(cfg).check_all(config.mirrors)
+    commands = mirror.cmd_mirror_update(cfg, "fakerepo01", config.mirrors["fakerepo01"])
+    assert len(commands) == 2
+    for cmd in commands:
+        cmd.execute()
+    mirror.commit_release_cache(cfg, commands)
+
+    release._cache = None
+    fakerepo01 = config.mirrors["fakerepo01"]
+    assert mirror.cmd_mirror_update(cfg, "fakerepo01", fakerepo01) == []
+    # A malformed archive URL counts as changed
+    assert len(mirror.cmd_mirror_update(cfg, "broken", config.mirrors["broken"])) == 2
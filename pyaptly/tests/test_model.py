@@ -0,0 +1,60 @@
+"""Test compiling the config into the model."""
+
+import dataclasses
+
+import pytest
+import tomli
+
+from .. import model
+
+
+@pytest.mark.parametrize("config", ["publish-publish.toml"], indirect=True)
+def test_compile_config(config, freeze):
+    """Test if lists are normalized, references split and lookups prepared."""
+    with open(config, "rb") as f:
+        cfg = tomli.load(f)
+    compiled = model.config(cfg)
+    assert model.config(cfg) is compiled
+
+    mirror = compiled.mirrors["fakerepo01"]
+    assert mirror.components == ("main",)
+    assert mirror.gpg_keys == ("2841988729C7F3FF",)
+    assert mirror.max_tries == 2
+
+    assert compiled.snapshots["fakerepo02-%T"].timestamp == {
+        "time": "00:00",
+        "repeat-weekly": "sat",
+    }
+
+    assert [entry.fullname for entry in compiled.entries] == [
+        "fakerepo01 main",
+        "fakerepo02 main",
+        "fakerepo01-stable main",
+    ]
+    publish = compiled.publishes[("fakerepo01", "main")]
+    assert publish.automatic_update
+    assert publish.skip_contents
+    assert publish.snapshots == (
+        model.SnapshotRef("fakerepo01-%T", 0, "archived-fakerepo01-%T"),
+    )
+    assert compiled.snapshot_name(publish.snapshots[0]) == "fakerepo01-20121010T0000Z"
+    stable = compiled.publishes_named("fakerepo01-stable")[0]
+    assert stable.publish == ("fakerepo01", "main")
+    assert compiled.publishes[stable.publish] is publish
+
+    with pytest.raises(dataclasses.FrozenInstanceError):
+        publish.distribution = "other"  # type: ignore[misc]
+    with pytest.raises(TypeError):
+        compiled.mirrors["other"] = mirror  # type: ignore[index]
+
+
+def test_compile_publish_reference():
+    """Test if publish references are split into name and distribution."""
+    compiled = model.compile_publish(
+        "current", {"publish": "fake/current stable", "components": ["main"]}
+    )
+    assert compiled.publish == ("fake/current", "stable")
+    with pytest.raises(ValueError):
+        model.compile_publish("current", {"publish": "fakerepo01/main"})
+    with pytest.raises(ValueError):
+        model.compile_publish("bad", {"repo": "a", "snapshots": ["b"]})
@@ -1,8 +1,11 @@
 """Test publish functionality."""
 
+import argparse
+import json
+
 import pytest
 
-from .. import command, main, state_reader
+from .. import command, main, publish, state_reader
 
 
 @pytest.mark.parametrize("repo", ["fakerepo01", "asdfasdf"])
@@ -216,3 +219,119 @@ def test_publish_update_wrong_snapshots(config, publish_create, freeze):
         "fakerepo02 main": set(["fakerepo01-20121011T0000Z"]),
     }
     assert expect2 == state.publish_map()
+
+
+def test_snapshot_publish_index(freeze):
+    """Test if publishes are indexed by their resolved snapshots once."""
+    cfg = {
+        "snapshot": {"fakerepo01-%T": {"timestamp": {"time": "00:00"}}},
+        "publish": {
+            "fakerepo01": [
+                {
+                    "distribution": "main",
+                    "snapshots": [
+                        {"name": "fakerepo01-%T", "timestamp": "current"},
+                        "extra",
+                    ],
+                },
+                {"distribution": "repo", "repo": "centrify"},
+            ],
+            "fake/current": [{"distribution": "stable", "snapshots": ["extra"]}],
+        },
+    }
+    entries, index = publish.snapshot_publish_index(cfg)
+    assert [(entry.name, entry.distribution) for entry in entries] == [
+        ("fakerepo01", "main"),
+        ("fakerepo01", "repo"),
+        ("fake/current", "stable"),
+    ]
+    assert index == {"fakerepo01-20121010T0000Z": [0], "extra": [0, 2]}
+    freeze.move_to("2012-10-11 10:10:10")
+    assert publish.snapshot_publish_index(cfg)[1] is index
+
+
+def test_defer_cleanup():
+    """Test if only the last switch of each component of a prefix cleans up."""
+    commands = []
+    for distribution, prefix, components in [
+        ("bookworm", "debian", "main"),
+        ("trixie", "debian", "main,contrib"),
+        ("stable", "other", "main"),
+        ("sid", "debian", "main"),
+    ]:
+        cmd = command.Command(
+            ["aptly", "publish", "switch", "-component=%s" % components]
+            + [distribution, prefix, "snap"]
+        )
+        cmd.provide("publish", "%s %s" % (prefix, distribution))
+        commands.append(cmd)
+    publish.defer_cleanup(commands + [None])
+    bookworm, trixie, other, sid = commands
+    assert bookworm.cmd[3] == "-skip-cleanup=true"
+    assert "-skip-cleanup=true" not in trixie.cmd + other.cmd + sid.cmd
+    for cleaning in [trixie, sid]:
+        assert ("virtual", "switched-debian bookworm") in cleaning._requires
+    assert ("virtual", "switched-debian trixie") not in sid._requires
+    ordered = command.Command.order_commands(commands)
+    assert ordered.index(bookworm) < ordered.index(sid)
+
+
+def test_defer_cleanup_duplicates():
+    """Test if copies of a switch from several rotations are changed alike."""
+    commands = []
+    for distribution in ["stable", "stable", "testing", "stable"]:
+        cmd = command.Command(
+            ["aptly", "publish", "switch", "-component=main"]
+            + [distribution, "fake/current", "snap"]
+        )
+        cmd.provide("publish", "fake/current %s" % distribution)
+        commands.append(cmd)
+    publish.defer_cleanup(commands)
+    testing = commands[2]
+    assert testing.cmd[3] == "-skip-cleanup=true"
+    stable = commands[0]
+    for cmd in commands[1:]:
+        if cmd is not testing:
+            assert cmd == stable
+    assert ("virtual", "switched-fake/current testing") in stable._requires
+    assert ("virtual", "switched-fake/current stable") not in stable._requires
+    ordered = command.Command.order_commands(commands)
+    assert ordered == [testing, stable]
+
+
+def test_defer_cleanup_update_all(fake_aptly):
+    """Test if the switches of publishes sharing a prefix are ordered and run."""
+    output = fake_aptly.parent / "output"
+    records = [
+        {
+            "Prefix": "ubuntu",
+            "Distribution": distribution,
+            "Storage": "",
+            "SourceKind": "snapshot",
+            "Sources": [{"Component": "main", "Name": "old-%s" % distribution}],
+        }
+        for distribution in ["a", "b"]
+    ]
+    (output / "publish_list_-json").write_text(json.dumps(records))
+    (output / "snapshot_list_-raw").write_text("new-a\nnew-b\nold-a\nold-b\n")
+    state_reader.state_reader().invalidate("publish")
+    state_reader.state_reader().invalidate("snapshot")
+    cfg = {
+        "publish": {
+            "ubuntu": [
+                {
+                    "distribution": distribution,
+                    "components": ["main"],
+                    "snapshots": ["new-%s" % distribution],
+                    "automatic-update": True,
+                }
+                for distribution in ["a", "b"]
+            ]
+        }
+    }
+    args = argparse.Namespace(task="update", publish_name="all", debug=False)
+    publish.publish(cfg, args)
+    assert fake_aptly.read_text().splitlines()[-2:] == [
+        "aptly publish switch -skip-cleanup=true -component=main a ubuntu new-a",
+        "aptly publish switch -component=main b ubuntu new-b",
+    ]
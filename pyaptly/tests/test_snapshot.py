@@ -1,8 +1,11 @@
 """Test snapshot functionality."""
 
+import argparse
+import json
+
 import pytest
 
-from .. import main, state_reader, util
+from .. import main, model, snapshot, state_reader, util
 
 
 @pytest.mark.parametrize("config", ["snapshot.toml"], indirect=True)
@@ -187,3 +190,238 @@ def test_snapshot_create_filter(config, snapshot_create):
     state = [x.strip() for x in result.stdout.split("\n") if x]
     expect = ["libhello_0.1-1_amd64"]
     assert state == expect
+
+
+PACKAGES = """Name: %s
+Packages:
+  %s
+"""
+
+
+def test_snapshot_update_unchanged(fake_aptly):
+    """Test if snapshots with the packages of their source are not rotated."""
+    output = fake_aptly.parent / "output"
+    (output / "snapshot_list_-raw").write_text("a-current\nb-current\n")
+    (output / "snapshot_show_b-current").write_text(
+        "Name: b-current\nSources:\n  a-current [snapshot]\n"
+    )
+    (output / "mirror_show_-with-packages_m").write_text(
+        PACKAGES % ("m", "pkg_1.0_amd64")
+    )
+    (output / "snapshot_show_-with-packages_a-current").write_text(
+        PACKAGES % ("a-current", "pkg_1.0_amd64")
+    )
+    cfg = {
+        "execution": {"skip-unchanged": True},
+        "snapshot": {
+            "a-current": {"mirror": "m"},
+            "b-current": {"merge": ["a-current"]},
+        },
+    }
+    for type_ in ("mirror", "snapshot", "repo", "publish"):
+        state_reader.state_reader().invalidate(type_)
+    snapshots = model.config(cfg).snapshots
+    assert snapshot.cmd_snapshot_update(cfg, "a-current", snapshots["a-current"]) == []
+    assert snapshot.snapshot_unchanged(cfg, "b-current")
+    assert not snapshot.snapshot_unchanged(cfg, "a-current", {("mirror", "m")})
+
+    (output / "mirror_show_-with-packages_m").write_text(
+        PACKAGES % ("m", "pkg_1.1_amd64")
+    )
+    assert not snapshot.snapshot_unchanged(cfg, "b-current")
+    commands = snapshot.cmd_snapshot_update(cfg, "a-current", snapshots["a-current"])
+    assert ["aptly", "snapshot", "rename", "a-current"] in [
+        list(cmd.cmd[:4]) for cmd in commands
+    ]
+
+
+def publish_json(prefix, snapshot):
+    """Return a publish as in aptly publish list -json."""
+    return {
+        "Prefix": prefix,
+        "Distribution": "main",
+        "Storage": "",
+        "SourceKind": "snapshot",
+        "Sources": [{"Component": "main", "Name": snapshot}],
+    }
+
+
+@pytest.mark.parametrize("unswitched", [True, False])
+def test_snapshot_update_cleanup(fake_aptly, freeze, unswitched):
+    """Test if rotated snapshots are dropped after the publishes switched."""
+    output = fake_aptly.parent / "output"
+    (output / "snapshot_list_-raw").write_text("a-current\nb-current\n")
+    (output / "snapshot_show_a-current").write_text("Name: a-current\n")
+    (output / "snapshot_show_b-current").write_text(
+        "Name: b-current\nSources:\n  a-current [snapshot]\n"
+    )
+    publishes = [publish_json("pub", "b-current")]
+    if unswitched:
+        publishes.append(publish_json("old", "a-current"))
+    (output / "publish_list_-json").write_text(json.dumps(publishes))
+    cfg = {
+        "execution": {"cleanup-rotated": True},
+        "snapshot": {
+            "a-current": {"mirror": "m"},
+            "b-current": {"merge": ["a-current"]},
+        },
+        "publish": {
+            "pub": [
+                {
+                    "distribution": "main",
+                    "components": "main",
+                    "automatic-update": True,
+                    "snapshots": ["b-current"],
+                }
+            ]
+        },
+    }
+    for type_ in ("mirror", "snapshot", "repo", "publish"):
+        state_reader.state_reader().invalidate(type_)
+    commands = snapshot.cmd_snapshot_update(
+        cfg, "b-current", model.config(cfg).snapshots["b-current"]
+    )
+    commands.extend(snapshot.cmd_cleanup_rotated(cfg, commands))
+    drops = dict(
+        (cmd.cmd[-1], cmd)
+        for cmd in commands
+        if list(cmd.cmd[:3]) == ["aptly", "snapshot", "drop"]
+    )
+    a_rotated = "a-current-rotated-20121010T1010Z"
+    b_rotated = "b-current-rotated-20121010T1010Z"
+    if unswitched:
+        assert list(drops) == [b_rotated]
+    else:
+        assert list(drops) == [b_rotated, a_rotated]
+        assert ("virtual", "dropped-%s" % b_rotated) in drops[a_rotated]._requires
+    assert ("virtual", "rotated-snapshots-droppable") in drops[b_rotated]._requires
+    ready = [
+        cmd
+        for cmd in commands
+        if ("virtual", "rotated-snapshots-droppable") in cmd.get_provides()
+    ]
+    assert ("publish", "pub main") in ready[0]._requires
+
+
+def test_snapshot_update_all_cleanup(fake_aptly, freeze):
+    """Test if the snapshots rotated by snapshot update all are dropped once."""
+    output = fake_aptly.parent / "output"
+    (output / "mirror_list_-raw").write_text("m1\nm2\n")
+    (output / "snapshot_list_-raw").write_text(
+        "a-current\nb-current\nc-current\narchive\n"
+    )
+    for name, sources in [
+        ("a-current", []),
+        ("c-current", []),
+        ("b-current", ["a-current", "c-current"]),
+        # An archived clone keeps a-current
+        ("archive", ["a-current"]),
+    ]:
+        (output / ("snapshot_show_%s" % name)).write_text(
+            "Name: %s\nSources:\n%s"
+            % (name, "".join("  %s [snapshot]\n" % source for source in sources))
+        )
+    (output / "publish_list_-json").write_text(
+        json.dumps(
+            [publish_json("pub-a", "a-current"), publish_json("pub", "b-current")]
+        )
+    )
+    cfg = {
+        "execution": {"cleanup-rotated": True},
+        "snapshot": {
+            "a-current": {"mirror": "m1"},
+            "c-current": {"mirror": "m2"},
+            "b-current": {"merge": ["a-current", "c-current"]},
+        },
+        "publish": {
+            name: [
+                {
+                    "distribution": "main",
+                    "components": "main",
+                    "automatic-update": True,
+                    "snapshots": [snap],
+                }
+            ]
+            for name, snap in [("pub-a", "a-current"), ("pub", "b-current")]
+        },
+    }
+    for type_ in ("mirror", "snapshot", "repo", "publish"):
+        state_reader.state_reader().invalidate(type_)
+    args = argparse.Namespace(task="update", snapshot_name="all", debug=False)
+    snapshot.snapshot(cfg, args)
+    log = fake_aptly.read_text().splitlines()
+    drops = [line for line in log if line.startswith("aptly snapshot drop")]
+    assert drops == [
+        "aptly snapshot drop b-current-rotated-20121010T1010Z",
+        "aptly snapshot drop c-current-rotated-20121010T1010Z",
+    ]
+    switches = [line for line in log if line.startswith("aptly publish switch")]
+    assert log.index(drops[0]) > max(log.index(line) for line in switches)
+
+
+def test_snapshot_gc(fake_aptly, freeze):
+    """Test if only unreferenced snapshots past their retention are dropped."""
+    output = fake_aptly.parent / "output"
+    names = ["a-2012100%sT0000Z" % day for day in range(5, 10)]
+    names += ["a-20121010T0000Z", "b-20121005T0000Z", "old-merge"]
+    (output / "snapshot_list_-raw").write_text("\n".join(names) + "\n")
+    for name, source in [
+        ("old-merge", "a-20121007T0000Z"),
+        ("b-20121005T0000Z", "a-20121005T0000Z"),
+    ]:
+        (output / ("snapshot_show_%s" % name)).write_text(
+            "Name: %s\nSources:\n  %s [snapshot]\n" % (name, source)
+        )
+    (output / "publish_list_-json").write_text(
+        json.dumps([publish_json("pub", "a-20121006T0000Z")])
+    )
+    cfg = {
+        "snapshot": {
+            "a-%T": {
+                "mirror": "m",
+                "timestamp": {"time": "00:00"},
+                "retention": {"keep": 2},
+            },
+            "b-%T": {
+                "merge": [{"name": "a-%T", "timestamp": "current"}],
+                "timestamp": {"time": "00:00"},
+                "retention": {"keep": 1},
+            },
+        },
+    }
+    for type_ in ("mirror", "snapshot", "repo", "publish"):
+        state_reader.state_reader().invalidate(type_)
+    create = snapshot.cmd_snapshot_create(
+        cfg, "b-%T", model.config(cfg).snapshots["b-%T"]
+    )
+    commands = snapshot.cmd_snapshot_gc(cfg, create)
+    drops = dict((cmd.cmd[-1], cmd) for cmd in commands[1:])
+    assert list(drops) == [
+        "a-20121008T0000Z",
+        "b-20121005T0000Z",
+        "a-20121005T0000Z",
+    ]
+    assert ("virtual", "dropped-b-20121005T0000Z") in drops[
+        "a-20121005T0000Z"
+    ]._requires
+    assert ("snapshot", "b-20121010T0000Z") in commands[0]._requires
+    for cmd in drops.values():
+        assert ("virtual", "snapshots-collectable") in cmd._requires
+
+
+def test_retained_snapshots_max_age(freeze):
+    """Test if snapshots younger than max-age are retained."""
+    cfg = {
+        "snapshot": {
+            "a-%T": {
+                "mirror": "m",
+                "timestamp": {"time": "00:00"},
+                "retention": {"max-age": 3},
+            },
+        },
+    }
+    existing = ["a-20121008T0000Z", "a-20121007T0000Z", "a-current", "b"]
+    retained = snapshot.retained_snapshots(
+        cfg, "a-%T", model.config(cfg).snapshots["a-%T"], existing
+    )
+    assert retained == {"a-20121008T0000Z": True, "a-20121007T0000Z": False}
@@ -0,0 +1,182 @@
+"""Test reading and caching the aptly state."""
+
+import json
+import threading
+
+import pytest
+
+from .. import command, state_reader
+
+SNAPSHOT_SHOW = """Name: %s
+Description: Merged from sources: 'fakerepo01'
+Sources:
+  fakerepo01 [snapshot]
+"""
+
+
+@pytest.fixture()
+def aptly_root(fake_aptly, tmp_path, monkeypatch):
+    """Create an aptly config and database for the fake aptly, yield the db."""
+    home = tmp_path / "home"
+    home.mkdir()
+    db = tmp_path / "aptly" / "db"
+    db.mkdir(parents=True)
+    (db / "CURRENT").write_text("MANIFEST-000001\n")
+    config = {"rootDir": str(tmp_path / "aptly")}
+    (home / ".aptly.conf").write_text(json.dumps(config))
+    monkeypatch.setenv("HOME", str(home))
+    monkeypatch.setattr(state_reader, "APTLY_CONFIGS", ("~/.aptly.conf",))
+    monkeypatch.setenv("GNUPGHOME", str(home / "gnupg"))
+    output = fake_aptly.parent / "output"
+    (output / "mirror_list_-raw").write_text("fakerepo01\n")
+    (output / "snapshot_list_-raw").write_text("a\nb\n")
+    (output / "snapshot_show_a").write_text(SNAPSHOT_SHOW % "a")
+    yield db
+
+
+def test_state_cache(aptly_root, fake_aptly, tmp_path):
+    """Test if the state is loaded from disk while aptly is unchanged."""
+    cache = tmp_path / "state.json"
+    state = state_reader.SystemStateReader()
+    state.load_cache(cache)
+    assert state.mirrors() == {"fakerepo01"}
+    assert state.snapshot_map()["a"] == {"fakerepo01"}
+    state.save_cache()
+    calls = len(fake_aptly.read_text().splitlines())
+    assert calls == 3
+
+    state = state_reader.SystemStateReader()
+    state.load_cache(cache)
+    assert state.mirrors() == {"fakerepo01"}
+    assert state.snapshots() == {"a", "b"}
+    assert state.snapshot_map()["a"] == {"fakerepo01"}
+    assert len(fake_aptly.read_text().splitlines()) == calls
+
+    # Invalidated state is read again and not saved
+    state.invalidate("snapshot")
+    assert state.snapshots() == {"a", "b"}
+    assert len(fake_aptly.read_text().splitlines()) == calls + 1
+    state.invalidate("snapshot")
+    state.save_cache()
+    saved = json.loads(cache.read_text())["state"]
+    assert saved == {"mirrors": ["fakerepo01"]}
+
+    # Changing the database invalidates the cache
+    (aptly_root / "CURRENT").write_text("MANIFEST-0000002\n")
+    state = state_reader.SystemStateReader()
+    state.load_cache(cache)
+    assert state.mirrors() == {"fakerepo01"}
+    assert len(fake_aptly.read_text().splitlines()) == calls + 2
+
+
+def test_state_cache_without_aptly(fake_aptly, tmp_path, monkeypatch):
+    """Test if no cache is saved if the aptly database is not found."""
+    monkeypatch.setenv("HOME", str(tmp_path))
+    monkeypatch.setattr(state_reader, "APTLY_CONFIGS", ("~/.aptly.conf",))
+    cache = tmp_path / "state.json"
+    state = state_reader.SystemStateReader()
+    state.load_cache(cache)
+    state.save_cache()
+    assert not cache.exists()
+
+
+def publish_list(snapshot):
+    """Return the output of aptly publish list -json."""
+    publish = {
+        "Prefix": "fake",
+        "Distribution": "stable",
+        "Storage": "",
+        "SourceKind": "snapshot",
+        "Sources": [{"Component": "main", "Name": snapshot}],
+    }
+    return json.dumps([publish], indent=2)
+
+
+def test_write_through(aptly_root, fake_aptly, monkeypatch, caplog):
+    """Test if commands update the cached state without reading it again."""
+    state = state_reader.SystemStateReader()
+    monkeypatch.setattr(state_reader, "_state_reader", state)
+    output = fake_aptly.parent / "output"
+    (output / "publish_list_-json").write_text(publish_list("a"))
+    assert state.snapshot_map()["a"] == {"fakerepo01"}
+    assert state.publish_map() == {"fake stable": {"a"}}
+
+    rename = command.Command(["aptly", "snapshot", "rename", "a", "a-rotated"])
+    rename.provide("snapshot", "a-rotated")
+    merge = command.Command(["aptly", "snapshot", "merge", "a", "b"])
+    merge.provide("snapshot", "a")
+    switch = command.Command(
+        ["aptly", "publish", "switch", "-component=main", "stable", "fake", "a"]
+    )
+    switch.provide("publish", "fake stable")
+    for cmd in [rename, merge, switch]:
+        cmd.execute()
+    log = fake_aptly.read_text().splitlines()
+    assert log[-3:] == [" ".join(cmd.cmd) for cmd in [rename, merge, switch]]
+    assert state.snapshots() == {"a", "a-rotated", "b"}
+    assert state.snapshot_map()["a"] == {"b"}
+    assert state.snapshot_map()["a-rotated"] == {"fakerepo01"}
+    assert state.publish_map() == {"fake stable": {"a"}}
+    assert len(fake_aptly.read_text().splitlines()) == len(log)
+
+    # The verification reads the changed state again
+    (output / "snapshot_list_-raw").write_text("a\na-rotated\nb\n")
+    (output / "snapshot_show_a").write_text(SNAPSHOT_SHOW.replace("fakerepo01", "b"))
+    (output / "snapshot_show_a-rotated").write_text(SNAPSHOT_SHOW % "a-rotated")
+    (output / "publish_list_-json").write_text(publish_list("b"))
+    state.verify()
+    assert "The publish_records differ" in caplog.text
+    assert "The snapshot" not in caplog.text
+    assert state.publish_map() == {"fake stable": {"b"}}
+    assert state.snapshot_map()["a"] == {"b"}
+
+
+def test_write_through_unknown(aptly_root, fake_aptly, monkeypatch):
+    """Test if the state is read again after commands with unknown effect."""
+    state = state_reader.SystemStateReader()
+    monkeypatch.setattr(state_reader, "_state_reader", state)
+    assert state.snapshots() == {"a", "b"}
+    pull = command.Command(["aptly", "snapshot", "pull", "a", "b", "c", "pkg"])
+    pull.provide("snapshot", "c")
+    pull.execute()
+    (fake_aptly.parent / "output" / "snapshot_list_-raw").write_text("a\nb\nc\n")
+    assert state.snapshots() == {"a", "b", "c"}
+
+
+def test_invalidate_locked(fake_aptly):
+    """Test if the state is not invalidated while another thread reads it."""
+    (fake_aptly.parent / "output" / "snapshot_list_-raw").write_text("a\n")
+    state = state_reader.SystemStateReader()
+    assert state.snapshots() == {"a"}
+    invalidate = threading.Thread(target=state.invalidate, args=("snapshot",))
+    with state._lock:
+        invalidate.start()
+        invalidate.join(0.1)
+        assert invalidate.is_alive()
+        assert "snapshots" in state._known
+    invalidate.join()
+    assert "snapshots" not in state._known
+
+
+def test_dependents():
+    """Test if the merge-tree below a snapshot is walked once."""
+    sources = {
+        "top": {"left", "right"},
+        "left": {"base"},
+        "right": {"base"},
+        "base": set(),
+    }
+    snapshot_map = state_reader.SnapshotMap(lambda: set(sources), sources)
+    assert snapshot_map.dependents("top") == ("left", "base", "right")
+    assert snapshot_map.dependents("right") == ("base",)
+    assert snapshot_map.dependents("missing") == ()
+    snapshot_map.rename("base", "renamed")
+    assert snapshot_map.dependents("top") == ("left", "renamed", "right")
+
+
+def test_dependents_cycle():
+    """Test if a cycle in the merge-tree is reported."""
+    sources = {"a": {"b"}, "b": {"c"}, "c": {"b"}}
+    snapshot_map = state_reader.SnapshotMap(lambda: set(sources), sources)
+    with pytest.raises(ValueError, match="b -> c -> b"):
+        snapshot_map.dependents("a")
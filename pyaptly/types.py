@@ -3,6 +3,6 @@
 from typing import TYPE_CHECKING, Callable
 
 if TYPE_CHECKING:  # pragma: no cover
-    from . import command
+    from . import command, model
 
-SnapshotCommand = Callable[[dict, str, dict], list["command.Command"]]
+SnapshotCommand = Callable[[dict, str, "model.Snapshot"], list["command.Command"]]
@@ -4,14 +4,10 @@ import logging
 import os
 import subprocess
 import sys
-import traceback
 from pathlib import Path
 from subprocess import PIPE, CalledProcessError  # noqa: F401
-from tempfile import NamedTemporaryFile
 from typing import Optional, Sequence
 
-from colorama import Fore, init
-
 _DEFAULT_KEYSERVER: str = "hkps://keys.openpgp.org"
 _PYTEST_KEYSERVER: Optional[str] = None
 
@@ -41,6 +37,9 @@ def exit_with_error(error):
 
 
 def write_traceback():  # pragma: no cover
+    import traceback
+    from tempfile import NamedTemporaryFile
+
     with NamedTemporaryFile("w", delete=False) as tmp:
         tmp.write(traceback.format_exc())
         tmp.close()
@@ -51,8 +50,10 @@ def isatty():
     global _isatty_cache
     if _isatty_cache is None:
         _isatty_cache = os.isatty(1)
-        if _isatty_cache:
-            init()  # pragma: no cover
+        if _isatty_cache:  # pragma: no cover
+            from colorama import init
+
+            init()
     return _isatty_cache
 
 
@@ -177,6 +178,8 @@ def format_run_result(result: subprocess.CompletedProcess, returncode: int, tb:
     color_begin = ""
     color_end = ""
     if isatty():  # pragma: no cover
+        from colorama import Fore
+
         if returncode == 0:
             color_begin = Fore.RED
             color_end = Fore.YELLOW